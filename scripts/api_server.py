@@ -0,0 +1,530 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import csv
+import dataclasses
+import hashlib
+import io
+import json
+import mimetypes
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from pivot import MonthTable
+from query import Dataset, Query, split_list
+
+# Service HTTP (asyncio, bibliothèque standard) au-dessus de docs/data:
+#   GET /months                      mois publiés {pe: {rows, formats}}
+#   GET /columns[?pe=YYYYMM]         colonnes
+#   GET /data?start=&end=&ou=&org2=&org3=&columns=&format=ndjson|csv
+#   GET /<fichier de docs/data>      fichiers publiés tels quels (Range accepté: lecture bgzf par blocs)
+# - ETag = sha256 des entrées d'index des mois concernés (qui contiennent le sha256 de chaque part)
+#   + paramètres; If-None-Match -> 304.
+# - /data sans filtre ni projection (ndjson, client gzip): les parts .ndjson.gz sont envoyées
+#   telles quelles (Content-Encoding: gzip, membres gzip concaténés), sans recompression.
+# - sinon: mois décodés en MonthTable gardés dans un LRU borné (--cache_mb); une requête sur
+#   peu d'OU d'un mois absent du cache passe par query.Dataset (lecture ciblée, sans remplir le cache).
+# - index.json surveillé (--reload_s): les mois modifiés sont retirés du cache.
+#   python scripts/api_server.py --data docs/data --port 8000
+
+CHUNK_BYTES = 64 * 1024
+MAX_HEADER_BYTES = 64 * 1024
+REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    416: "Range Not Satisfiable",
+    500: "Internal Server Error",
+}
+CONTENT_TYPES = {".ndjson": "application/x-ndjson", ".json": "application/json", ".csv": "text/csv"}
+
+
+def entry_signature(entry: dict) -> str:
+    """Change dès qu'un fichier publié du mois change (l'entrée contient sha256/octets de chaque fichier)."""
+    return hashlib.sha256(json.dumps(entry, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+class MonthCache:
+    """LRU des mois décodés, borné en octets (matrice 8 o/cellule + ~100 o par OU)."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.items: "OrderedDict[Tuple[str, str], MonthTable]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def size_of(t: MonthTable) -> int:
+        return len(t.data) * 8 + len(t.ous) * 100
+
+    def get(self, key: Tuple[str, str]) -> Optional[MonthTable]:
+        with self.lock:
+            t = self.items.get(key)
+            if t is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return t
+
+    def put(self, key: Tuple[str, str], t: MonthTable) -> None:
+        size = self.size_of(t)
+        with self.lock:
+            if key in self.items or size > self.max_bytes:
+                return
+            self.items[key] = t
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, old = self.items.popitem(last=False)
+                self.bytes -= self.size_of(old)
+
+    def drop_stale(self, signatures: Dict[str, str]) -> List[str]:
+        """Retire les mois dont la signature publiée a changé (ou disparus)."""
+        with self.lock:
+            stale = [k for k in self.items if signatures.get(k[0]) != k[1]]
+            for k in stale:
+                self.bytes -= self.size_of(self.items.pop(k))
+        return sorted(pe for pe, _ in stale)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"months": len(self.items), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
+
+
+@dataclasses.dataclass
+class Response:
+    status: int = 200
+    headers: Dict[str, str] = dataclasses.field(default_factory=dict)
+    body: bytes = b""
+    stream: Optional[Iterator[bytes]] = None  # corps produit par morceaux (Transfer-Encoding: chunked)
+
+
+def json_response(obj: object, status: int = 200, etag: Optional[str] = None) -> Response:
+    headers = {"Content-Type": "application/json; charset=utf-8"}
+    if etag:
+        headers["ETag"] = etag
+    return Response(status, headers, json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+
+
+def error(status: int, message: str) -> Response:
+    return json_response({"error": message}, status=status)
+
+
+def batched(lines: Iterator[bytes], size: int = CHUNK_BYTES) -> Iterator[bytes]:
+    buf: List[bytes] = []
+    n = 0
+    for line in lines:
+        buf.append(line)
+        n += len(line)
+        if n >= size:
+            yield b"".join(buf)
+            buf, n = [], 0
+    if buf:
+        yield b"".join(buf)
+
+
+def accepts_gzip(header: str) -> bool:
+    """Accept-Encoding avec q-values: "gzip;q=0" refuse gzip, "*" vaut pour gzip s'il n'est pas cité."""
+    q: Dict[str, float] = {}
+    for item in header.split(","):
+        coding, *attrs = [x.strip() for x in item.split(";")]
+        weight = 1.0
+        for a in attrs:
+            k, _, v = a.partition("=")
+            if k.strip().lower() == "q":
+                try:
+                    weight = float(v)
+                except ValueError:
+                    weight = 0.0
+        if coding:
+            q[coding.lower()] = weight
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in q:
+            return q[coding] > 0
+    return False
+
+
+def gzip_stream(chunks: Iterator[bytes], level: int = 6) -> Iterator[bytes]:
+    z = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
+
+
+def iter_file(path: Path, start: int = 0, length: Optional[int] = None) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        f.seek(start)
+        left = length
+        while left is None or left > 0:
+            data = f.read(CHUNK_BYTES if left is None else min(CHUNK_BYTES, left))
+            if not data:
+                return
+            if left is not None:
+                left -= len(data)
+            yield data
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """"bytes=a-b" / "bytes=a-" / "bytes=-n" -> (début, longueur); une seule plage."""
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    a, _, b = header[6:].strip().partition("-")
+    try:
+        if a == "":
+            n = int(b)
+            start = max(size - n, 0)
+            end = size - 1
+        else:
+            start = int(a)
+            end = min(int(b), size - 1) if b else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return None
+    return start, end - start + 1
+
+
+class App:
+    def __init__(self, ds: Dataset, cache: MonthCache, pushdown_max_ous: int = 500) -> None:
+        self.ds = ds
+        self.cache = cache
+        self.pushdown_max_ous = pushdown_max_ous
+        self.signatures: Dict[str, str] = {}
+        self._seen: Optional[dict] = None  # dernier index.json pris en compte
+        self.file_sha: Dict[str, str] = {}
+        self.lock = threading.Lock()
+        self.reload()
+
+    # ---- index ----
+
+    def reload(self) -> List[str]:
+        """Relit index.json (si modifié): signatures des mois, sha256 des fichiers; renvoie les mois évincés."""
+        with self.lock:
+            return self._reload()
+
+    def _reload(self) -> List[str]:
+        index = self.ds.index  # relu par Dataset seulement si son mtime a changé
+        if index is self._seen:
+            return []
+        self._seen = index
+        months = index.get("months", {})
+        sigs = {pe: entry_signature(e) for pe, e in months.items()}
+        if sigs == self.signatures:
+            return []
+        self.signatures = sigs
+        self.file_sha = {}
+        for pe, e in months.items():
+            slices = [("", e)] + [(f"org2={uid}/", sl) for uid, sl in (e.get("org2") or {}).items()]
+            for prefix, sl in slices:
+                for p in sl.get("parts") or []:
+                    if p.get("sha256"):
+                        self.file_sha[f"monthly/{pe}/{prefix}{p['file']}"] = p["sha256"]
+                for extra in ("sparse", "ou_index"):
+                    if (sl.get(extra) or {}).get("sha256"):
+                        self.file_sha[f"monthly/{pe}/{prefix}{sl[extra]['file']}"] = sl[extra]["sha256"]
+        return self.cache.drop_stale(sigs)
+
+    def etag(self, *parts: object) -> str:
+        raw = json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+        return '"' + hashlib.sha256(raw).hexdigest()[:32] + '"'
+
+    # ---- routes ----
+
+    def handle(self, method: str, target: str, headers: Dict[str, str]) -> Response:
+        if method not in ("GET", "HEAD"):
+            return error(405, "only GET and HEAD are supported")
+        url = urlsplit(target)
+        path = unquote(url.path)
+        params = parse_qs(url.query)
+        self.reload()
+        if path in ("/", "/health"):
+            return json_response({"ok": True, "months": len(self.signatures), "cache": self.cache.stats()})
+        if path == "/months":
+            months = dict(sorted(self.ds.index.get("months", {}).items()))
+            body = {pe: {"rows": e.get("rows"), "formats": e.get("formats") or ["ndjson"]} for pe, e in months.items()}
+            return json_response(body, etag=self.etag("months", self.signatures))
+        if path == "/columns":
+            pe = (params.get("pe") or [None])[0]
+            if pe is not None and pe not in self.signatures:
+                return error(404, f"unknown month {pe}")
+            return json_response(self.ds.columns(pe), etag=self.etag("columns", pe, self.signatures))
+        if path == "/data":
+            return self.data(params, headers)
+        return self.static(path, headers)
+
+    def query_of(self, params: Dict[str, List[str]]) -> Tuple[Query, str]:
+        fmt = (params.get("format") or ["ndjson"])[0]
+        if fmt not in ("ndjson", "csv"):
+            raise ValueError("format must be ndjson or csv")
+        columns = [c.strip() for v in params.get("columns") or [] for c in v.split(",") if c.strip()]
+        q = Query(
+            start=(params.get("start") or [None])[0],
+            end=(params.get("end") or [None])[0],
+            ous=split_list(params.get("ou")),
+            org2=split_list(params.get("org2"), sep="\0"),
+            org3=split_list(params.get("org3"), sep="\0"),
+            columns=columns or None,
+        )
+        known = self.ds.columns()
+        unknown = [c for c in q.columns or [] if known and c not in known]
+        if unknown:
+            raise ValueError(f"unknown column(s): {unknown}")
+        return q, fmt
+
+    def data(self, params: Dict[str, List[str]], headers: Dict[str, str]) -> Response:
+        try:
+            q, fmt = self.query_of(params)
+            months = self.ds.months(q)
+            filtered = bool(q.ous or q.org2 or q.org3)
+            ou_version = self.ds.ou_map_mtime() if (q.org2 or q.org3) else None
+        except ValueError as e:
+            return error(400, str(e))
+        gz_ok = accepts_gzip(headers.get("accept-encoding", ""))
+        tag = self.etag(
+            "data", fmt, q.start, q.end, sorted(q.ous or []), sorted(q.org2 or []), sorted(q.org3 or []),
+            q.columns, [(pe, self.signatures.get(pe)) for pe in months], ou_version, gz_ok,
+        )
+        ctype = "text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson; charset=utf-8"
+        base = {"Content-Type": ctype, "ETag": tag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if headers.get("if-none-match") == tag:
+            return Response(304, {"ETag": tag})
+
+        entries = [self.ds.entry(pe) for pe in months]
+        passthrough = entries and all(e.get("parts") for e in entries)  # aucun mois: pas de membre gzip à envoyer
+        if fmt == "ndjson" and not filtered and q.columns is None and gz_ok and passthrough:
+            files = [self.ds.month_folder(pe) / p["file"] for pe, e in zip(months, entries) for p in e["parts"]]
+            size = sum(f.stat().st_size for f in files)
+            stream = (chunk for f in files for chunk in iter_file(f))
+            return Response(200, {**base, "Content-Encoding": "gzip", "Content-Length": str(size)}, stream=stream)
+
+        try:
+            ous = self.ds.resolve_ous(q)
+        except ValueError as e:
+            return error(400, str(e))
+        body = batched(self.iter_output(q, months, ous, fmt))
+        if gz_ok:
+            return Response(200, {**base, "Content-Encoding": "gzip"}, stream=gzip_stream(body))
+        return Response(200, base, stream=body)
+
+    def month_table(self, pe: str) -> MonthTable:
+        key = (pe, self.signatures.get(pe, ""))
+        t = self.cache.get(key)
+        if t is None:
+            entry = self.ds.entry(pe)
+            columns = self.ds.columns(pe)
+            t = MonthTable.from_records(pe, columns, self.ds.scan_slice(self.ds.month_folder(pe), entry, None, None))
+            self.cache.put(key, t)
+        return t
+
+    def iter_output(self, q: Query, months: List[str], ous: Optional[Set[str]], fmt: str) -> Iterator[bytes]:
+        columns = q.columns or self.ds.columns()
+        if fmt == "csv":
+            yield csv_line(["OrgUnit", "Period", *columns])
+        for pe in months:
+            cached = self.cache.get((pe, self.signatures.get(pe, "")))
+            if cached is None and ous is not None and len(ous) <= self.pushdown_max_ous:
+                # peu d'OU: lecture ciblée (parts/blocs/tranche) plutôt que décoder tout le mois
+                records = self.ds.scan(dataclasses.replace(q, start=pe, end=pe, columns=columns))
+                for rec in records:
+                    yield encode_record(rec, columns, fmt)
+                continue
+            t = cached or self.month_table(pe)
+            wanted = None if ous is None else [ou for ou in ous if ou in t.ou_row]
+            if fmt == "ndjson" and q.columns is None and t.columns == columns:
+                for ou, values in t.iter_rows(wanted):
+                    yield t.encode_line(ou, values)  # mêmes octets que les parts publiées
+                continue
+            cidx = [t.columns.index(c) if c in t.columns else -1 for c in columns]
+            for ou, values in t.iter_rows(wanted):
+                rec: dict = {"OrgUnit": ou, "Period": t.period}
+                for c, i in zip(columns, cidx):
+                    v = values[i] if i >= 0 else None
+                    rec[c] = None if v is None or v != v else v
+                yield encode_record(rec, columns, fmt)
+
+    def static(self, path: str, headers: Dict[str, str]) -> Response:
+        root = self.ds.root.resolve()
+        target = (root / path.lstrip("/")).resolve()
+        if root not in target.parents or not target.is_file():
+            return error(404, f"not found: {path}")
+        rel = target.relative_to(root).as_posix()
+        st = target.stat()
+        sha = self.file_sha.get(rel)
+        tag = f'"{sha[:32]}"' if sha else f'W/"{st.st_size:x}-{int(st.st_mtime_ns):x}"'
+        suffixes = target.suffixes
+        ctype = "application/gzip" if suffixes and suffixes[-1] == ".gz" else (
+            CONTENT_TYPES.get(target.suffix) or mimetypes.guess_type(target.name)[0] or "application/octet-stream"
+        )
+        base = {"Content-Type": ctype, "ETag": tag, "Accept-Ranges": "bytes", "Cache-Control": "no-cache"}
+        if headers.get("if-none-match") == tag:
+            return Response(304, {"ETag": tag})
+        rng = headers.get("range")
+        if rng:
+            r = parse_range(rng, st.st_size)
+            if r is None:
+                return Response(416, {"Content-Range": f"bytes */{st.st_size}"})
+            start, length = r
+            return Response(
+                206,
+                {
+                    **base,
+                    "Content-Range": f"bytes {start}-{start + length - 1}/{st.st_size}",
+                    "Content-Length": str(length),
+                },
+                stream=iter_file(target, start, length),
+            )
+        return Response(200, {**base, "Content-Length": str(st.st_size)}, stream=iter_file(target))
+
+
+def csv_line(values: List[object]) -> bytes:
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="\n").writerow(values)
+    return buf.getvalue().encode("utf-8")
+
+
+def encode_record(rec: dict, columns: List[str], fmt: str) -> bytes:
+    if fmt == "csv":
+        cells = ("" if rec.get(c) is None else rec.get(c) for c in columns)
+        return csv_line([rec.get("OrgUnit"), rec.get("Period"), *cells])
+    return (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class Server:
+    def __init__(self, app: App, workers: int = 4) -> None:
+        self.app = app
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    async def run_blocking(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    async def send(self, writer: asyncio.StreamWriter, resp: Response, head_only: bool, keep_alive: bool) -> None:
+        headers = dict(resp.headers)
+        chunked = resp.stream is not None and "Content-Length" not in headers and resp.status != 304
+        if resp.stream is None and resp.status != 304:
+            headers["Content-Length"] = str(len(resp.body))
+        if chunked and not head_only:
+            headers["Transfer-Encoding"] = "chunked"
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        head = f"HTTP/1.1 {resp.status} {REASONS.get(resp.status, '')}\r\n"
+        head += "".join(f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n"
+        writer.write(head.encode("latin-1"))
+        if head_only or resp.status == 304:
+            await writer.drain()
+            return
+        if resp.stream is None:
+            writer.write(resp.body)
+            await writer.drain()
+            return
+        it = resp.stream
+        while True:
+            # décodage/encodage hors de la boucle asyncio; le générateur n'avance que dans un thread à la fois
+            chunk = await self.run_blocking(next, it, None)
+            if chunk is None:
+                break
+            if not chunk:
+                continue
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+            await writer.drain()
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+
+    async def client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    raw = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                lines = raw.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                except ValueError:
+                    await self.send(writer, error(400, "bad request line"), False, False)
+                    return
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        k, v = line.split(":", 1)
+                        headers[k.strip().lower()] = v.strip()
+                conn = headers.get("connection", "").lower()
+                keep_alive = conn != "close" if version == "HTTP/1.1" else conn == "keep-alive"
+                try:
+                    resp = await self.run_blocking(self.app.handle, method, target, headers)
+                except Exception as e:  # une requête en erreur ne doit pas arrêter le service
+                    print(f"ERROR {method} {target}: {e!r}")
+                    resp = error(500, "internal error")
+                print(f"{method} {target} -> {resp.status}")
+                await self.send(writer, resp, method == "HEAD", keep_alive)
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            return
+        finally:
+            writer.close()
+
+    async def watch(self, every_s: float) -> None:
+        while True:
+            await asyncio.sleep(every_s)
+            try:
+                dropped = await self.run_blocking(self.app.reload)
+            except (OSError, ValueError) as e:  # index.json en cours d'écriture / absent
+                print(f"WARN: index.json reload failed: {e}")
+                continue
+            if dropped:
+                print(f"index.json changed: evicted {dropped}")
+
+    async def serve(self, host: str, port: int, reload_s: float) -> None:
+        server = await asyncio.start_server(self.client, host, port, limit=MAX_HEADER_BYTES)
+        print(f"Serving {self.app.ds.root} on http://{host}:{port}")
+        watcher = asyncio.create_task(self.watch(reload_s)) if reload_s > 0 else None
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="HTTP API over the published docs/data dataset")
+    ap.add_argument("--data", default="docs/data", help="Published data folder (index.json, monthly/)")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8000)
+    ap.add_argument("--cache_mb", type=int, default=512, help="Memory budget for decoded months (LRU)")
+    ap.add_argument(
+        "--pushdown_max_ous",
+        type=int,
+        default=500,
+        help="Queries on at most this many OUs read uncached months selectively instead of decoding them",
+    )
+    ap.add_argument("--reload_s", type=float, default=2.0, help="index.json polling interval (0 = per request only)")
+    ap.add_argument("--workers", type=int, default=4, help="Threads for decoding and encoding")
+    ap.add_argument("--no_sparse", action="store_true", help="Decode NDJSON parts even when sparse.bin.gz exists")
+    args = ap.parse_args()
+
+    ds = Dataset(Path(args.data), prefer_sparse=not args.no_sparse)
+    app = App(ds, MonthCache(args.cache_mb * 1024 * 1024), pushdown_max_ous=args.pushdown_max_ous)
+    try:
+        asyncio.run(Server(app, workers=args.workers).serve(args.host, args.port, args.reload_s))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from fetch_dhis2_vaccination import DX_LIST, RENAME_MAP
+from pivot import PivotAccumulator, parse_value
+
+# Benchmark du pivot, sur des données synthétiques au format des lignes analytics
+# [dx, pe, ou, value] (mêmes dx/colonnes que le vrai script):
+# - list:   pivot_records d'origine (dicts longs -> liste de dicts complets triée -> json.dumps)
+# - dict:   accumulateur dict par (ou,pe) streamé ligne à ligne -> json.dumps
+# - matrix: matrice array('d') (pivot.py) sérialisée directement
+#   python scripts/bench_pivot.py --ous 25000 --density 0.14
+
+
+def original_pivot_lines(rows: List[list], dx_expected: List[str], rename_map: Dict[str, str]) -> Iterator[bytes]:
+    """pivot_records d'origine, précédé de rows_to_records (1 dict par ligne analytics)."""
+    long_recs = [{"dx": dx, "pe": pe, "ou": ou, "value": parse_value(val)} for dx, pe, ou, val in rows]
+    idx: Dict[Tuple[str, str], dict] = {}
+    for r in long_recs:
+        key = (r["ou"], r["pe"])
+        row = idx.get(key)
+        if row is None:
+            row = {"ou": r["ou"], "pe": r["pe"]}
+            idx[key] = row
+        old = row.get(r["dx"])
+        val = r["value"]
+        row[r["dx"]] = val if old is None else (old or 0) + (val or 0)
+    for row in idx.values():
+        for dx in dx_expected:
+            row.setdefault(dx, None)
+    out: List[dict] = []
+    for row in idx.values():
+        out_row: dict = {"OrgUnit": row.get("ou"), "Period": f"{row['pe'][:4]}-{row['pe'][4:6]}-01"}
+        for dx in dx_expected:
+            out_row[rename_map.get(dx, dx)] = row.get(dx)
+        out.append(out_row)
+    out.sort(key=lambda x: (x.get("OrgUnit") or "", x.get("Period") or ""))
+    for rec in out:
+        yield (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def dict_pivot_lines(rows: List[list], dx_expected: List[str], rename_map: Dict[str, str]) -> Iterator[bytes]:
+    """Accumulateur dict par (ou,pe) qui ne garde que les dx reçus, sortie streamée."""
+    idx: Dict[Tuple[str, str], Dict[str, Optional[float]]] = {}
+    for dx, pe, ou, val in rows:
+        row = idx.setdefault((ou, pe), {})
+        v = parse_value(val)
+        old = row.get(dx)
+        row[dx] = v if old is None else (old or 0) + (v or 0)
+    cols = [(dx, rename_map.get(dx, dx)) for dx in dx_expected]
+    for ou, pe in sorted(idx):
+        row = idx.pop((ou, pe))
+        rec: dict = {"OrgUnit": ou, "Period": f"{pe[:4]}-{pe[4:6]}-01"}
+        for dx, col in cols:
+            rec[col] = row.get(dx)
+        yield (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def matrix_pivot_lines(rows: List[list], dx_expected: List[str], rename_map: Dict[str, str]) -> Iterator[bytes]:
+    acc = PivotAccumulator(dx_expected, rename_map)
+    acc.add_rows(rows)
+    for pe in sorted(acc.tables):
+        yield from acc.pop_table(pe).iter_lines()
+
+
+def synthetic_rows(n_ou: int, dx: List[str], pe: str, density: float, dup: float, seed: int = 1) -> List[list]:
+    rnd = random.Random(seed)
+    ous = [f"OU{rnd.getrandbits(40):011x}"[:11] for _ in range(n_ou)]
+    rows = []
+    for d in dx:
+        for ou in ous:
+            if rnd.random() < density:
+                rows.append([d, pe, ou, str(rnd.randint(0, 300))])
+                if rnd.random() < dup:
+                    rows.append([d, pe, ou, str(rnd.randint(0, 30))])
+    rnd.shuffle(rows)
+    return rows
+
+
+def measure(fn: Callable[[], int]) -> Tuple[float, float, int]:
+    """(secondes, pic mémoire Mo, octets produits); la mémoire est mesurée dans un 2e passage."""
+    gc.collect()
+    t0 = time.perf_counter()
+    n = fn()
+    dt = time.perf_counter() - t0
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return dt, peak / 1e6, n
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--ous", type=int, default=25_000, help="LEVEL-5 org units")
+    ap.add_argument("--density", type=float, default=0.14, help="Share of non-null cells")
+    ap.add_argument("--dup", type=float, default=0.01, help="Share of duplicated (ou, dx) cells")
+    ap.add_argument("--pe", default="202601")
+    args = ap.parse_args()
+
+    dx_expected = [x.strip() for x in DX_LIST.split(";") if x.strip()]
+    rows = synthetic_rows(args.ous, dx_expected, args.pe, args.density, args.dup)
+    print(f"{len(rows)} analytics rows, {args.ous} OUs x {len(dx_expected)} dx")
+
+    ref = b"".join(original_pivot_lines(rows, dx_expected, RENAME_MAP))
+    same = all(b"".join(f(rows, dx_expected, RENAME_MAP)) == ref for f in (dict_pivot_lines, matrix_pivot_lines))
+    print(f"identical output: {same} ({len(ref) / 1e6:.1f} MB NDJSON)")
+
+    def run(impl) -> Callable[[], int]:
+        return lambda: sum(len(line) for line in impl(rows, dx_expected, RENAME_MAP))
+
+    results = {}
+    impls = (("list", original_pivot_lines), ("dict", dict_pivot_lines), ("matrix", matrix_pivot_lines))
+    for name, impl in impls:
+        dt, peak, _ = measure(run(impl))
+        results[name] = (dt, peak)
+        print(f"{name:>7}: {dt:6.2f} s  peak {peak:7.1f} MB")
+    t1, m1 = results["matrix"]
+    for name in ("list", "dict"):
+        t0, m0 = results[name]
+        print(f"matrix vs {name}: speedup x{t0 / t1:.2f}, memory x{m0 / m1:.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,320 @@
+from __future__ import annotations
+
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from bench_pivot import measure
+from build_ou_map import build_ou_map
+from dhis2_client import Dhis2Client, iter_csv_rows, iter_json_rows
+from fake_dhis2 import FakeConfig, FakeData, csv_body, serve_process
+from fetch_dhis2_vaccination import (
+    DX_LIST,
+    RENAME_MAP,
+    chunk_list,
+    fetch_period,
+    pivot_records,
+    rows_to_records,
+    write_ndjson_gz_parts,
+)
+from telemetry import TELEMETRY
+
+# Benchmarks hors ligne du pipeline, contre fake_dhis2.py (lancé dans un processus à part):
+#   chunk_list, fetch_period (HTTP + streaming + pivot; JSON, et CSV gzip pour fetch_period_csv),
+#   parse_json / parse_csv (parsing seul d'une réponse en mémoire), rows_to_records, pivot_records,
+#   write_ndjson_gz_parts, build_ou_map.
+# Les deux transports se comparent sur les octets reçus (wire_mb) et le CPU de parsing (parse_cpu_s).
+# Pour chaque étape: temps, débit et pic mémoire (tracemalloc, 2e passage, cf. bench_pivot.measure).
+# Les résultats sont gardés dans .bench/<commit>.json pour comparer deux commits:
+#   python scripts/bench_suite.py                      # mesure et enregistre
+#   python scripts/bench_suite.py --compare 1fcfe27    # idem + écart avec .bench/1fcfe27*.json
+
+CONFIG_KEYS = (
+    "ous",
+    "density",
+    "pe",
+    "latency_s",
+    "latency_per_krow_s",
+    "error_rate",
+    "seed",
+    "concurrency",
+    "dx_chunk_chars",
+    "page_size",
+    "gzip_level",
+    "gzip_workers",
+)
+BENCHES = (
+    "chunk_list",
+    "fetch_period",
+    "fetch_period_csv",
+    "parse_json",
+    "parse_csv",
+    "rows_to_records",
+    "pivot_records",
+    "write_ndjson_gz_parts",
+    "build_ou_map",
+)
+FETCH_BENCHES = {"fetch_period": "json", "fetch_period_csv": "csv"}
+
+
+def git_commit() -> str:
+    """Commit courant (suffixe -dirty si des fichiers suivis sont modifiés)."""
+    root = Path(__file__).resolve().parent.parent
+    try:
+        sha = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=root, text=True).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return sha + ("-dirty" if dirty.strip() else "")
+
+
+class FakeServerProcess:
+    """fake_dhis2 dans un processus séparé (le serveur ne prend pas le GIL des étapes mesurées)."""
+
+    def __init__(self, cfg: FakeConfig) -> None:
+        ctx = multiprocessing.get_context()
+        ready = ctx.Queue()
+        self.proc = ctx.Process(target=serve_process, args=(cfg, ready), daemon=True)
+        self.proc.start()
+        self.url: str = ready.get(timeout=120)
+
+    def stats(self) -> dict:
+        with urllib.request.urlopen(self.url + "/__stats") as r:
+            return json.loads(r.read())
+
+    def stop(self) -> None:
+        self.proc.terminate()
+        self.proc.join(timeout=10)
+
+
+def result(name: str, dt: float, peak_mb: float, items: int, unit: str, **extra: object) -> dict:
+    out = {"wall_s": round(dt, 4), "peak_mb": round(peak_mb, 1), "items": items, "unit": unit}
+    out["throughput"] = round(items / dt, 1) if dt > 0 else None
+    out.update(extra)
+    return out
+
+
+def quiet(fn: Callable[[], int]) -> Callable[[], int]:
+    """Les étapes du vrai script impriment leur progression: on la coupe pendant la mesure."""
+
+    def run() -> int:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return fn()
+
+    return run
+
+
+def run_benches(args: argparse.Namespace, only: List[str]) -> Dict[str, dict]:
+    dx_expected = [x.strip() for x in DX_LIST.split(";") if x.strip()]
+    cfg = FakeConfig(
+        n_ou=args.ous,
+        density=args.density,
+        latency_s=args.latency_s,
+        latency_per_krow_s=args.latency_per_krow_s,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    results: Dict[str, dict] = {}
+
+    def report(name: str, res: dict) -> None:
+        results[name] = res
+        print(
+            f"{name:>22}: {res['wall_s']:8.3f} s  peak {res['peak_mb']:8.1f} MB  "
+            f"{res['throughput'] or 0:>12,.0f} {res['unit']}/s",
+            flush=True,
+        )
+
+    if "chunk_list" in only:
+        reps = 2000
+        dt, peak, n = measure(lambda: sum(len(chunk_list(dx_expected, args.dx_chunk_chars)) for _ in range(reps)))
+        report("chunk_list", result("chunk_list", dt, peak, reps * len(dx_expected), "dx", chunks=n // reps))
+
+    needs_server = {"build_ou_map", *FETCH_BENCHES} & set(only)
+    server = FakeServerProcess(cfg) if needs_server else None
+    try:
+        if server is not None:
+            client = Dhis2Client(server.url, "bench", "bench", pool_size=args.concurrency + 1)
+        for name, transport in FETCH_BENCHES.items():
+            if name not in only:
+                continue
+            client_t = Dhis2Client(server.url, "bench", "bench", pool_size=args.concurrency + 1, transport=transport)
+            before = server.stats()
+            TELEMETRY.reset()
+            dt, peak, n = measure(
+                quiet(
+                    lambda: len(
+                        fetch_period(client_t, args.pe, dx_expected, RENAME_MAP, args.dx_chunk_chars, args.concurrency)
+                    )
+                )
+            )
+            after = server.stats()
+            wire = {k: (after[k] - before[k]) // 2 for k in after}  # 2 passages dans measure
+            parse_cpu = TELEMETRY.summary()["chunks"]["parse_cpu_s"] / 2
+            res = result(name, dt, peak, wire["rows"], "rows", records=n)
+            res.update(requests=wire["requests"], errors=wire["errors"], wire_mb=round(wire["bytes"] / 1e6, 1))
+            res["parse_cpu_s"] = round(parse_cpu, 3)
+            report(name, res)
+            print(f"{'':>24}{res['wire_mb']} MB on the wire, parse cpu {res['parse_cpu_s']} s", flush=True)
+        if "build_ou_map" in only:
+            dt, peak, n = measure(quiet(lambda: len(build_ou_map(client, args.page_size, args.concurrency))))
+            report("build_ou_map", result("build_ou_map", dt, peak, n, "ou"))
+    finally:
+        if server is not None:
+            server.stop()
+
+    if {"parse_json", "parse_csv"} & set(only):
+        obj = FakeData(cfg).analytics_json(dx_expected, [args.pe])
+        n_rows = len(obj["rows"])
+        bodies = {"parse_json": json.dumps(obj, separators=(",", ":")).encode("utf-8"), "parse_csv": csv_body(obj)}
+        del obj
+        for name, body in bodies.items():
+            if name not in only:
+                continue
+            # morceaux de 64 Ko, comme iter_content dans Dhis2Client._stream
+            chunks = [body[i : i + (1 << 16)] for i in range(0, len(body), 1 << 16)]
+            parse = iter_csv_rows if name == "parse_csv" else iter_json_rows
+            dt, peak, n = measure(lambda: sum(1 for _ in parse(chunks)))
+            if n != n_rows:
+                raise SystemExit(f"{name}: {n} rows parsed, {n_rows} expected")
+            res = result(name, dt, peak, n, "rows", raw_mb=round(len(body) / 1e6, 1))
+            res["gz_mb"] = round(len(gzip.compress(body, compresslevel=6, mtime=0)) / 1e6, 2)
+            report(name, res)
+            print(f"{'':>24}{res['raw_mb']} MB body, {res['gz_mb']} MB gzipped", flush=True)
+        del bodies
+
+    if not {"rows_to_records", "pivot_records", "write_ndjson_gz_parts"} & set(only):
+        return results
+    # entrées construites hors mesure, libérées dès que l'étape suivante n'en a plus besoin
+    analytics_json: Optional[dict] = FakeData(cfg).analytics_json(dx_expected, [args.pe])
+    n_rows = len(analytics_json["rows"])
+    if "rows_to_records" in only:
+        dt, peak, _ = measure(lambda: len(rows_to_records(analytics_json)))
+        report("rows_to_records", result("rows_to_records", dt, peak, n_rows, "rows"))
+    long_recs = rows_to_records(analytics_json)
+    analytics_json = None
+    if "pivot_records" in only:
+        dt, peak, n = measure(lambda: len(pivot_records(long_recs, dx_expected, RENAME_MAP)))
+        report("pivot_records", result("pivot_records", dt, peak, n_rows, "rows", records=n))
+    if "write_ndjson_gz_parts" in only:
+        records = pivot_records(long_recs, dx_expected, RENAME_MAP)
+        del long_recs
+        raw_mb = sum(len((json.dumps(r, ensure_ascii=False) + "\n").encode("utf-8")) for r in records) / 1e6
+        tmp = Path(tempfile.mkdtemp(prefix="bench-gz-"))
+        parts: List[dict] = []
+
+        def write() -> int:
+            shutil.rmtree(tmp, ignore_errors=True)
+            parts[:] = write_ndjson_gz_parts(
+                tmp, records, max_part_mb=80, level=args.gzip_level, workers=args.gzip_workers, mtime=0
+            )
+            return sum(p["rows"] for p in parts)
+
+        try:
+            dt, peak, n = measure(write)
+            gz_mb = sum(p["bytes"] for p in parts) / 1e6
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        res = result("write_ndjson_gz_parts", dt, peak, n, "rows", raw_mb=round(raw_mb, 1), gz_mb=round(gz_mb, 2))
+        res["mb_per_s"] = round(raw_mb / dt, 1) if dt > 0 else None
+        report("write_ndjson_gz_parts", res)
+    return results
+
+
+def find_run(out_dir: Path, ref: str) -> Path:
+    path = Path(ref)
+    if path.is_file():
+        return path
+    matches = sorted(out_dir.glob(f"{ref}*.json"))
+    if not matches:
+        raise SystemExit(f"No saved benchmark for {ref!r} in {out_dir}")
+    return matches[-1]
+
+
+def compare(current: dict, baseline: dict) -> None:
+    print(f"\nvs {baseline['commit']} ({baseline['date']}):")
+    if current["config"] != baseline["config"]:
+        print(f"  WARNING: different settings {baseline['config']} -> {current['config']}")
+    for name, res in current["results"].items():
+        old = baseline["results"].get(name)
+        if not old:
+            print(f"{name:>22}: (not in baseline)")
+            continue
+        dt = res["wall_s"] / old["wall_s"] if old["wall_s"] else float("nan")
+        mem = f"memory x{res['peak_mb'] / old['peak_mb']:5.2f}" if old["peak_mb"] else "memory    -"
+        flag = "  <-- slower" if dt > 1.10 else ""
+        print(f"{name:>22}: time x{dt:5.2f}  {mem}{flag}")
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Offline benchmarks against a fake DHIS2 server")
+    ap.add_argument("--only", default=None, help=f"Comma separated subset of: {','.join(BENCHES)}")
+    ap.add_argument("--ous", type=int, default=25_000, help="LEVEL-5 org units")
+    ap.add_argument("--density", type=float, default=0.14, help="Share of non-null (ou, dx) cells")
+    ap.add_argument("--pe", default="202601")
+    ap.add_argument("--latency_s", type=float, default=0.0, help="Fake server latency per request")
+    ap.add_argument("--latency_per_krow_s", type=float, default=0.0, help="Fake server latency per 1000 rows")
+    ap.add_argument(
+        "--error_rate",
+        type=float,
+        default=0.0,
+        help="Share of failing requests (retries back off for real: expect multi-second runs)",
+    )
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--dx_chunk_chars", type=int, default=6500)
+    ap.add_argument("--page_size", type=int, default=5000, help="build_ou_map page size")
+    ap.add_argument("--gzip_level", type=int, default=9)
+    ap.add_argument("--gzip_workers", type=int, default=0)
+    ap.add_argument("--out_dir", default=".bench", help="Where results are saved (<commit>.json)")
+    ap.add_argument("--no_save", action="store_true")
+    ap.add_argument("--compare", default=None, help="Baseline: commit prefix (in --out_dir) or JSON file")
+    args = ap.parse_args()
+
+    only = [b.strip() for b in args.only.split(",")] if args.only else list(BENCHES)
+    unknown = [b for b in only if b not in BENCHES]
+    if unknown:
+        print(f"Unknown benchmark(s): {unknown}", file=sys.stderr)
+        return 2
+
+    out_dir = Path(args.out_dir)
+    # lue avant la mesure: --compare peut viser le commit courant, dont le fichier va être réécrit
+    baseline = json.loads(find_run(out_dir, args.compare).read_text(encoding="utf-8")) if args.compare else None
+    commit = git_commit()
+    print(f"commit {commit}, {args.ous} OUs, density {args.density}, python {platform.python_version()}")
+    t0 = time.perf_counter()
+    results = run_benches(args, only)
+    run = {
+        "commit": commit,
+        "date": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()} cpus={os.cpu_count()}",
+        "config": {k: getattr(args, k) for k in CONFIG_KEYS},
+        "results": results,
+        "total_s": round(time.perf_counter() - t0, 1),
+    }
+    if not args.no_save:
+        out_dir.mkdir(parents=True, exist_ok=True)
+        path = out_dir / f"{commit}.json"
+        path.write_text(json.dumps(run, indent=2, sort_keys=True), encoding="utf-8")
+        print(f"saved {path}")
+    if baseline is not None:
+        compare(run, baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
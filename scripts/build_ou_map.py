@@ -1,108 +1,130 @@
 from __future__ import annotations
 
+import argparse
 import gzip
 import json
 import os
 import sys
-from dataclasses import dataclass
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional
-
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-
-
-@dataclass
-class Dhis2Client:
-    base_url: str
-    username: str
-    password: str
-    timeout_s: int = 600  # 10 minutes
-
-    def __post_init__(self) -> None:
-        retry = Retry(
-            total=6,
-            connect=6,
-            read=6,
-            status=6,
-            backoff_factor=5,
-            status_forcelist=[429, 500, 502, 503, 504],
-            allowed_methods=["GET"],
-            raise_on_status=False,
-        )
-        self.session = requests.Session()
-        adapter = HTTPAdapter(max_retries=retry)
-        self.session.mount("https://", adapter)
-        self.session.mount("http://", adapter)
-
-    def _get(self, path: str, params: Dict[str, object]) -> dict:
-        url = self.base_url.rstrip("/") + "/" + path.lstrip("/")
-        r = self.session.get(
-            url,
-            params=params,
-            auth=(self.username, self.password),
-            headers={"Accept": "application/json"},
-            timeout=self.timeout_s,
-        )
-        r.raise_for_status()
-        return r.json()
-
-    def org_units_level(self, level: int) -> List[dict]:
-        params = {
-            "filter": f"level:eq:{level}",
-            "paging": "false",
-            "fields": "id,name,level,path",
-        }
-        data = self._get("api/organisationUnits.json", params)
-        return data.get("organisationUnits", [])
+from typing import Dict, Optional
+
+from dhis2_client import Dhis2Client
+from http_cache import ResponseCache
+from ou_tree import LEVELS, OU_TREE_FORMAT, decode_tree, encode_tree, flat_map, unit_parent
 
 
-def build_ou_map(client: Dhis2Client) -> Dict[str, Dict[str, str]]:
+def slim_unit(ou: dict, level: int) -> dict:
+    return {
+        "id": ou["id"],
+        "name": ou.get("name") or "",
+        "level": ou.get("level", level),
+        "parent": unit_parent(ou),
+        "lastUpdated": ou.get("lastUpdated") or "",
+    }
+
+
+def fetch_units(
+    client: Dhis2Client,
+    updated_since: Optional[str] = None,
+    page_size: int = 5000,
+    concurrency: int = 4,
+) -> Dict[str, dict]:
     """
-    Retourne: { ou5_id: {Org2, Org3, Org4, Org5} }
+    OU des niveaux 2 à 5: uid -> {id, name, level, parent, lastUpdated} (modifiées après updated_since).
+    Téléchargement paginé: la 1re page de chaque niveau donne le nombre de pages, les suivantes
+    sont demandées en parallèle (tous niveaux confondus); chaque page est repliée dans la carte
+    dès son arrivée, on ne garde jamais une réponse complète d'un niveau en mémoire.
     """
-    all_units: Dict[str, dict] = {}
-    for lvl in (2, 3, 4, 5):
-        units = client.org_units_level(lvl)
-        for ou in units:
-            all_units[ou["id"]] = ou
-
-    out: Dict[str, Dict[str, str]] = {}
-
-    for ou_id, ou in all_units.items():
-        if ou.get("level") != 5:
-            continue
-
-        path = ou.get("path") or ""
-        ids = [p for p in path.split("/") if p]
-
-        def name_for(level: int) -> str:
-            for pid in ids:
-                u = all_units.get(pid)
-                if u and u.get("level") == level:
-                    return u.get("name") or ""
-            return ""
-
-        out[ou_id] = {
-            "Org2": name_for(2),
-            "Org3": name_for(3),
-            "Org4": name_for(4),
-            "Org5": ou.get("name") or "",
+    units: Dict[str, dict] = {}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = {
+            pool.submit(client.org_units_page, lvl, 1, page_size, updated_since): (lvl, 1) for lvl in LEVELS
         }
-
-    return out
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for fut in done:
+                lvl, page = futures.pop(fut)
+                page_units, page_count = fut.result()
+                for ou in page_units:
+                    units[ou["id"]] = slim_unit(ou, lvl)
+                if page == 1:
+                    print(f"[level {lvl}] {page_count} page(s) of {page_size}", flush=True)
+                    for p in range(2, page_count + 1):
+                        futures[pool.submit(client.org_units_page, lvl, p, page_size, updated_since)] = (lvl, p)
+    return units
+
+
+def build_ou_map(client: Dhis2Client, page_size: int = 5000, concurrency: int = 4) -> Dict[str, Dict[str, str]]:
+    """
+    Retourne: { ou5_id: {Org2, Org3, Org4, Org5, Org2Id, Org3Id, Org4Id} }
+    (les uid des parents servent au partitionnement par province des données mensuelles)
+    """
+    return flat_map(fetch_units(client, page_size=page_size, concurrency=concurrency))
 
 
-def write_gz_json(path: Path, obj: object) -> None:
+def update_units(
+    client: Dhis2Client,
+    previous: Dict[str, dict],
+    since: str,
+    page_size: int = 5000,
+    concurrency: int = 4,
+) -> Optional[Dict[str, dict]]:
+    """
+    Reconstruction incrémentale: OU modifiées après `since` fusionnées dans la carte précédente.
+    Une suppression ne change aucun lastUpdated: si le nombre d'OU d'un niveau ne correspond plus,
+    renvoie None (=> reconstruction complète).
+    """
+    changed = fetch_units(client, updated_since=since, page_size=page_size, concurrency=concurrency)
+    units = dict(previous)
+    units.update(changed)
+    for lvl in LEVELS:
+        local = sum(1 for u in units.values() if u.get("level") == lvl)
+        remote = client.org_units_count(lvl)
+        if local != remote:
+            print(f"[incremental] level {lvl}: {local} local vs {remote} on server: full rebuild", flush=True)
+            return None
+    print(f"[incremental] {len(changed)} org units updated since {since}", flush=True)
+    return units
+
+
+def write_gz_json(path: Path, obj: object, compact: bool = False) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
-    raw = json.dumps(obj, ensure_ascii=False).encode("utf-8")
-    with gzip.open(path, "wb") as f:
+    seps = (",", ":") if compact else None
+    raw = json.dumps(obj, ensure_ascii=False, separators=seps).encode("utf-8")
+    with gzip.GzipFile(path, "wb", compresslevel=9, mtime=0) as f:
         f.write(raw)
 
 
+def read_tree_units(out_dir: Path) -> Optional[Dict[str, dict]]:
+    try:
+        with gzip.open(out_dir / "ou_tree.json.gz", "rb") as f:
+            return decode_tree(json.loads(f.read()))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
 def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--out", default="docs/data", help="Output folder")
+    ap.add_argument("--cache_dir", default=None, help="On-disk HTTP response cache (disabled if unset)")
+    ap.add_argument("--cache_max_mb", type=int, default=1024)
+    ap.add_argument("--page_size", type=int, default=5000, help="Org units per page")
+    ap.add_argument("--concurrency", type=int, default=4, help="Pages downloaded in parallel")
+    ap.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only fetch org units updated since the previous ou_map.meta.json (full rebuild if counts differ)",
+    )
+    ap.add_argument(
+        "--flat",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Also write the legacy flat ou_map.json.gz next to ou_tree.json.gz",
+    )
+    args = ap.parse_args()
+
     base_url = os.environ.get("DHIS2_BASE_URL")
     username = os.environ.get("DHIS2_USERNAME")
     password = os.environ.get("DHIS2_PASSWORD")
@@ -110,19 +132,50 @@ def main() -> int:
         print("Missing secrets: DHIS2_BASE_URL, DHIS2_USERNAME, DHIS2_PASSWORD", file=sys.stderr)
         return 2
 
-    client = Dhis2Client(base_url=base_url, username=username, password=password)
-    ou_map = build_ou_map(client)
-
-    out_dir = Path("docs/data")
-    write_gz_json(out_dir / "ou_map.json.gz", ou_map)
+    cache = ResponseCache(Path(args.cache_dir), max_mb=args.cache_max_mb) if args.cache_dir else None
+    client = Dhis2Client(
+        base_url=base_url,
+        username=username,
+        password=password,
+        cache=cache,
+        read_retries=6,
+        pool_size=args.concurrency + 1,
+    )
+    out_dir = Path(args.out)
+    units: Optional[Dict[str, dict]] = None
+    since: Optional[str] = None
+    if args.incremental:
+        try:
+            old_meta = json.loads((out_dir / "ou_map.meta.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            old_meta = {}
+        previous = read_tree_units(out_dir)
+        since = old_meta.get("last_updated")
+        if previous is not None and since:
+            units = update_units(client, previous, since, page_size=args.page_size, concurrency=args.concurrency)
+        else:
+            print("[incremental] no previous ou_tree.json.gz / last_updated: full rebuild", flush=True)
+    if units is None:
+        since = None
+        units = fetch_units(client, page_size=args.page_size, concurrency=args.concurrency)
+
+    tree = encode_tree(units)
+    write_gz_json(out_dir / "ou_tree.json.gz", tree, compact=True)
+    ou_map = flat_map(units)
+    if args.flat:
+        write_gz_json(out_dir / "ou_map.json.gz", ou_map)
 
     meta = {
         "generated_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
         "count_ou_level5": len(ou_map),
+        "counts": {str(lvl): len(tree["levels"][str(lvl)]["ids"]) for lvl in LEVELS},
+        # horodatage serveur (pas l'horloge locale) pour la prochaine reconstruction incrémentale
+        "last_updated": max([since or ""] + [u.get("lastUpdated") or "" for u in units.values()]) or None,
+        "format": OU_TREE_FORMAT,
     }
     (out_dir / "ou_map.meta.json").write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
 
-    print(f"OK: ou_map.json.gz generated for {len(ou_map)} OU level 5")
+    print(f"OK: ou_tree.json.gz generated for {len(ou_map)} OU level 5")
     return 0
 
 
@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from sparse_format import compact_number
+
+# Produit "changes": ce qui a changé dans un mois republié, pour qu'un client qui garde les données
+# en local se synchronise sans retélécharger les mois entiers.
+# changes/<seq:06d>-<pe>.json.gz:
+# {
+#   "format": "changes-v1",
+#   "seq": 42, "pe": "202601",
+#   "base": "<signature du mois avant>", "target": "<après>",   # = index.json months[pe]["signature"]
+#   "columns": ["BCG fixe1", ...],
+#   "cells": [[ou, c, old, new], ...],            # OU présentes avant et après; c = indice dans columns,
+#                                                 # null = cellule absente
+#   "added": {"<ou>": [[c, ...], [val, ...]]},    # OU nouvelles (cellules non nulles, comme series)
+#   "removed": ["<ou>", ...]                      # OU sans plus aucune valeur
+# }
+# index.json["changes"]["items"] liste les changesets gardés (les --changes_keep derniers), seq croissant.
+# Un mois publié pour la première fois a un item sans fichier ("file": null): le client le télécharge.
+# Client à jour au seq S: appliquer dans l'ordre les items de seq > S dont "base" est la signature
+# qu'il a du mois; si S < premier seq gardé ou si la base diffère, retélécharger le mois.
+CHANGES_FORMAT = "changes-v1"
+
+Rows = Iterable[Tuple[str, Sequence[Optional[float]]]]
+
+
+def non_null(values: Sequence[Optional[float]]) -> Dict[int, float]:
+    """{indice de colonne: valeur} des cellules présentes (None et NaN = absent)."""
+    return {c: float(v) for c, v in enumerate(values) if v is not None and v == v}
+
+
+def iter_present(rows: Rows) -> Iterator[Tuple[str, Dict[int, float]]]:
+    """OU avec au moins une valeur (une ligne toute nulle vaut une OU absente), triées par OU."""
+    last = None
+    for ou, values in rows:
+        if last is not None and ou <= last:
+            raise ValueError(f"rows not sorted by OU: {last!r} then {ou!r}")
+        last = ou
+        cells = non_null(values)
+        if cells:
+            yield ou, cells
+
+
+def diff_rows(old_rows: Rows, new_rows: Rows) -> dict:
+    """
+    Différence cellule par cellule de deux versions d'un mois (lignes (ou, valeurs alignées sur les
+    mêmes colonnes) triées par OU, comme MonthTable.iter_rows et les fichiers publiés): jointure
+    par fusion, une ligne de chaque côté en mémoire.
+    """
+    cells: List[list] = []
+    added: Dict[str, list] = {}
+    removed: List[str] = []
+    old_it, new_it = iter_present(old_rows), iter_present(new_rows)
+    old, new = next(old_it, None), next(new_it, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            removed.append(old[0])
+            old = next(old_it, None)
+            continue
+        if old is None or new[0] < old[0]:
+            ou, vals = new
+            added[ou] = [list(vals), [compact_number(v) for v in vals.values()]]
+            new = next(new_it, None)
+            continue
+        ou, a = old
+        b = new[1]
+        for c in sorted(a.keys() | b.keys()):
+            va, vb = a.get(c), b.get(c)
+            if va != vb:
+                cells.append(
+                    [ou, c, None if va is None else compact_number(va), None if vb is None else compact_number(vb)]
+                )
+        old, new = next(old_it, None), next(new_it, None)
+    return {"cells": cells, "added": added, "removed": removed}
+
+
+@dataclass
+class ChangeLog:
+    """Changesets publiés dans root (= docs/data/changes) et leur liste dans index.json["changes"]."""
+
+    root: Path
+    keep: int = 180
+    last_seq: int = 0
+    items: List[dict] = field(default_factory=list)
+
+    def __post_init__(self) -> None:
+        self.root = Path(self.root)
+
+    @classmethod
+    def from_index(cls, root: Path, meta: Optional[dict], keep: int) -> "ChangeLog":
+        log = cls(root=root, keep=keep)
+        if meta and meta.get("format") == CHANGES_FORMAT:
+            log.last_seq = int(meta.get("last_seq") or 0)
+            log.items = list(meta.get("items") or [])
+        return log
+
+    def name(self, seq: int, pe: str) -> str:
+        return f"{seq:06d}-{pe}.json.gz"
+
+    def record(
+        self,
+        pe: str,
+        base: Optional[str],
+        target: str,
+        columns: List[str],
+        old_rows: Optional[Rows],
+        new_rows: Rows,
+    ) -> dict:
+        """
+        Ajoute le changeset du mois pe (base -> target). old_rows=None: mois nouveau, item sans fichier.
+        Le fichier est écrit avant la publication du mois; l'item n'est visible qu'une fois
+        index.json réécrit (un seq non publié après un crash est simplement réutilisé).
+        """
+        diff = diff_rows(old_rows, new_rows) if old_rows is not None else None  # peut lever: seq pas consommé
+        self.last_seq += 1
+        seq = self.last_seq
+        item: dict = {"seq": seq, "pe": pe, "base": base, "target": target, "file": None}
+        item["at"] = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        if diff is not None:
+            doc = {"format": CHANGES_FORMAT, "seq": seq, "pe": pe, "base": base, "target": target}
+            doc.update(columns=columns, **diff)
+            raw = json.dumps(doc, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            name = self.name(seq, pe)
+            self.root.mkdir(parents=True, exist_ok=True)
+            tmp = self.root / f".{name}.tmp"
+            with gzip.GzipFile(tmp, "wb", compresslevel=9, mtime=0) as f:
+                f.write(raw)
+            os.replace(tmp, self.root / name)
+            item.update(
+                file=f"changes/{name}",
+                bytes=(self.root / name).stat().st_size,
+                sha256=hashlib.sha256(raw).hexdigest(),
+                cells=len(diff["cells"]),
+                added=len(diff["added"]),
+                removed=len(diff["removed"]),
+            )
+        self.items.append(item)
+        self.trim()
+        return item
+
+    def trim(self) -> None:
+        """Ne garde que les `keep` derniers changesets (fichiers plus anciens supprimés)."""
+        while len(self.items) > max(self.keep, 0):
+            old = self.items.pop(0)
+            if old.get("file"):
+                (self.root / Path(old["file"]).name).unlink(missing_ok=True)
+
+    def meta(self) -> dict:
+        return {
+            "format": CHANGES_FORMAT,
+            "path": "changes/{seq:06d}-{pe}.json.gz",
+            "keep": self.keep,
+            "last_seq": self.last_seq,
+            "first_seq": self.items[0]["seq"] if self.items else self.last_seq + 1,
+            "items": self.items,
+        }
@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+@dataclass
+class CostModel:
+    """
+    Coût serveur appris d'une run à l'autre: secondes par dx, pour 1 période et
+    toutes les OU niveau 5 (moyenne mobile exponentielle des requêtes observées).
+    Sert à découper d'emblée les requêtes trop lourdes au lieu d'attendre le timeout.
+    """
+
+    path: Optional[Path] = None
+    alpha: float = 0.3
+    costs: Dict[str, float] = field(default_factory=dict)
+
+    def __post_init__(self) -> None:
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: Path) -> "CostModel":
+        m = cls(path=path)
+        try:
+            m.costs = {k: float(v) for k, v in json.loads(path.read_text(encoding="utf-8")).items()}
+        except (OSError, ValueError):
+            pass
+        return m
+
+    def estimate(self, dx_items: List[str], n_periods: int = 1, ou_frac: float = 1.0) -> Optional[float]:
+        """Durée attendue (s) d'une requête, None si aucun dx n'est encore connu."""
+        with self.lock:
+            known = [self.costs[d] for d in dx_items if d in self.costs]
+            if not known:
+                return None
+            mean = sum(known) / len(known)
+            total = sum(self.costs.get(d, mean) for d in dx_items)
+        return total * n_periods * ou_frac
+
+    def observe(self, dx_items: List[str], n_periods: int, ou_frac: float, elapsed_s: float) -> None:
+        if not dx_items:
+            return
+        per_dx = elapsed_s / (len(dx_items) * max(1, n_periods) * max(ou_frac, 1e-6))
+        with self.lock:
+            for d in dx_items:
+                old = self.costs.get(d)
+                self.costs[d] = per_dx if old is None else (1 - self.alpha) * old + self.alpha * per_dx
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            raw = json.dumps({k: round(v, 4) for k, v in sorted(self.costs.items())})
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(raw, encoding="utf-8")
+        os.replace(tmp, self.path)
@@ -0,0 +1,486 @@
+from __future__ import annotations
+
+import codecs
+import csv
+import io
+import json
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from http_cache import ResponseCache
+from telemetry import TELEMETRY
+
+TRANSPORTS = ("json", "csv")
+# CSV: gzip demandé explicitement (le corps texte se compresse ~10x; requests le décompresse au fil de l'eau)
+CSV_HEADERS = {"Accept": "text/csv", "Accept-Encoding": "gzip"}
+# en-têtes CSV de DHIS2 (colonnes ou noms affichés selon la version) -> dimension
+CSV_COLUMNS = {
+    "dx": "dx",
+    "data": "dx",
+    "pe": "pe",
+    "period": "pe",
+    "ou": "ou",
+    "organisation unit": "ou",
+    "organisationunit": "ou",
+    "value": "value",
+}
+
+
+class TokenBucket:
+    """
+    Limiteur de débit partagé par tous les workers (token bucket).
+    - acquire() bloque jusqu'à ce qu'un jeton soit disponible
+    - throttle() divise le débit par 2 (réponse 429/503 du serveur)
+    - relax() remonte le débit par petits pas quand tout va bien (AIMD)
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None, min_rate: float = 0.05) -> None:
+        self.max_rate = max(rate, min_rate)
+        self.min_rate = min_rate
+        self.rate = self.max_rate
+        self.burst = burst if burst is not None else max(1.0, self.max_rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self) -> None:
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+        print(f"[rate] throttled -> {self.rate:.2f} req/s", flush=True)
+
+    def relax(self) -> None:
+        with self.lock:
+            if self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class ThrottleAwareRetry(Retry):
+    """
+    Retry urllib3 qui prévient le limiteur quand le serveur répond 429/503,
+    y compris pour les tentatives internes que requests ne voit jamais.
+    """
+
+    on_throttle: Optional[Callable[[], None]] = None
+
+    def new(self, **kw: object) -> "ThrottleAwareRetry":
+        r = super().new(**kw)
+        r.on_throttle = self.on_throttle
+        return r
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None and response.status in (429, 503) and self.on_throttle:
+            self.on_throttle()
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+@dataclass
+class Dhis2Client:
+    """
+    Client DHIS2 commun aux scripts (fetch_dhis2_vaccination.py, build_ou_map.py).
+    Authentification une seule fois (Basic sur api/me) puis réutilisation du cookie de
+    session JSESSIONID: DHIS2 ne revérifie plus le hash du mot de passe à chaque appel.
+    Sur 401 (session expirée), ré-authentification transparente puis nouvel essai.
+    Si le serveur ne pose pas de cookie, on reste en Basic à chaque requête.
+    """
+
+    base_url: str
+    username: str
+    password: str
+    timeout_s: int = 600  # 10 minutes
+    limiter: Optional[TokenBucket] = None
+    pool_size: int = 10  # = concurrence des requêtes
+    cache: Optional[ResponseCache] = None
+    read_retries: int = 1  # une requête trop lourde qui a expiré expirera encore: on la découpe plutôt
+    transport: str = "json"  # analytics_rows: api/analytics.json ou api/analytics.csv (gzip)
+
+    def __post_init__(self) -> None:
+        if self.transport not in TRANSPORTS:
+            raise ValueError(f"transport inconnu: {self.transport!r} (attendu: {', '.join(TRANSPORTS)})")
+        self.session = requests.Session()
+        # keep-alive explicite; 1 connexion par worker, les workers attendent plutôt que d'ouvrir
+        # des connexions jetables au-delà du pool
+        self.session.headers.update({"Accept": "application/json", "Connection": "keep-alive"})
+        adapter = self._adapter([429, 500, 502, 503, 504])
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # analytics: un 5xx vient d'une requête trop lourde, la renvoyer telle quelle ne fait que
+        # perdre du temps; AdaptiveFetcher la découpe dès le premier échec. 429/503 restent retentés.
+        self.session.mount(self._url("api/analytics"), self._adapter([429, 503]))
+        self.auth_lock = threading.Lock()
+        self.auth_generation = 0
+        self.use_cookie = False
+
+    def _adapter(self, statuses: List[int]) -> HTTPAdapter:
+        retry = ThrottleAwareRetry(
+            total=6,
+            connect=6,
+            read=self.read_retries,
+            status=6,
+            backoff_factor=5,  # 5s,10s,20s,40s...
+            status_forcelist=statuses,
+            allowed_methods=["GET"],
+            raise_on_status=False,
+        )
+        if self.limiter is not None:
+            retry.on_throttle = self.limiter.throttle
+        return HTTPAdapter(
+            max_retries=retry,
+            pool_connections=self.pool_size,
+            pool_maxsize=self.pool_size,
+            pool_block=True,
+        )
+
+    def _url(self, path: str) -> str:
+        return self.base_url.rstrip("/") + "/" + path.lstrip("/")
+
+    def _login(self) -> None:
+        """Basic auth une fois sur api/me; garde le cookie de session s'il y en a un."""
+        self.session.cookies.clear()
+        r = self.session.get(
+            self._url("api/me.json"),
+            params={"fields": "id"},
+            auth=(self.username, self.password),
+            timeout=self.timeout_s,
+        )
+        r.raise_for_status()
+        self.use_cookie = bool(self.session.cookies)
+        self.auth_generation += 1
+        mode = "session cookie" if self.use_cookie else "basic auth per request"
+        print(f"[auth] logged in ({mode})", flush=True)
+
+    def _relogin(self, generation: int) -> None:
+        # un seul worker se ré-authentifie; les autres réutilisent la nouvelle session
+        with self.auth_lock:
+            if generation == self.auth_generation:
+                self._login()
+
+    def _request(
+        self,
+        path: str,
+        params: Dict[str, object],
+        stream: bool = False,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> requests.Response:
+        if self.auth_generation == 0:
+            self._relogin(0)
+
+        t0 = time.perf_counter()
+        for attempt in (1, 2):
+            generation = self.auth_generation
+            if self.limiter is not None:
+                self.limiter.acquire()
+            r = self.session.get(
+                self._url(path),
+                params=params,
+                auth=None if self.use_cookie else (self.username, self.password),
+                headers=headers,
+                timeout=self.timeout_s,
+                stream=stream,
+            )
+            if r.status_code == 401 and attempt == 1:
+                r.close()
+                self._relogin(generation)
+                continue
+            break
+
+        # 429/503: le limiteur a déjà été ralenti par ThrottleAwareRetry, y compris pour la réponse finale
+        if self.limiter is not None and r.ok:
+            self.limiter.relax()
+        history = getattr(getattr(r.raw, "retries", None), "history", None) or ()
+        TELEMETRY.request_sent(r.status_code, time.perf_counter() - t0, len(history), relogin=attempt == 2)
+        if not r.ok:
+            r.close()
+        r.raise_for_status()
+        return r
+
+    def _get(self, path: str, params: Dict[str, object]) -> dict:
+        return json.loads(b"".join(self._stream(path, params)))
+
+    def _stream(
+        self,
+        path: str,
+        params: Dict[str, object],
+        chunk_size: int = 1 << 16,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Iterator[bytes]:
+        """Corps de la réponse par morceaux, sans jamais le charger en entier (via le cache si actif)."""
+        TELEMETRY.request_started()
+        t0 = time.perf_counter()
+        nbytes = 0
+        error = ""
+        sent: List[requests.Response] = []
+
+        def send(cond: Dict[str, str]) -> requests.Response:
+            r = self._request(path, params, stream=True, headers={**(headers or {}), **cond})
+            sent.append(r)
+            return r
+
+        try:
+            if self.cache is not None:
+                for chunk in self.cache.stream(path, params, send, chunk_size=chunk_size):
+                    nbytes += len(chunk)
+                    yield chunk
+                return
+            r = send({})
+            try:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    nbytes += len(chunk)
+                    yield chunk
+            finally:
+                r.close()
+        except Exception as e:
+            error = e.__class__.__name__
+            raise
+        finally:
+            # octets reçus avant décompression (Content-Encoding); 0 si servi par le cache
+            wire = sum(wire_bytes(r) for r in sent)
+            cached = self.cache is not None and not sent and not error
+            total_s = time.perf_counter() - t0
+            TELEMETRY.request_done(path, params, nbytes, total_s, error, wire_bytes=wire, cached=cached)
+
+    @staticmethod
+    def _analytics_params(dx_items: List[str], pe: str, ou: str) -> Dict[str, object]:
+        return {
+            "dimension": [f"dx:{';'.join(dx_items)}", f"pe:{pe}", f"ou:{ou}"],
+            "displayProperty": "NAME",
+            "outputIdScheme": "UID",
+            "skipMeta": "true",
+            "paging": "false",
+        }
+
+    def analytics_totals(self, dx_items: List[str], pe: str, ou: str = "LEVEL-5") -> dict:
+        """Sonde légère: 1 ligne par dx (total sur toutes les OU de `ou`, passées en filtre)."""
+        params = {
+            "dimension": [f"dx:{';'.join(dx_items)}", f"pe:{pe}"],
+            "filter": f"ou:{ou}",
+            "outputIdScheme": "UID",
+            "skipMeta": "true",
+        }
+        return self._get("api/analytics.json", params)
+
+    def org_unit_ids(self, level: int) -> List[str]:
+        params = {"filter": f"level:eq:{level}", "paging": "false", "fields": "id"}
+        return [u["id"] for u in self._get("api/organisationUnits.json", params).get("organisationUnits", [])]
+
+    @staticmethod
+    def _org_units_filters(level: int, updated_since: Optional[str]) -> List[str]:
+        filters = [f"level:eq:{level}"]
+        if updated_since:
+            filters.append(f"lastUpdated:gt:{updated_since}")
+        return filters
+
+    def org_units_level(self, level: int, updated_since: Optional[str] = None) -> List[dict]:
+        """OU d'un niveau (id, name, level, path, lastUpdated); seulement celles modifiées après updated_since."""
+        params = {
+            "filter": self._org_units_filters(level, updated_since),
+            "paging": "false",
+            "fields": "id,name,level,path,lastUpdated",
+        }
+        data = self._get("api/organisationUnits.json", params)
+        return data.get("organisationUnits", [])
+
+    def org_units_page(
+        self, level: int, page: int, page_size: int, updated_since: Optional[str] = None
+    ) -> Tuple[List[dict], int]:
+        """Une page d'OU d'un niveau (ordre stable par id); renvoie (OU, nombre de pages)."""
+        params = {
+            "filter": self._org_units_filters(level, updated_since),
+            "paging": "true",
+            "page": page,
+            "pageSize": page_size,
+            "order": "id:asc",
+            "fields": "id,name,level,path,lastUpdated",
+        }
+        data = self._get("api/organisationUnits.json", params)
+        return data.get("organisationUnits", []), int((data.get("pager") or {}).get("pageCount") or 1)
+
+    def org_units_count(self, level: int) -> int:
+        params = {"filter": f"level:eq:{level}", "paging": "true", "pageSize": 1, "fields": "id"}
+        return int((self._get("api/organisationUnits.json", params).get("pager") or {}).get("total") or 0)
+
+    def system_info(self) -> dict:
+        return self._get("api/system/info.json", {})
+
+    def analytics_rows(self, dx_items: List[str], pe: str, ou: str = "LEVEL-5") -> Iterator[list]:
+        """
+        Comme analytics(), mais renvoie les lignes [dx, pe, ou, value] une à une au fil du téléchargement.
+        transport="csv": api/analytics.csv compressé en gzip, lu par csv.reader (valeurs en texte,
+        "" pour null: le pivot les traite comme les valeurs JSON).
+        """
+        params = self._analytics_params(dx_items, pe, ou)
+        if self.transport == "csv":
+            return iter_csv_rows(self._stream("api/analytics.csv", params, headers=CSV_HEADERS))
+        return iter_json_rows(self._stream("api/analytics.json", params), key="rows")
+
+
+def iter_json_rows(chunks: Iterable[bytes], key: str = "rows") -> Iterator[object]:
+    """
+    Parseur JSON incrémental minimal: parcourt l'objet racine et renvoie un par un
+    les éléments du tableau `key` (les autres clés sont décodées puis ignorées).
+    Seul le morceau en cours et la ligne en cours sont gardés en mémoire.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    it = iter(chunks)
+    buf = ""
+    pos = 0
+    eof = False
+
+    def more() -> bool:
+        nonlocal buf, pos, eof
+        if eof:
+            return False
+        c = next(it, None)
+        if c is None:
+            eof = True
+            text = utf8.decode(b"", final=True)
+        else:
+            text = utf8.decode(c)
+        buf = buf[pos:] + text
+        pos = 0
+        return True
+
+    def peek() -> str:
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not more():
+                raise ValueError("JSON tronqué")
+
+    def value() -> object:
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                v, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if not more():
+                    raise
+                continue
+            # un nombre en fin de tampon peut être coupé ("12" de "123"): relire avec la suite
+            if end == len(buf) and more():
+                continue
+            pos = end
+            return v
+
+    def expect(ch: str) -> None:
+        nonlocal pos
+        if peek() != ch:
+            raise ValueError(f"JSON inattendu: {buf[pos:pos + 40]!r}")
+        pos += 1
+
+    expect("{")
+    while True:
+        c = peek()
+        if c == "}":
+            # lire la fin du flux (un cache en écriture ne valide l'entrée qu'à la fin)
+            for _ in it:
+                pass
+            return
+        if c == ",":
+            pos += 1
+            continue
+        k = value()
+        expect(":")
+        if k != key:
+            value()
+            continue
+        expect("[")
+        while True:
+            c = peek()
+            if c == "]":
+                pos += 1
+                break
+            if c == ",":
+                pos += 1
+                continue
+            yield value()
+
+
+def wire_bytes(r: requests.Response) -> int:
+    """Octets lus sur la socket (urllib3 compte avant décodage gzip/deflate)."""
+    try:
+        return int(r.raw.tell())
+    except (AttributeError, OSError, TypeError, ValueError):
+        return 0
+
+
+class ChunkReader(io.RawIOBase):
+    """Flux binaire en lecture sur un itérateur de morceaux (pour io.TextIOWrapper puis csv.reader)."""
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self.chunks = iter(chunks)
+        self.view = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: bytearray) -> int:
+        while not self.view:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.view = memoryview(chunk)
+        n = min(len(b), len(self.view))
+        b[:n] = self.view[:n]
+        self.view = self.view[n:]
+        return n
+
+    def close(self) -> None:
+        # ferme le générateur amont (et donc la réponse HTTP) si la lecture s'arrête avant la fin
+        close = getattr(self.chunks, "close", None)
+        if close is not None:
+            close()
+        super().close()
+
+
+def iter_csv_rows(chunks: Iterable[bytes], columns: Tuple[str, ...] = ("dx", "pe", "ou", "value")) -> Iterator[list]:
+    """
+    Lignes d'une réponse analytics CSV, dans l'ordre de `columns` quel que soit l'ordre des colonnes
+    du serveur (repéré dans la ligne d'en-tête). Le décodage UTF-8 et le découpage se font en C
+    (TextIOWrapper, csv.reader), par blocs de 64 Ko.
+    """
+    text = io.TextIOWrapper(io.BufferedReader(ChunkReader(chunks), 1 << 16), encoding="utf-8-sig", newline="")
+    try:
+        reader = csv.reader(text)
+        header = next(reader, None)
+        if header is None:
+            return
+        found = {CSV_COLUMNS.get(h.strip().casefold()): i for i, h in enumerate(header)}
+        pos = [found.get(c, i) for i, c in enumerate(columns)]
+        if pos == list(range(len(columns))):
+            yield from reader  # ordre attendu: les lignes du lecteur telles quelles
+            return
+        for row in reader:
+            try:
+                yield [row[i] for i in pos]
+            except IndexError:
+                continue
+    finally:
+        text.close()
@@ -0,0 +1,342 @@
+from __future__ import annotations
+
+import argparse
+import base64
+import csv
+import gzip
+import io
+import json
+import multiprocessing
+import random
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+# Serveur DHIS2 factice (hors ligne) pour les benchmarks: api/me.json (cookie de session),
+# api/system/info.json, api/analytics.json|csv et api/organisationUnits.json, avec la forme de nos données:
+# ~25k formations sanitaires (niveau 5) sous 26 provinces / 519 zones / ~9 700 aires, les dx de DX_LIST,
+# ~14 % de cellules (ou, dx) non nulles et ~86 % des formations qui rapportent chaque mois
+# (docs/data/monthly/202601). Valeurs déterministes: (seed, pe, dx) -> mêmes lignes à chaque appel.
+# Latence (fixe + par millier de lignes) et erreurs (429/500/503) injectables. Corps compressés en gzip
+# quand le client l'accepte (comme Tomcat/nginx devant DHIS2).
+#   python scripts/fake_dhis2.py --port 8080 --latency_s 0.5 --error_rate 0.02
+
+UID_CHARS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
+
+@dataclass
+class FakeConfig:
+    n_ou: int = 25_000  # niveau 5
+    n_org4: int = 9_700
+    n_org3: int = 519
+    n_org2: int = 26
+    density: float = 0.14  # part des cellules (ou, dx) non nulles, parmi les OU qui rapportent
+    reporting: float = 0.86  # part des OU avec au moins une valeur dans le mois
+    latency_s: float = 0.0  # par requête
+    latency_per_krow_s: float = 0.0  # en plus, par millier de lignes renvoyées
+    error_rate: float = 0.0
+    error_statuses: Tuple[int, ...] = (429, 500, 503)
+    max_rows: int = 0  # > 0: au-delà, 500 (requête trop lourde, comme un timeout côté DHIS2)
+    analytics_ts: str = "2026-01-01T00:00:00.000"
+    gzip_level: int = 6  # Content-Encoding: gzip si Accept-Encoding le permet (0 = jamais)
+    seed: int = 1
+
+
+class FakeData:
+    """Arbre des OU et valeurs analytics synthétiques (indépendant du HTTP, utilisable seul)."""
+
+    def __init__(self, cfg: FakeConfig) -> None:
+        self.cfg = cfg
+        rnd = random.Random(cfg.seed)
+        seen: set = set()
+
+        def uid() -> str:
+            while True:
+                u = rnd.choice(UID_CHARS[:52]) + "".join(rnd.choice(UID_CHARS) for _ in range(10))
+                if u not in seen:
+                    seen.add(u)
+                    return u
+
+        root = {"id": uid(), "name": "RDC", "level": 1, "parent": None}
+        self.units: List[dict] = [root]
+        above = [root]
+        # petits jeux (--ous 500): jamais plus de parents que d'enfants
+        n4 = min(cfg.n_org4, cfg.n_ou)
+        n3 = min(cfg.n_org3, n4)
+        counts = {2: min(cfg.n_org2, n3), 3: n3, 4: n4, 5: cfg.n_ou}
+        kinds = {2: "Province", 3: "Zone de Santé", 4: "Aire de Santé", 5: "Centre de Santé"}
+        self.by_level: Dict[int, List[dict]] = {1: [root]}
+        for lvl in (2, 3, 4, 5):
+            cur = []
+            for i in range(counts[lvl]):
+                parent = above[i * len(above) // counts[lvl]]
+                cur.append({"id": uid(), "name": f"{kinds[lvl]} {i + 1}", "level": lvl, "parent": parent})
+            self.by_level[lvl] = cur
+            self.units += cur
+            above = cur
+        for u in self.units:
+            p = u["parent"]
+            u["path"] = (p["path"] if p else "") + "/" + u["id"]
+            u["lastUpdated"] = "2024-01-01T00:00:00.000"
+        self.ou5 = [u["id"] for u in self.by_level[5]]
+        self.province_of = {u["id"]: u["path"].split("/")[2] for u in self.by_level[5]}
+
+    @lru_cache(maxsize=4096)
+    def reporting_ous(self, pe: str) -> Tuple[int, ...]:
+        rnd = random.Random(zlib.crc32(f"{self.cfg.seed}:{pe}".encode()))
+        return tuple(i for i in range(len(self.ou5)) if rnd.random() < self.cfg.reporting)
+
+    @lru_cache(maxsize=4096)
+    def cells(self, pe: str, dx: str) -> Tuple[Tuple[int, str], ...]:
+        """(indice d'OU, valeur texte) non nulles de (pe, dx), triées par OU."""
+        rnd = random.Random(zlib.crc32(f"{self.cfg.seed}:{pe}:{dx}".encode()))
+        pool = self.reporting_ous(pe)
+        k = round(len(pool) * self.cfg.density)
+        idx = sorted(rnd.sample(pool, k))
+        if "REPORTING_RATE" in dx:
+            return tuple((i, "100.0" if rnd.random() < 0.9 else "50.0") for i in idx)
+        return tuple((i, str(rnd.randint(0, 300))) for i in idx)
+
+    def ou_filter(self, ou_dim: str) -> Optional[set]:
+        """"LEVEL-5" -> None (toutes); "LEVEL-5;<prov>;..." -> uid des provinces retenues."""
+        items = [x for x in ou_dim.split(";") if x and not x.startswith("LEVEL-")]
+        return set(items) or None
+
+    def analytics_rows(self, dxs: List[str], pes: List[str], ou_dim: str) -> List[list]:
+        provinces = self.ou_filter(ou_dim)
+        rows: List[list] = []
+        for pe in pes:
+            for dx in dxs:
+                for i, v in self.cells(pe, dx):
+                    ou = self.ou5[i]
+                    if provinces is None or self.province_of[ou] in provinces:
+                        rows.append([dx, pe, ou, v])
+        return rows
+
+    def analytics_totals(self, dxs: List[str], pes: List[str]) -> List[list]:
+        rows = []
+        for pe in pes:
+            for dx in dxs:
+                cells = self.cells(pe, dx)
+                if cells:
+                    rows.append([dx, pe, str(sum(float(v) for _, v in cells))])
+        return rows
+
+    def analytics_json(self, dxs: List[str], pes: List[str], ou_dim: str = "LEVEL-5") -> dict:
+        rows = self.analytics_rows(dxs, pes, ou_dim)
+        headers = [{"name": n} for n in ("dx", "pe", "ou", "value")]
+        return {"headers": headers, "rows": rows, "height": len(rows), "width": 4}
+
+    def org_units(self, params: Dict[str, List[str]]) -> dict:
+        units = self.units
+        for flt in params.get("filter", []):
+            f, op, v = (flt.split(":", 2) + ["", ""])[:3]
+            if f == "level" and op == "eq":
+                units = [u for u in units if u["level"] == int(v)]
+            elif f == "lastUpdated" and op == "gt":
+                units = [u for u in units if u["lastUpdated"] > v]
+        units = sorted(units, key=lambda u: u["id"])
+        fields = (params.get("fields") or ["id"])[0].split(",")
+        out: dict = {}
+        if (params.get("paging") or ["true"])[0] != "false":
+            size = int((params.get("pageSize") or ["50"])[0])
+            page = int((params.get("page") or ["1"])[0])
+            total = len(units)
+            out["pager"] = {"page": page, "pageSize": size, "total": total, "pageCount": (total + size - 1) // size}
+            units = units[(page - 1) * size : page * size]
+        out["organisationUnits"] = [{k: u[k] for k in fields if k in u} for u in units]
+        return out
+
+
+@dataclass
+class FakeStats:
+    requests: int = 0
+    errors: int = 0
+    bytes_sent: int = 0
+    rows_sent: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, nbytes: int, rows: int, error: bool) -> None:
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.bytes_sent += nbytes
+            self.rows_sent += rows
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {"requests": self.requests, "errors": self.errors, "bytes": self.bytes_sent, "rows": self.rows_sent}
+
+
+class FakeDhis2Server:
+    """Serveur HTTP dans un thread: with FakeDhis2Server(cfg) as srv: Dhis2Client(srv.url, "u", "p")."""
+
+    def __init__(self, cfg: Optional[FakeConfig] = None, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.cfg = cfg or FakeConfig()
+        self.data = FakeData(self.cfg)
+        self.stats = FakeStats()
+        self.sessions: set = set()
+        self.rnd = random.Random(self.cfg.seed + 1)
+        self.rnd_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeDhis2Server":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "FakeDhis2Server":
+        return self.start()
+
+    def __exit__(self, *exc: object) -> None:
+        self.stop()
+
+    def inject_error(self) -> Optional[int]:
+        with self.rnd_lock:
+            if self.cfg.error_rate and self.rnd.random() < self.cfg.error_rate:
+                return self.rnd.choice(self.cfg.error_statuses)
+        return None
+
+    def respond(self, path: str, params: Dict[str, List[str]], headers: Dict[str, str]) -> Tuple[int, dict, int]:
+        """(statut, corps JSON, nb de lignes analytics)."""
+        if path == "/__stats":  # compteurs du serveur (benchmarks)
+            return 200, self.stats.as_dict(), 0
+        if path.endswith("api/me.json"):
+            if not headers.get("authorization", "").startswith("Basic "):
+                return 401, {}, 0
+            user = base64.b64decode(headers["authorization"][6:]).split(b":")[0].decode()
+            return 200, {"id": "fake", "username": user}, 0
+        cookie = headers.get("cookie", "")
+        sid = next((c.strip()[11:] for c in cookie.split(";") if c.strip().startswith("JSESSIONID=")), None)
+        if sid not in self.sessions and not headers.get("authorization"):
+            return 401, {"httpStatus": "Unauthorized"}, 0
+        status = self.inject_error()
+        if status is not None:
+            return status, {"httpStatus": "Error", "message": "injected"}, 0
+        if path.endswith("api/system/info.json"):
+            return 200, {"lastAnalyticsTableGeneration": self.cfg.analytics_ts}, 0
+        if path.endswith("api/organisationUnits.json"):
+            return 200, self.data.org_units(params), 0
+        if path.endswith(("api/analytics.json", "api/analytics.csv")):
+            dims = dict(d.split(":", 1) for d in params.get("dimension", []) if ":" in d)
+            dxs = [x for x in dims.get("dx", "").split(";") if x]
+            pes = [x for x in dims.get("pe", "").split(";") if x]
+            if "ou" not in dims:
+                rows = self.data.analytics_totals(dxs, pes)
+                return 200, {"headers": [{"name": n} for n in ("dx", "pe", "value")], "rows": rows}, len(rows)
+            rows = self.data.analytics_rows(dxs, pes, dims["ou"])
+            if self.cfg.max_rows and len(rows) > self.cfg.max_rows:
+                return 500, {"httpStatus": "Internal Server Error", "message": "query too heavy"}, 0
+            headers_ = [{"name": n} for n in ("dx", "pe", "ou", "value")]
+            return 200, {"headers": headers_, "rows": rows, "height": len(rows), "width": 4}, len(rows)
+        return 404, {"httpStatus": "Not Found"}, 0
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args: object) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                url = urlsplit(self.path)
+                headers = {k.lower(): v for k, v in self.headers.items()}
+                status, obj, rows = server.respond(url.path, parse_qs(url.query), headers)
+                delay = server.cfg.latency_s + server.cfg.latency_per_krow_s * rows / 1000
+                if delay:
+                    time.sleep(delay)
+                if status == 200 and url.path.endswith(".csv"):
+                    body, ctype = csv_body(obj), "application/csv;charset=UTF-8"
+                else:
+                    body, ctype = json.dumps(obj, separators=(",", ":")).encode("utf-8"), "application/json"
+                encoding = ""
+                if server.cfg.gzip_level and "gzip" in headers.get("accept-encoding", ""):
+                    body, encoding = gzip.compress(body, compresslevel=server.cfg.gzip_level, mtime=0), "gzip"
+                self.send_response(status)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                if encoding:
+                    self.send_header("Content-Encoding", encoding)
+                if url.path.endswith("api/me.json") and status == 200:
+                    sid = f"{random.getrandbits(64):016x}"
+                    server.sessions.add(sid)
+                    self.send_header("Set-Cookie", f"JSESSIONID={sid}; Path=/; HttpOnly")
+                self.end_headers()
+                self.wfile.write(body)
+                server.stats.add(len(body), rows, status >= 400)
+
+        return Handler
+
+
+CSV_HEADER_NAMES = {"dx": "Data", "pe": "Period", "ou": "Organisation unit", "value": "Value"}
+
+
+def csv_body(obj: dict) -> bytes:
+    """Réponse analytics en CSV, comme api/analytics.csv (1 ligne d'en-tête avec les noms affichés)."""
+    buf = io.StringIO()
+    w = csv.writer(buf, lineterminator="\n")
+    w.writerow([CSV_HEADER_NAMES.get(h["name"], h["name"]) for h in obj.get("headers", [])])
+    w.writerows(obj.get("rows", []))
+    return buf.getvalue().encode("utf-8")
+
+
+def serve_process(cfg: FakeConfig, ready: "multiprocessing.Queue") -> None:
+    """Cible de multiprocessing.Process: le serveur ne partage pas le GIL du code mesuré."""
+    srv = FakeDhis2Server(cfg)
+    ready.put(srv.url)
+    srv.httpd.serve_forever()
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Offline stand-in for the DHIS2 API (benchmarks, local runs)")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8080)
+    ap.add_argument("--ous", type=int, default=25_000, help="LEVEL-5 org units")
+    ap.add_argument("--density", type=float, default=0.14, help="Share of non-null (ou, dx) cells")
+    ap.add_argument("--latency_s", type=float, default=0.0, help="Added latency per request")
+    ap.add_argument("--latency_per_krow_s", type=float, default=0.0, help="Added latency per 1000 analytics rows")
+    ap.add_argument("--error_rate", type=float, default=0.0, help="Share of requests failing with 429/500/503")
+    ap.add_argument("--max_rows", type=int, default=0, help="Fail analytics responses above this many rows (0 = off)")
+    ap.add_argument("--gzip_level", type=int, default=6, help="Gzip level when the client accepts it (0 = off)")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    cfg = FakeConfig(
+        n_ou=args.ous,
+        density=args.density,
+        latency_s=args.latency_s,
+        latency_per_krow_s=args.latency_per_krow_s,
+        error_rate=args.error_rate,
+        max_rows=args.max_rows,
+        gzip_level=args.gzip_level,
+        seed=args.seed,
+    )
+    srv = FakeDhis2Server(cfg, host=args.host, port=args.port)
+    print(f"Fake DHIS2 on {srv.url} ({cfg.n_ou} LEVEL-5 OUs); DHIS2_BASE_URL={srv.url}", flush=True)
+    try:
+        srv.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
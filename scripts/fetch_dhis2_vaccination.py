@@ -2,18 +2,35 @@ from __future__ import annotations
 
 import argparse
 import gzip
+import hashlib
 import json
 import os
+import shutil
+import struct
 import sys
+import threading
 import time
-from dataclasses import dataclass
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from datetime import date, datetime
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+
+from changesets import ChangeLog
+from cost_model import CostModel
+from dhis2_client import TRANSPORTS, Dhis2Client, TokenBucket
+from http_cache import ResponseCache
+from journal import FetchJournal, SpillWriter
+from ou_tree import read_ou_map
+from pivot import MonthTable, PivotAccumulator, parse_value
+from rollup import RollupSpec
+from series import SeriesStore
+from sparse_format import SPARSE_FILE, SparseMonthBuilder, iter_sparse_records, read_sparse
+from telemetry import RUN_STATS_FILE, TELEMETRY
 
 # =========================
 # 1) CONFIG: COLLER ICI
@@ -365,65 +382,20 @@ def chunk_list(items: List[str], max_chars: int = 6500) -> List[List[str]]:
     return chunks
 
 
-@dataclass
-class Dhis2Client:
-    base_url: str
-    username: str
-    password: str
-    timeout_s: int = 600  # 10 minutes
-
-    def __post_init__(self) -> None:
-        retry = Retry(
-            total=6,
-            connect=6,
-            read=6,
-            status=6,
-            backoff_factor=5,  # 5s,10s,20s,40s...
-            status_forcelist=[429, 500, 502, 503, 504],
-            allowed_methods=["GET"],
-            raise_on_status=False,
-        )
-        self.session = requests.Session()
-        adapter = HTTPAdapter(max_retries=retry)
-        self.session.mount("https://", adapter)
-        self.session.mount("http://", adapter)
-
-    def _get(self, path: str, params: Dict[str, object]) -> dict:
-        url = self.base_url.rstrip("/") + "/" + path.lstrip("/")
-        r = self.session.get(
-            url,
-            params=params,
-            auth=(self.username, self.password),
-            headers={"Accept": "application/json"},
-            timeout=self.timeout_s,
-        )
-        r.raise_for_status()
-        return r.json()
-
-    def analytics(self, dx_items: List[str], pe: str, ou: str = "LEVEL-5") -> dict:
-        params = {
-            "dimension": [f"dx:{';'.join(dx_items)}", f"pe:{pe}", f"ou:{ou}"],
-            "displayProperty": "NAME",
-            "outputIdScheme": "UID",
-            "skipMeta": "true",
-            "paging": "false",
-        }
-        return self._get("api/analytics.json", params)
-
-
 def rows_to_records(analytics_json: dict) -> List[dict]:
     rows = analytics_json.get("rows") or []
     recs: List[dict] = []
-    for r in rows:
-        try:
-            dx, pe, ou, val = r[0], r[1], r[2], r[3]
-        except Exception:
-            continue
-        try:
-            v = float(val)
-        except Exception:
-            v = None
-        recs.append({"dx": dx, "pe": pe, "ou": ou, "value": v})
+    with TELEMETRY.stage("rows_to_records"):
+        for r in rows:
+            try:
+                dx, pe, ou, val = r[0], r[1], r[2], r[3]
+            except Exception:
+                continue
+            try:
+                v = float(val)
+            except Exception:
+                v = None
+            recs.append({"dx": dx, "pe": pe, "ou": ou, "value": v})
     return recs
 
 
@@ -432,39 +404,371 @@ def pivot_records(long_recs: List[dict], dx_expected: List[str], rename_map: Dic
     Pivot simple: 1 ligne par (ou,pe)
     Colonnes = dx (renommées via rename_map)
     """
-    idx: Dict[Tuple[str, str], dict] = {}
-    for r in long_recs:
-        key = (r["ou"], r["pe"])
-        row = idx.get(key)
-        if row is None:
-            row = {"ou": r["ou"], "pe": r["pe"]}
-            idx[key] = row
-
-        old = row.get(r["dx"])
-        val = r["value"]
-        if old is None:
-            row[r["dx"]] = val
-        else:
-            row[r["dx"]] = (old or 0) + (val or 0)
-
-    # assurer toutes les colonnes
-    for row in idx.values():
-        for dx in dx_expected:
-            row.setdefault(dx, None)
-
-    out: List[dict] = []
-    for row in idx.values():
-        out_row: dict = {
-            "OrgUnit": row.get("ou"),
-            "Period": f"{row['pe'][:4]}-{row['pe'][4:6]}-01",
-        }
-        for dx in dx_expected:
-            col = rename_map.get(dx, dx)
-            out_row[col] = row.get(dx)
-        out.append(out_row)
+    with TELEMETRY.stage("pivot_records"):
+        acc = PivotAccumulator(dx_expected, rename_map)
+        for r in long_recs:
+            acc.add(r["dx"], r["pe"], r["ou"], r["value"])
+        return list(acc.iter_records())
 
-    out.sort(key=lambda x: (x.get("OrgUnit") or "", x.get("Period") or ""))
-    return out
+
+def fetch_chunk_into(
+    client: Dhis2Client,
+    acc: PivotAccumulator,
+    dx_items: List[str],
+    pe: str,
+    ou: str = "LEVEL-5",
+    batch_rows: int = 5000,
+    spill: Optional[SpillWriter] = None,
+) -> int:
+    """
+    Streame une requête analytics dans l'accumulateur, par lots (le verrou n'est pas tenu pendant le réseau).
+    Si `spill` est donné, les lignes brutes y sont aussi écrites (reprise après crash).
+    Télémétrie: temps et CPU du thread, dont pivot et journal (le reste est le parsing du flux JSON ou CSV).
+    """
+    n = 0
+    batch: List[list] = []
+    w0, c0 = time.perf_counter(), time.thread_time()
+    pivot_cpu = spill_cpu = 0.0
+
+    def flush() -> int:
+        nonlocal pivot_cpu, spill_cpu
+        p0 = time.thread_time()
+        added = acc.add_rows(batch)
+        p1 = time.thread_time()
+        pivot_cpu += p1 - p0
+        if spill is not None:
+            spill.write(batch)
+            spill_cpu += time.thread_time() - p1
+        return added
+
+    try:
+        for row in client.analytics_rows(dx_items=dx_items, pe=pe, ou=ou):
+            batch.append(row)
+            if len(batch) >= batch_rows:
+                n += flush()
+                batch = []
+        if batch:
+            n += flush()
+    except BaseException:
+        if spill is not None:
+            spill.abort()
+        raise
+    wall, cpu = time.perf_counter() - w0, time.thread_time() - c0
+    TELEMETRY.chunk(f"{pe} ou={ou}", len(dx_items), n, wall, cpu, pivot_cpu, spill_cpu)
+    return n
+
+
+def plan_key(dx_expected: List[str]) -> str:
+    return hashlib.sha256(json.dumps(dx_expected).encode("utf-8")).hexdigest()[:16]
+
+
+def unit_key(dx_items: List[str]) -> str:
+    return hashlib.sha256(";".join(dx_items).encode("utf-8")).hexdigest()[:12]
+
+
+def is_server_failure(e: Exception) -> bool:
+    """Echec attribuable à une requête trop lourde (timeout, coupure, 5xx), pas à une erreur client."""
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and e.response.status_code >= 500
+    return isinstance(
+        e,
+        (
+            requests.Timeout,
+            requests.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.RetryError,
+        ),
+    )
+
+
+def plan_chunks(
+    dx_expected: List[str],
+    max_chars: int,
+    cost_model: Optional[CostModel] = None,
+    target_s: float = 300.0,
+) -> List[List[str]]:
+    """
+    Découpage dx: d'abord par longueur d'URL (chunk_list), puis chaque chunk dont le coût
+    appris (1 période, toutes les OU) dépasse target_s est coupé en deux, récursivement.
+    """
+    chunks: List[List[str]] = []
+    todo = chunk_list(dx_expected, max_chars=max_chars)
+    while todo:
+        ch = todo.pop(0)
+        est = cost_model.estimate(ch) if cost_model else None
+        if est is not None and est > target_s and len(ch) > 1:
+            mid = len(ch) // 2
+            todo[:0] = [ch[:mid], ch[mid:]]
+            continue
+        chunks.append(ch)
+    return chunks
+
+
+@dataclass
+class AdaptiveFetcher:
+    """
+    Exécute une requête analytics en la découpant quand elle échoue (timeout, 5xx) ou
+    quand le modèle de coût la prédit trop lente: d'abord les périodes groupées, puis
+    bissection de l'ensemble dx, et pour un dx seul partition de `ou` par province
+    (LEVEL-5;<uid Org2>). Les lignes d'une tentative échouée ne touchent jamais le pivot.
+    """
+
+    client: Dhis2Client
+    cost_model: Optional[CostModel] = None
+    slow_s: float = 300.0
+    provinces: Optional[List[str]] = None
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def province_ids(self) -> List[str]:
+        with self.lock:
+            if self.provinces is None:
+                self.provinces = self.client.org_unit_ids(level=2)
+        return self.provinces
+
+    def ou_fraction(self, ou: str) -> float:
+        return 1.0 if ou == "LEVEL-5" else 1.0 / max(1, len(self.province_ids()))
+
+    @staticmethod
+    def can_split(dx_items: List[str], periods: List[str], ou: str) -> bool:
+        return len(periods) > 1 or len(dx_items) > 1 or ou == "LEVEL-5"
+
+    def fetch(
+        self,
+        acc: PivotAccumulator,
+        dx_items: List[str],
+        periods: List[str],
+        ou: str = "LEVEL-5",
+        new_spill: Optional[Callable[[], SpillWriter]] = None,
+    ) -> int:
+        label = f"{'+'.join(periods)} dx={len(dx_items)} ou={ou}"
+        ou_frac = self.ou_fraction(ou)
+        est = self.cost_model.estimate(dx_items, len(periods), ou_frac) if self.cost_model else None
+        if est is not None and est > self.slow_s and self.can_split(dx_items, periods, ou):
+            print(f"[{label}] predicted {est:.0f}s > {self.slow_s:.0f}s: splitting", flush=True)
+            return self.split(acc, dx_items, periods, ou, new_spill)
+
+        local = acc.empty_like(dx_items)  # tampon de la requête: seulement les colonnes du chunk
+        spill = new_spill() if new_spill else None
+        t0 = time.monotonic()
+        try:
+            n = fetch_chunk_into(self.client, local, dx_items, ";".join(periods), ou, spill=spill)
+        except requests.RequestException as e:
+            if not (is_server_failure(e) and self.can_split(dx_items, periods, ou)):
+                raise
+            elapsed = time.monotonic() - t0
+            if self.cost_model:
+                # au moins "trop lent": la prochaine planification découpera d'emblée
+                self.cost_model.observe(dx_items, len(periods), ou_frac, max(elapsed, 2 * self.slow_s))
+            print(f"[{label}] failed after {elapsed:.0f}s ({e.__class__.__name__}): splitting", flush=True)
+            return self.split(acc, dx_items, periods, ou, new_spill)
+
+        elapsed = time.monotonic() - t0
+        if self.cost_model:
+            self.cost_model.observe(dx_items, len(periods), ou_frac, elapsed)
+        if elapsed > self.slow_s:
+            print(f"[{label}] slow request ({elapsed:.0f}s): later plans will split it", flush=True)
+        if spill is not None:
+            spill.commit()
+        acc.merge(local)
+        return n
+
+    def split(
+        self,
+        acc: PivotAccumulator,
+        dx_items: List[str],
+        periods: List[str],
+        ou: str,
+        new_spill: Optional[Callable[[], SpillWriter]],
+    ) -> int:
+        if len(periods) > 1:
+            mid = len(periods) // 2
+            return self.fetch(acc, dx_items, periods[:mid], ou, new_spill) + self.fetch(
+                acc, dx_items, periods[mid:], ou, new_spill
+            )
+        if len(dx_items) > 1:
+            mid = len(dx_items) // 2
+            return self.fetch(acc, dx_items[:mid], periods, ou, new_spill) + self.fetch(
+                acc, dx_items[mid:], periods, ou, new_spill
+            )
+        return sum(self.fetch(acc, dx_items, periods, f"LEVEL-5;{uid}", new_spill) for uid in self.province_ids())
+
+
+@dataclass
+class MonthResult:
+    pe: str
+    table: MonthTable  # mois pivoté (matrice OU x colonnes)
+    cells: int  # nb de valeurs brutes reçues de DHIS2
+
+
+def period_density(month: Optional[dict], n_dx: int) -> Optional[float]:
+    """Part des cellules (OU x dx) non vides observée lors de la dernière publication du mois."""
+    if not month or not month.get("cells") or not month.get("rows"):
+        return None
+    return month["cells"] / (month["rows"] * max(1, n_dx))
+
+
+def plan_period_groups(
+    periods: List[str],
+    chunks: List[List[str]],
+    months_index: Dict[str, dict],
+    ou_count: int,
+    rows_budget: int,
+    max_periods: int = 12,
+    default_density: float = 0.3,
+) -> List[List[str]]:
+    """
+    Regroupe des périodes consécutives dans une même requête (pe:202501;202502;...) tant que
+    le nombre de lignes attendu pour le plus gros chunk dx reste sous rows_budget:
+    len(chunk) x ~ou_count OU x densité (apprise mois par mois dans l'index) x nb de périodes.
+    """
+    n_dx = sum(len(ch) for ch in chunks)
+    known = [d for d in (period_density(months_index.get(pe), n_dx) for pe in months_index) if d]
+    fallback = sum(known) / len(known) if known else default_density
+    heaviest = max((len(ch) for ch in chunks), default=1)
+
+    groups: List[List[str]] = []
+    cur: List[str] = []
+    cur_rows = 0.0
+    for pe in periods:
+        density = period_density(months_index.get(pe), n_dx) or fallback
+        est = heaviest * ou_count * density
+        if cur and (cur_rows + est > rows_budget or len(cur) >= max_periods):
+            groups.append(cur)
+            cur, cur_rows = [], 0.0
+        cur.append(pe)
+        cur_rows += est
+    if cur:
+        groups.append(cur)
+    return groups
+
+
+def fetch_periods(
+    client: Dhis2Client,
+    periods: List[str],
+    dx_expected: List[str],
+    rename_map: Dict[str, str],
+    dx_chunk_chars: int,
+    concurrency: int = 4,
+    journal: Optional[FetchJournal] = None,
+    groups: Optional[List[List[str]]] = None,
+    fetcher: Optional[AdaptiveFetcher] = None,
+    chunks: Optional[List[List[str]]] = None,
+) -> Iterator[MonthResult]:
+    """
+    Télécharge toutes les paires (groupe de périodes, chunk dx) avec un pool de workers borné.
+    Les lignes sont streamées directement dans un accumulateur de pivot par groupe;
+    dès que tous les chunks d'un groupe sont arrivés, chaque période du groupe est renvoyée
+    (yield) séparément sous forme de matrice pivotée, pendant que les workers continuent.
+    Avec un journal, chaque unité terminée est consignée et ses lignes brutes gardées
+    sur disque; les unités déjà consignées sont rejouées depuis le disque.
+    """
+    chunks = chunks or chunk_list(dx_expected, max_chars=dx_chunk_chars)
+    groups = groups or [[pe] for pe in periods]
+    fetcher = fetcher or AdaptiveFetcher(client)
+    labels = ["+".join(g) for g in groups]
+    remaining: Dict[str, int] = {label: len(chunks) for label in labels}
+    acc_by_group: Dict[str, PivotAccumulator] = {
+        label: PivotAccumulator(dx_expected, rename_map) for label in labels
+    }
+
+    def run_unit(label: str, group: List[str], ch: List[str]) -> Tuple[int, bool]:
+        acc = acc_by_group[label]
+        if journal is None:
+            return fetcher.fetch(acc, ch, group), False
+        unit = unit_key(ch)
+        if journal.is_done(label, unit):
+            return acc.add_rows(journal.replay(label, unit)), True
+        journal.start_unit(label, unit)
+        n = fetcher.fetch(acc, ch, group, new_spill=lambda: journal.spill_writer(label, unit))
+        journal.mark_done(label, unit, n)
+        return n, False
+
+    pool = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    try:
+        # soumis dans l'ordre => le pool (FIFO) termine les périodes à peu près dans l'ordre
+        futures = {}
+        for label, group in zip(labels, groups):
+            for i, ch in enumerate(chunks, start=1):
+                fut = pool.submit(TELEMETRY.profiled, group, run_unit, label, group, ch)
+                futures[fut] = (label, group, i, len(ch))
+
+        for fut in as_completed(futures):
+            label, group, i, n_dx = futures[fut]
+            n_rows, replayed = fut.result()
+            remaining[label] -= 1
+            how = "replayed" if replayed else "done"
+            print(f"[{label}] chunk {i}/{len(chunks)} dx_items={n_dx} rows={n_rows} {how}", flush=True)
+            if remaining[label] == 0:
+                acc = acc_by_group.pop(label)
+                for pe in group:
+                    yield MonthResult(pe, acc.pop_table(pe), acc.cells.get(pe, 0))
+    finally:
+        # en cas d'erreur: ne pas laisser tourner les requêtes restantes
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def probe_fingerprint(
+    client: Dhis2Client,
+    pe: str,
+    dx_expected: List[str],
+    dx_chunk_chars: int,
+    analytics_ts: Optional[str],
+) -> dict:
+    """
+    Empreinte d'un mois: nb de lignes et checksum des totaux par dx (requêtes légères,
+    ~1 ligne par dx) + date de la dernière génération des tables analytics.
+    """
+    totals: List[str] = []
+    for ch in chunk_list(dx_expected, max_chars=dx_chunk_chars):
+        for r in client.analytics_totals(dx_items=ch, pe=pe).get("rows") or []:
+            v = parse_value(r[-1])
+            totals.append(f"{r[0]}={v!r}" if v is not None else f"{r[0]}=")  # valeur exacte (repr)
+    totals.sort()
+    return {
+        "analytics_ts": analytics_ts,
+        "probe_rows": len(totals),
+        "checksum": hashlib.sha256("\n".join(totals).encode("utf-8")).hexdigest(),
+    }
+
+
+def plan_incremental(
+    client: Dhis2Client,
+    periods: List[str],
+    months_index: Dict[str, dict],
+    dx_expected: List[str],
+    dx_chunk_chars: int,
+    concurrency: int = 4,
+) -> Tuple[List[str], Dict[str, dict]]:
+    """
+    Choisit les mois à retélécharger. Un mois est sauté si les tables analytics n'ont pas
+    été régénérées depuis sa dernière empreinte, ou si la sonde redonne la même empreinte.
+    Renvoie (mois à retélécharger, nouvelles empreintes par mois).
+    """
+    analytics_ts = client.system_info().get("lastAnalyticsTableGeneration")
+    to_probe: List[str] = []
+    fingerprints: Dict[str, dict] = {}
+    for pe in periods:
+        old = (months_index.get(pe) or {}).get("fingerprint")
+        if old and analytics_ts and old.get("analytics_ts") == analytics_ts:
+            print(f"[{pe}] analytics not regenerated since {analytics_ts}: skip", flush=True)
+            continue
+        to_probe.append(pe)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        probed = pool.map(lambda pe: probe_fingerprint(client, pe, dx_expected, dx_chunk_chars, analytics_ts), to_probe)
+        for pe, fp in zip(to_probe, probed):
+            fingerprints[pe] = fp
+
+    to_fetch: List[str] = []
+    for pe in to_probe:
+        fp = fingerprints[pe]
+        old = (months_index.get(pe) or {}).get("fingerprint") or {}
+        if pe in months_index and (old.get("probe_rows"), old.get("checksum")) == (fp["probe_rows"], fp["checksum"]):
+            print(f"[{pe}] fingerprint unchanged: skip", flush=True)
+            months_index[pe]["fingerprint"] = fp
+            continue
+        to_fetch.append(pe)
+    return to_fetch, fingerprints
 
 
 def fetch_period(
@@ -473,80 +777,907 @@ def fetch_period(
     dx_expected: List[str],
     rename_map: Dict[str, str],
     dx_chunk_chars: int,
-    sleep_s: float,
+    concurrency: int = 4,
 ) -> List[dict]:
-    chunks = chunk_list(dx_expected, max_chars=dx_chunk_chars)
-    long_all: List[dict] = []
-    for i, ch in enumerate(chunks, start=1):
-        print(f"[{pe}] chunk {i}/{len(chunks)} dx_items={len(ch)}", flush=True)
-        data = client.analytics(dx_items=ch, pe=pe, ou="LEVEL-5")
-        long_all.extend(rows_to_records(data))
-        if sleep_s:
-            time.sleep(sleep_s)
-    return pivot_records(long_all, dx_expected, rename_map)
+    for month in fetch_periods(client, [pe], dx_expected, rename_map, dx_chunk_chars, concurrency):
+        return list(month.table.iter_records())
+    return []
+
+
+# Gzip parallèle (façon pigz): chaque bloc est compressé indépendamment (raw deflate
+# amorcé avec les 32 Ko précédents, terminé par un Z_SYNC_FLUSH aligné sur l'octet),
+# puis les blocs sont concaténés dans l'ordre en UN SEUL membre gzip par part.
+# La taille compressée est connue par les octets produits: plus de flush/stat par ligne.
+
+GZIP_EMPTY_FINAL_BLOCK = b"\x03\x00"  # bloc deflate final vide (BFINAL=1, huffman fixe)
+DEFLATE_WINDOW = 32 * 1024
+
+
+def gzip_header(mtime: int) -> bytes:
+    # ID1 ID2 CM=deflate FLG=0 MTIME XFL=0 OS=3 (unix)
+    return b"\x1f\x8b\x08\x00" + struct.pack("<I", mtime & 0xFFFFFFFF) + b"\x00\x03"
 
 
-def write_ndjson_gz_parts(folder: Path, records: List[dict], max_part_mb: int = 80) -> List[dict]:
+def gzip_trailer(crc: int, size: int) -> bytes:
+    return GZIP_EMPTY_FINAL_BLOCK + struct.pack("<II", crc & 0xFFFFFFFF, size & 0xFFFFFFFF)
+
+
+def deflate_bound(n: int) -> int:
+    """Majorant de la taille compressée d'un bloc (compressBound de zlib + marqueur de sync)."""
+    return n + (n >> 12) + (n >> 14) + (n >> 25) + 13 + 5
+
+
+def deflate_block(data: bytes, level: int, zdict: Optional[bytes] = None) -> bytes:
+    kw = {"zdict": zdict} if zdict else {}
+    c = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, **kw)
+    return c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)
+
+
+def iter_line_blocks(lines: Iterable[bytes], block_bytes: int) -> Iterator[Tuple[bytes, int]]:
+    """Regroupe des lignes en blocs d'environ block_bytes (coupés sur les fins de ligne)."""
+    buf = bytearray()
+    n = 0
+    for line in lines:
+        buf += line
+        n += 1
+        if len(buf) >= block_bytes:
+            yield bytes(buf), n
+            buf = bytearray()
+            n = 0
+    if n:
+        yield bytes(buf), n
+
+
+def write_ndjson_lines_gz_parts(
+    folder: Path,
+    lines: Iterable[bytes],
+    max_part_mb: int = 80,
+    level: int = 9,
+    workers: int = 0,
+    block_kb: int = 1024,
+    mtime: Optional[int] = None,
+) -> List[dict]:
     """
-    Ecrit records en NDJSON compressé, découpé en parts.
-    On découpe sur la taille COMPRESSÉE (bytes) pour rester < 100MB GitHub.
+    Ecrit des lignes NDJSON (déjà encodées) en parts gzip, compressées sur plusieurs coeurs.
+    Le plafond max_part_mb est garanti: on ouvre une nouvelle part dès que
+    (octets déjà écrits + majorant des blocs en cours + bloc suivant) risquerait de le dépasser.
+    mtime=0 => en-têtes gzip fixes: même contenu => mêmes octets.
+    Chaque part porte le sha256 de son contenu NON compressé.
     """
     folder.mkdir(parents=True, exist_ok=True)
     max_bytes = max_part_mb * 1024 * 1024
+    # un bloc doit toujours tenir largement dans une part
+    block_bytes = max(4096, min(block_kb * 1024, max_bytes // 8))
+    workers = workers or os.cpu_count() or 1
 
     parts_meta: List[dict] = []
-    part_idx = 1
+    pool = ThreadPoolExecutor(max_workers=workers)
+    pending: "deque[Tuple[Future, int]]" = deque()  # (bloc compressé, majorant)
+
+    f = None
+    path: Optional[Path] = None
+    part_bytes = 0
+    pending_bound = 0
     rows_in_part = 0
+    crc = 0
+    size = 0
+    sha = hashlib.sha256()
+    prev_tail: Optional[bytes] = None
+
+    def open_part() -> None:
+        nonlocal f, path, part_bytes, rows_in_part, crc, size, sha, prev_tail
+        path = folder / f"part-{len(parts_meta) + 1:04d}.ndjson.gz"
+        f = open(path, "wb")
+        header = gzip_header(int(time.time()) if mtime is None else mtime)
+        f.write(header)
+        part_bytes = len(header)
+        rows_in_part = 0
+        crc = 0
+        size = 0
+        sha = hashlib.sha256()
+        prev_tail = None  # pas de dictionnaire à travers une frontière de part
+
+    def drain(keep: int) -> None:
+        nonlocal part_bytes, pending_bound
+        while len(pending) > keep:
+            fut, bound = pending.popleft()
+            data = fut.result()
+            f.write(data)
+            part_bytes += len(data)
+            pending_bound -= bound
+
+    def close_part() -> None:
+        nonlocal part_bytes
+        drain(0)
+        trailer = gzip_trailer(crc, size)
+        f.write(trailer)
+        part_bytes += len(trailer)
+        f.close()
+        parts_meta.append(
+            {"file": path.name, "rows": rows_in_part, "bytes": part_bytes, "sha256": sha.hexdigest()}
+        )
+
+    try:
+        open_part()
+        for block, n_rows in iter_line_blocks(lines, block_bytes):
+            bound = deflate_bound(len(block))
+            if rows_in_part and part_bytes + pending_bound + bound + 10 > max_bytes:
+                drain(0)
+                if part_bytes + bound + 10 > max_bytes:
+                    close_part()
+                    open_part()
+            pending.append((pool.submit(deflate_block, block, level, prev_tail), bound))
+            pending_bound += bound
+            prev_tail = block[-DEFLATE_WINDOW:]
+            crc = zlib.crc32(block, crc)
+            sha.update(block)
+            size += len(block)
+            rows_in_part += n_rows
+            drain(2 * workers)
+        # records vide => 1 part gzip vide (valide)
+        close_part()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        if f is not None and not f.closed:
+            f.close()
+
+    return parts_meta
 
-    def new_path(i: int) -> Path:
-        return folder / f"part-{i:04d}.ndjson.gz"
 
-    # ouvre en binaire pour pouvoir mesurer la taille compressée
-    path = new_path(part_idx)
-    gz = gzip.open(path, "wb")
+# Variante "bgzf" (même principe que BGZF de htslib): chaque bloc de lignes entières
+# (<= ~64 Ko non compressés) est un membre gzip indépendant, avec son champ extra "BC"
+# (taille du bloc). Un bloc se décompresse seul: une requête HTTP Range suffit pour lire
+# une OU, via l'index ou_index.json.gz (OU -> bloc -> part, offset, longueur).
+
+BGZF_MAX_BLOCK = 0xFF00
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+OU_INDEX_FILE = "ou_index.json.gz"
+
+
+def bgzf_member(data: bytes, level: int) -> bytes:
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    body = c.compress(data) + c.flush()
+    bsize = 18 + len(body) + 8 - 1
+    # ID1 ID2 CM FLG=FEXTRA MTIME=0 XFL=0 OS=255 XLEN=6 | SI1=B SI2=C SLEN=2 BSIZE
+    header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" + struct.pack("<H", bsize)
+    return header + body + struct.pack("<II", zlib.crc32(data) & 0xFFFFFFFF, len(data))
+
+
+def iter_keyed_line_blocks(
+    keyed_lines: Iterable[Tuple[str, bytes]], block_bytes: int
+) -> Iterator[Tuple[bytes, List[Tuple[str, int]]]]:
+    """
+    Blocs de lignes entières d'au plus block_bytes, avec les (clé, nb de blocs) des lignes
+    qui y commencent. Une ligne plus longue qu'un bloc est répartie sur des blocs consécutifs.
+    """
+    buf = bytearray()
+    starts: List[Tuple[str, int]] = []
+    for key, line in keyed_lines:
+        if buf and len(buf) + len(line) > block_bytes:
+            yield bytes(buf), starts
+            buf = bytearray()
+            starts = []
+        if len(line) <= block_bytes:
+            buf += line
+            starts.append((key, 1))
+            continue
+        pieces = [line[i : i + block_bytes] for i in range(0, len(line), block_bytes)]
+        for j, piece in enumerate(pieces[:-1]):
+            yield piece, [(key, len(pieces))] if j == 0 else []
+        buf = bytearray(pieces[-1])
+    if buf:
+        yield bytes(buf), starts
+
+
+def write_ndjson_bgzf_parts(
+    folder: Path,
+    keyed_lines: Iterable[Tuple[str, bytes]],
+    max_part_mb: int = 80,
+    level: int = 9,
+    workers: int = 0,
+) -> Tuple[List[dict], dict]:
+    """
+    Comme write_ndjson_lines_gz_parts, en blocs gzip indépendants (compressés sur plusieurs coeurs).
+    Renvoie (parts, index) avec index = {"parts", "blocks": [[part, offset, longueur]],
+    "ous": [...], "block": [1er bloc de chaque OU], "spans": {i: nb de blocs si > 1}}.
+    Sortie toujours reproductible (MTIME=0 dans chaque membre).
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    max_bytes = max_part_mb * 1024 * 1024
+    workers = workers or os.cpu_count() or 1
+
+    parts_meta: List[dict] = []
+    index: dict = {"format": "bgzf-ou-index-v1", "parts": [], "blocks": [], "ous": [], "block": [], "spans": {}}
+    pool = ThreadPoolExecutor(max_workers=workers)
+    pending: "deque[Tuple[Future, int, List[Tuple[str, int]]]]" = deque()
+
+    f = None
+    path: Optional[Path] = None
+    part_bytes = 0
+    pending_bound = 0
+    rows_in_part = 0
+    sha = hashlib.sha256()
+
+    def open_part() -> None:
+        nonlocal f, path, part_bytes, rows_in_part, sha
+        path = folder / f"part-{len(parts_meta) + 1:04d}.ndjson.gz"
+        f = open(path, "wb")
+        index["parts"].append(path.name)
+        part_bytes = 0
+        rows_in_part = 0
+        sha = hashlib.sha256()
+
+    def drain(keep: int) -> None:
+        nonlocal part_bytes, pending_bound
+        while len(pending) > keep:
+            fut, bound, starts = pending.popleft()
+            data = fut.result()
+            f.write(data)
+            b = len(index["blocks"])
+            index["blocks"].append([len(parts_meta), part_bytes, len(data)])
+            for key, span in starts:
+                if span > 1:
+                    index["spans"][str(len(index["ous"]))] = span
+                index["ous"].append(key)
+                index["block"].append(b)
+            part_bytes += len(data)
+            pending_bound -= bound
 
     def close_part() -> None:
-        nonlocal gz, rows_in_part, path
-        gz.close()
-        parts_meta.append({"file": path.name, "rows": rows_in_part, "bytes": path.stat().st_size})
+        nonlocal part_bytes
+        drain(0)
+        f.write(BGZF_EOF)
+        part_bytes += len(BGZF_EOF)
+        f.close()
+        parts_meta.append(
+            {"file": path.name, "rows": rows_in_part, "bytes": part_bytes, "sha256": sha.hexdigest()}
+        )
+
+    try:
+        open_part()
+        mid_line = False
+        for block, starts in iter_keyed_line_blocks(keyed_lines, BGZF_MAX_BLOCK):
+            bound = deflate_bound(len(block)) + 26
+            # jamais de nouvelle part au milieu d'une ligne répartie sur plusieurs blocs
+            if rows_in_part and not mid_line and part_bytes + pending_bound + bound + 28 > max_bytes:
+                drain(0)
+                if part_bytes + bound + 28 > max_bytes:
+                    close_part()
+                    open_part()
+            pending.append((pool.submit(bgzf_member, block, level), bound, starts))
+            pending_bound += bound
+            sha.update(block)
+            rows_in_part += len(starts)
+            mid_line = not block.endswith(b"\n")
+            drain(2 * workers)
+        close_part()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        if f is not None and not f.closed:
+            f.close()
+
+    return parts_meta, index
+
+
+def write_gz_json(path: Path, obj: object, level: int = 9) -> dict:
+    """JSON compact gzip reproductible (MTIME=0); renvoie {file, bytes, sha256}."""
+    raw = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with gzip.GzipFile(path, "wb", compresslevel=level, mtime=0) as f:
+        f.write(raw)
+    return {"file": path.name, "bytes": path.stat().st_size, "sha256": hashlib.sha256(raw).hexdigest()}
+
+
+def write_gz_ndjson(path: Path, records: Iterable[dict], level: int = 9, mtime: Optional[int] = None) -> dict:
+    """Petit fichier NDJSON gzip en un morceau; renvoie {file, rows, bytes, sha256} (sha256 du contenu)."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    sha = hashlib.sha256()
+    rows = 0
+    with gzip.GzipFile(path, "wb", compresslevel=level, mtime=mtime) as f:
+        for rec in records:
+            line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+            f.write(line)
+            sha.update(line)
+            rows += 1
+    return {"file": path.name, "rows": rows, "bytes": path.stat().st_size, "sha256": sha.hexdigest()}
+
+
+def write_ndjson_gz_parts(
+    folder: Path,
+    records: Iterable[dict],
+    max_part_mb: int = 80,
+    level: int = 9,
+    workers: int = 0,
+    mtime: Optional[int] = None,
+) -> List[dict]:
+    """
+    Ecrit records en NDJSON compressé, découpé en parts.
+    On découpe sur la taille COMPRESSÉE (bytes) pour rester < 100MB GitHub.
+    """
+    lines = ((json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8") for rec in records)
+    with TELEMETRY.stage("write_ndjson_gz_parts"):
+        return write_ndjson_lines_gz_parts(
+            folder, lines, max_part_mb=max_part_mb, level=level, workers=workers, mtime=mtime
+        )
+
+
+def replace_dir(src: Path, dst: Path) -> None:
+    """Remplace dst par src (deux renommages, l'ancien contenu est supprimé ensuite)."""
+    old = dst.with_name(f".{dst.name}.old")
+    if old.exists():
+        shutil.rmtree(old)
+    if dst.exists():
+        dst.rename(old)
+    src.rename(dst)
+    if old.exists():
+        shutil.rmtree(old)
+
+
+def entry_files(entry: dict) -> List[Tuple[str, object, object]]:
+    """(chemin relatif au dossier du mois, lignes, sha256) de chaque fichier publié du mois."""
+    files = [(p["file"], p.get("rows"), p.get("sha256")) for p in entry.get("parts") or []]
+    for extra in ("sparse", "ou_index"):
+        if entry.get(extra):
+            e = entry[extra]
+            files.append((e["file"], e.get("rows"), e.get("sha256")))
+    for name, r in sorted((entry.get("rollups") or {}).items()):
+        files.append((r["file"], r.get("rows"), r.get("sha256")))
+    for uid, sl in sorted((entry.get("org2") or {}).items()):
+        files += [(f"org2={uid}/{f}", rows, sha) for f, rows, sha in entry_files(sl)]
+    return files
+
+
+def same_content(old: Optional[dict], entry: dict) -> bool:
+    """Même contenu publié: mêmes formats, mêmes fichiers, mêmes lignes, même sha256 (absent => différent)."""
+    if not old or old.get("formats", ["ndjson"]) != entry["formats"]:
+        return False
+    old_files = entry_files(old)
+    return all(sha for _, _, sha in old_files) and old_files == entry_files(entry)
+
+
+def write_slice(
+    folder: Path,
+    table: MonthTable,
+    formats: Tuple[str, ...],
+    ous: Optional[Iterable[str]] = None,
+    max_part_mb: int = 80,
+    level: int = 9,
+    workers: int = 0,
+    mtime: Optional[int] = None,
+    layout: str = "stream",
+) -> dict:
+    """
+    Ecrit les lignes du mois (toutes, ou seulement celles des OU `ous`) dans chacun des formats
+    demandés ("ndjson": parts larges, "sparse": voir sparse_format.py), en un seul passage sur la matrice.
+    layout="bgzf": parts NDJSON en blocs gzip indépendants + index des OU (lecture par HTTP Range).
+    """
+    with TELEMETRY.stage("write_slice"):
+        return _write_slice(folder, table, formats, ous, max_part_mb, level, workers, mtime, layout)
+
+
+def _write_slice(
+    folder: Path,
+    table: MonthTable,
+    formats: Tuple[str, ...],
+    ous: Optional[Iterable[str]],
+    max_part_mb: int,
+    level: int,
+    workers: int,
+    mtime: Optional[int],
+    layout: str,
+) -> dict:
+    sparse = SparseMonthBuilder(table.columns, period=table.period) if "sparse" in formats else None
+
+    def keyed_lines() -> Iterator[Tuple[str, bytes]]:
+        for ou, values in table.iter_rows(ous):
+            if sparse is not None:
+                sparse.add_values(ou, values)
+            yield ou, table.encode_line(ou, values)
+
+    out: dict = {}
+    if "ndjson" in formats and layout == "bgzf":
+        parts, ou_index = write_ndjson_bgzf_parts(
+            folder, keyed_lines(), max_part_mb=max_part_mb, level=level, workers=workers
+        )
+        out["layout"] = "bgzf"
+        out["ou_index"] = write_gz_json(folder / OU_INDEX_FILE, ou_index, level=level)
+        out["ou_index"]["rows"] = len(ou_index["ous"])
+        out["parts"] = parts
+        out["rows"] = sum(p["rows"] for p in parts)
+    elif "ndjson" in formats:
+        parts = write_ndjson_lines_gz_parts(
+            folder,
+            (line for _, line in keyed_lines()),
+            max_part_mb=max_part_mb,
+            level=level,
+            workers=workers,
+            mtime=mtime,
+        )
+        out["parts"] = parts
+        out["rows"] = sum(p["rows"] for p in parts)
+    elif sparse is not None:
+        for ou, values in table.iter_rows(ous):
+            sparse.add_values(ou, values)
+    if sparse is not None:
+        out["sparse"] = sparse.write(folder / SPARSE_FILE, level=level, mtime=mtime)
+        out.setdefault("rows", out["sparse"]["rows"])
+    if out.get("parts"):
+        add_ou_ranges(out["parts"], sorted(table.ous if ous is None else ous))
+    return out
+
+
+def add_ou_ranges(parts: List[dict], ous_sorted: List[str]) -> None:
+    """ou_min / ou_max de chaque part (lignes triées par OU): permet de sauter les parts à la lecture."""
+    i = 0
+    for p in parts:
+        if p["rows"]:
+            p["ou_min"] = ous_sorted[i]
+            p["ou_max"] = ous_sorted[i + p["rows"] - 1]
+        i += p["rows"]
+
+
+def carry_ou_ranges(old: dict, new: dict) -> None:
+    """Mois inchangé: l'entrée d'index existante récupère les ou_min / ou_max calculés."""
+    for po, pn in zip(old.get("parts") or [], new.get("parts") or []):
+        for k in ("ou_min", "ou_max"):
+            if k in pn:
+                po[k] = pn[k]
+    for uid, sl in (old.get("org2") or {}).items():
+        carry_ou_ranges(sl, (new.get("org2") or {}).get(uid) or {})
 
+
+def publish_month(
+    monthly_root: Path,
+    pe: str,
+    table: MonthTable,
+    previous: Optional[dict],
+    formats: Tuple[str, ...] = ("ndjson",),
+    org2_of: Optional[Dict[str, str]] = None,
+    rollups: Optional[RollupSpec] = None,
+    changes: Optional[ChangeLog] = None,
+    **writer_kw: object,
+) -> Tuple[dict, bool]:
+    """
+    Ecrit le mois dans un dossier temporaire puis ne le publie que si son contenu
+    (sha256 des fichiers) a changé. Renvoie (entrée d'index, modifié?).
+    Avec org2_of (OU -> uid province), chaque province est aussi écrite dans
+    monthly/<pe>/org2=<uid>/ (mêmes formats), listée dans entry["org2"].
+    Avec rollups, les agrégats Org2/Org3/Org4 sont écrits dans rollup-orgN.ndjson.gz (entry["rollups"]).
+    Avec changes, un mois modifié ajoute son changeset (différence avec la version publiée).
+    """
+    month_folder = monthly_root / pe
+    staging = monthly_root / f".{pe}.tmp"
+    if staging.exists():
+        shutil.rmtree(staging)
+
+    entry: dict = {"formats": list(formats)}
+    entry.update(write_slice(staging, table, formats, **writer_kw))
+
+    if org2_of is not None:
+        by_org2: Dict[str, List[str]] = {}
+        for ou in table.ous:
+            by_org2.setdefault(org2_of.get(ou) or ORG2_UNKNOWN, []).append(ou)
+        entry["org2"] = {}
+        for uid, ous in sorted(by_org2.items()):
+            sl = write_slice(staging / f"org2={uid}", table, formats, ous=ous, **writer_kw)
+            sl["bytes"] = sum(p["bytes"] for p in sl.get("parts", [])) + sum(
+                sl.get(extra, {}).get("bytes", 0) for extra in ("sparse", "ou_index")
+            )
+            entry["org2"][uid] = sl
+
+    if rollups is not None:
+        level = int(writer_kw.get("level", 9))
+        mtime = writer_kw.get("mtime")
+        with TELEMETRY.stage("rollups"):
+            entry["rollups"] = {
+                f"org{lvl}": write_gz_ndjson(staging / f"rollup-org{lvl}.ndjson.gz", recs, level=level, mtime=mtime)
+                for lvl, recs in sorted(rollups.records(table).items())
+            }
+
+    if same_content(previous, entry) and all((month_folder / f).exists() for f, _, _ in entry_files(entry)):
+        shutil.rmtree(staging)
+        carry_ou_ranges(previous, entry)
+        return previous, False
+
+    if changes is not None:
+        record_changes(changes, month_folder, pe, previous, entry, table.columns, table.iter_rows())
+    replace_dir(staging, month_folder)
+    return entry, True
+
+
+def published_intact(folder: Path, entry: dict) -> bool:
+    """Les fichiers de l'entrée sont sur disque avec la taille indiquée (parts, sparse, ou_index)."""
+    sized = [(p["file"], p.get("bytes")) for p in entry.get("parts") or []]
+    sized += [(entry[k]["file"], entry[k].get("bytes")) for k in ("sparse", "ou_index") if entry.get(k)]
+    if not all((folder / f).exists() for f, _, _ in entry_files(entry)):
+        return False
+    return all(size is None or (folder / f).stat().st_size == size for f, size in sized)
+
+
+def record_changes(
+    changes: ChangeLog,
+    month_folder: Path,
+    pe: str,
+    previous: Optional[dict],
+    entry: dict,
+    columns: List[str],
+    new_rows: Iterable[Tuple[str, Sequence[Optional[float]]]],
+) -> None:
+    """
+    Changeset du mois avant son remplacement. Version publiée absente, illisible ou qui n'est plus celle
+    de l'index (tailles différentes: crash entre publication et index) => item sans fichier.
+    """
+    target = month_signature(entry)
+    with TELEMETRY.stage("changes"):
+        if previous and published_intact(month_folder, previous):
+            base = previous.get("signature") or month_signature(previous)
+            try:
+                old_rows = iter_published_rows(month_folder, previous, columns)
+                changes.record(pe, base, target, columns, old_rows, new_rows)
+                return
+            except (OSError, ValueError, EOFError) as e:
+                print(f"[{pe}] previous version unreadable ({e}): no changeset", flush=True)
+        changes.record(pe, None, target, columns, None, new_rows)
+
+
+def month_signature(entry: dict) -> str:
+    """Identifie le contenu publié d'un mois (sert à savoir si les séries l'ont déjà intégré)."""
+    raw = json.dumps(entry_files(entry), sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def iter_published_rows(month_folder: Path, entry: dict, columns: List[str]) -> Iterator[Tuple[str, list]]:
+    """(ou, valeurs alignées sur columns) d'un mois déjà publié: fichier creux si présent, sinon parts NDJSON."""
+    if entry.get("sparse"):
+        records: Iterable[dict] = iter_sparse_records(read_sparse(month_folder / entry["sparse"]["file"]))
+    else:
+        records = (
+            json.loads(line)
+            for p in entry.get("parts") or []
+            for line in gzip.open(month_folder / p["file"], "rt", encoding="utf-8")
+        )
     for rec in records:
-        line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
-        gz.write(line)
-        rows_in_part += 1
-
-        # taille compressée actuelle
-        gz.flush()
-        if path.stat().st_size >= max_bytes:
-            close_part()
-            part_idx += 1
-            rows_in_part = 0
-            path = new_path(part_idx)
-            gz = gzip.open(path, "wb")
-
-    close_part()
-
-    # cas records vide => créer 1 part vide
-    if not records and not parts_meta:
-        path = new_path(1)
-        with gzip.open(path, "wb") as f:
-            f.write(b"")
-        parts_meta.append({"file": path.name, "rows": 0, "bytes": path.stat().st_size})
+        yield rec["OrgUnit"], [rec.get(c) for c in columns]
+
+
+def write_json_if_changed(path: Path, obj: object) -> bool:
+    """Sérialisation stable (clés triées); n'écrit (atomiquement) que si les octets changent."""
+    raw = json.dumps(obj, ensure_ascii=False, sort_keys=True)
+    if path.exists() and path.read_text(encoding="utf-8") == raw:
+        return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(raw, encoding="utf-8")
+    os.replace(tmp, path)
+    return True
 
-    return parts_meta
 
+ORG2_UNKNOWN = "unknown"  # OU absentes de ou_map.json.gz
 
-def main() -> int:
-    ap = argparse.ArgumentParser()
+
+def load_org2_partitions(ou_map: Dict[str, dict], client: Dhis2Client) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    (OU niveau 5 -> uid province, uid province -> nom).
+    Un ancien ou_map sans Org2Id est complété par les noms des OU niveau 2.
+    """
+    org2_of: Dict[str, str] = {}
+    names: Dict[str, str] = {}
+    by_name: Optional[Dict[str, str]] = None
+    for ou, e in ou_map.items():
+        uid = e.get("Org2Id")
+        if not uid:
+            if by_name is None:
+                by_name = {u.get("name") or "": u["id"] for u in client.org_units_level(2)}
+            uid = by_name.get(e.get("Org2") or "")
+        if uid:
+            org2_of[ou] = uid
+            names[uid] = e.get("Org2") or ""
+    return org2_of, names
+
+
+def load_index(path: Path) -> dict:
+    """index.json publié (vide s'il est absent ou illisible)."""
+    index = {"generated_at": None, "months": {}}
+    if path.exists():
+        try:
+            index = json.loads(path.read_text(encoding="utf-8"))
+            if "months" not in index:
+                index["months"] = {}
+        except Exception:
+            index = {"generated_at": None, "months": {}}
+    return index
+
+
+# =========================
+# Backfill en shards: chaque runner publie un sous-ensemble des mois dans son propre dossier
+# (--shard i/n --shard_dir ...), puis `merge` les recopie dans docs/data et refait index.json.
+# =========================
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """"i/n" (0 <= i < n) -> (i, n)."""
+    try:
+        i, n = (int(x) for x in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"--shard attendu sous la forme i/n, reçu {spec!r}") from None
+    if not 0 <= i < n:
+        raise ValueError(f"--shard {spec}: il faut 0 <= i < n")
+    return i, n
+
+
+def shard_periods(periods: List[str], shard: int, n_shards: int) -> List[str]:
+    """Mois du shard, 1 sur n en tourniquet: chaque runner a autant d'années anciennes (creuses) que récentes."""
+    return periods[shard::n_shards]
+
+
+def verify_month(folder: Path, entry: dict) -> None:
+    """Fichiers d'un mois présents et conformes à l'index (sha256 du contenu décompressé)."""
+    for f, _, sha in entry_files(entry):
+        path = folder / f
+        if not path.is_file():
+            raise ValueError(f"{path}: missing")
+        if not sha:
+            continue
+        h = hashlib.sha256()
+        with gzip.open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                h.update(block)
+        if h.hexdigest() != sha:
+            raise ValueError(f"{path}: sha256 does not match its index entry")
+
+
+def merge_shards(
+    out_dir: Path,
+    shard_dirs: List[Path],
+    columns: List[str],
+    series: bool = False,
+    series_buckets: int = 256,
+    changes_keep: Optional[int] = None,
+) -> Tuple[dict, List[str]]:
+    """
+    Publie dans out_dir les mois des shards (chacun: index.json + monthly/<pe>/).
+    Un mois déjà publié avec le même contenu n'est pas recopié; l'index est réécrit après chaque mois,
+    puis les séries sont mises à jour depuis les mois publiés. Renvoie (index, mois modifiés).
+    changes_keep=None: pas de changesets.
+    """
+    monthly_root = out_dir / "monthly"
+    index_path = out_dir / "index.json"
+    index = load_index(index_path)
+    changes = None
+    if changes_keep is not None:
+        changes = ChangeLog.from_index(out_dir / "changes", index.get("changes"), keep=changes_keep)
+
+    owner: Dict[str, Path] = {}
+    shards: List[Tuple[Path, dict]] = []
+    for d in shard_dirs:
+        sidx = load_index(d / "index.json")
+        for pe in sidx["months"]:
+            if pe in owner:
+                raise ValueError(f"month {pe} is in two shards: {owner[pe]} and {d}")
+            owner[pe] = d
+        shards.append((d, sidx))
+
+    changed: List[str] = []
+    for d, sidx in shards:
+        if sidx.get("org2"):
+            index["org2"] = {**index.get("org2", {}), **sidx["org2"]}
+        for pe, entry in sorted(sidx["months"].items()):
+            src = d / "monthly" / pe
+            verify_month(src, entry)
+            dst = monthly_root / pe
+            previous = index["months"].get(pe)
+            if same_content(previous, entry) and all((dst / f).exists() for f, _, _ in entry_files(entry)):
+                print(f"[merge] {pe} unchanged ({d})", flush=True)
+            else:
+                staging = monthly_root / f".{pe}.tmp"
+                if staging.exists():
+                    shutil.rmtree(staging)
+                shutil.copytree(src, staging)
+                if changes is not None:
+                    new_rows = iter_published_rows(src, entry, columns)
+                    record_changes(changes, dst, pe, previous, entry, columns, new_rows)
+                    index["changes"] = changes.meta()
+                replace_dir(staging, dst)
+                changed.append(pe)
+                index["generated_at"] = datetime.utcnow().isoformat(timespec="seconds") + "Z"
+                print(f"[merge] {pe} written ({d}) rows={entry['rows']}", flush=True)
+            entry["signature"] = month_signature(entry)
+            index["months"][pe] = entry
+            write_json_if_changed(index_path, index)
+
+    if series:
+        store = SeriesStore.from_index(out_dir / "series", columns, index.get("series"), buckets=series_buckets)
+        with TELEMETRY.stage("series"):
+            for pe, entry in sorted(index["months"].items()):
+                sig = month_signature(entry)
+                if store.needs(pe, sig):
+                    store.update_month(pe, sig, iter_published_rows(monthly_root / pe, entry, columns))
+            rewritten = store.flush()
+        index["series"] = store.meta()
+        print(f"[series] {len(rewritten)} buckets rewritten", flush=True)
+
+    if not index.get("generated_at"):
+        index["generated_at"] = datetime.utcnow().isoformat(timespec="seconds") + "Z"
+    write_json_if_changed(index_path, index)
+    return index, changed
+
+
+def merge_main(argv: List[str]) -> int:
+    ap = argparse.ArgumentParser(
+        prog="fetch_dhis2_vaccination.py merge",
+        description="Publish the months of sharded backfill runs (--shard i/n) and rebuild index.json",
+    )
+    ap.add_argument("--shards", nargs="+", required=True, help="Shard folders (the --shard_dir of each run)")
+    ap.add_argument("--out", default="docs/data", help="Published folder to merge into")
+    ap.add_argument(
+        "--series",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Update the per-OU time series from the merged months",
+    )
+    ap.add_argument("--series_buckets", type=int, default=256)
+    ap.add_argument(
+        "--changes",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Write a changeset in changes/ for every month whose published content changes",
+    )
+    ap.add_argument("--changes_keep", type=int, default=180)
+    args = ap.parse_args(argv)
+
+    shard_dirs = [Path(d) for d in args.shards if (Path(d) / "index.json").exists()]
+    missing = sorted(set(args.shards) - {str(d) for d in shard_dirs})
+    if missing:
+        print(f"[merge] no index.json (shard failed before its first month?): {missing}", flush=True)
+    dx_expected = [x.strip() for x in DX_LIST.split(";") if x.strip()]
+    columns = [RENAME_MAP.get(dx, dx) for dx in dx_expected]
+    try:
+        index, changed = merge_shards(
+            Path(args.out),
+            shard_dirs,
+            columns,
+            series=args.series,
+            series_buckets=args.series_buckets,
+            changes_keep=args.changes_keep if args.changes else None,
+        )
+    except ValueError as e:
+        print(f"merge failed: {e}", file=sys.stderr)
+        return 2
+    print(f"OK: merged {len(shard_dirs)} shards; changed={changed}; index months={len(index['months'])}")
+    return 0
+
+
+def read_ou_count(out_dir: Path, default: int = 25_000) -> int:
+    """Nombre d'OU niveau 5 (ou_map.meta.json de build_ou_map.py), pour estimer la taille des réponses."""
+    try:
+        meta = json.loads((out_dir / "ou_map.meta.json").read_text(encoding="utf-8"))
+        return int(meta.get("count_ou_level5") or default)
+    except (OSError, ValueError):
+        return default
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["merge"]:
+        return merge_main(argv[1:])
+    ap = argparse.ArgumentParser(epilog="Subcommand: merge --shards DIR... (see merge --help)")
     ap.add_argument("--start", default="202501", help="YYYYMM")
     ap.add_argument("--end", default=None, help="YYYYMM (optional)")
     ap.add_argument("--months", type=int, default=3, help="Refresh last N months (scheduled runs)")
     ap.add_argument("--backfill", action="store_true", help="Fetch ALL months from --start to --end/current")
     ap.add_argument("--out", default="docs/data", help="Output folder (docs/ for GitHub Pages)")
     ap.add_argument("--dx_chunk_chars", type=int, default=6500)
-    ap.add_argument("--sleep", type=float, default=0.2)
+    ap.add_argument("--concurrency", type=int, default=4, help="Parallel analytics requests")
+    ap.add_argument("--rate", type=float, default=5.0, help="Max analytics requests per second (adaptive)")
+    ap.add_argument("--sleep", type=float, default=None, help=argparse.SUPPRESS)  # obsolète: remplacé par --rate
     ap.add_argument("--max_part_mb", type=int, default=80)
-    args = ap.parse_args()
+    ap.add_argument("--gzip_level", type=int, default=9, help="Gzip compression level (1-9)")
+    ap.add_argument("--gzip_workers", type=int, default=0, help="Compression threads (0 = all cores)")
+    ap.add_argument(
+        "--formats",
+        default="ndjson",
+        help="Comma-separated month formats: ndjson (wide parts) and/or sparse (typed columns + null bitmap)",
+    )
+    ap.add_argument(
+        "--gzip_layout",
+        choices=["stream", "bgzf"],
+        default="stream",
+        help="NDJSON parts as one gzip stream, or as independent gzip blocks + ou_index.json.gz (HTTP range reads)",
+    )
+    ap.add_argument(
+        "--rollups",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Write per-month Org2/Org3/Org4 aggregates (rollup-orgN.ndjson.gz, uses ou_map.json.gz)",
+    )
+    ap.add_argument(
+        "--series",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Maintain per-OU time series (series/b-XXX.json.gz), rewriting only changed buckets",
+    )
+    ap.add_argument("--series_buckets", type=int, default=256, help="Number of OU buckets for --series")
+    ap.add_argument(
+        "--changes",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Write a changeset (changed cells, added/removed OUs) in changes/ for every republished month",
+    )
+    ap.add_argument("--changes_keep", type=int, default=180, help="Changesets kept in index.json and changes/")
+    ap.add_argument("--series_rebuild", action="store_true", help="Rebuild the series from all published months")
+    ap.add_argument(
+        "--partition_org2",
+        action="store_true",
+        help="Also write one slice per province in monthly/<pe>/org2=<uid>/ (uses ou_map.json.gz)",
+    )
+    ap.add_argument(
+        "--reproducible",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Byte-stable output (fixed gzip header); unchanged months are not rewritten",
+    )
+    ap.add_argument("--cache_dir", default=None, help="On-disk HTTP response cache (disabled if unset)")
+    ap.add_argument("--cache_max_mb", type=int, default=1024)
+    ap.add_argument("--cache_ttl_h", type=float, default=None, help="TTL for cached analytics responses (hours)")
+    ap.add_argument(
+        "--rows_budget",
+        type=int,
+        default=2_000_000,
+        help="Max expected rows per analytics request when batching several periods",
+    )
+    ap.add_argument("--max_periods_per_request", type=int, default=12)
+    ap.add_argument("--timeout_s", type=int, default=600, help="HTTP timeout per analytics request")
+    ap.add_argument(
+        "--transport",
+        choices=list(TRANSPORTS),
+        default="json",
+        help="Analytics wire format: analytics.json, or analytics.csv with gzip negotiated (smaller, cheaper to parse)",
+    )
+    ap.add_argument(
+        "--slow_request_s",
+        type=float,
+        default=300.0,
+        help="Requests predicted (or observed) slower than this are split (periods, dx set, then province)",
+    )
+    ap.add_argument("--state_dir", default=".fetch_state", help="Checkpoint journal, spilled chunks, cost model")
+    ap.add_argument("--resume", action="store_true", help="Resume an interrupted run from its journal")
+    ap.add_argument(
+        "--shard",
+        default=None,
+        help="i/n: fetch only every n-th month (starting at i) into --shard_dir; publish later with `merge`",
+    )
+    ap.add_argument("--shard_dir", default=None, help="Staging folder of this shard (default .shards/shard-<i>)")
+    ap.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Probe each month first; full fetch only for months whose fingerprint changed",
+    )
+    ap.add_argument(
+        "--run_stats",
+        choices=["auto", "always", "off"],
+        default="auto",
+        help="Telemetry in <state_dir>/run_stats.json; also published next to index.json "
+        "when data changed (auto) or on every run (always)",
+    )
+    ap.add_argument("--stats_history", type=int, default=30, help="Runs kept in the run_stats.json history")
+    ap.add_argument(
+        "--profile_period",
+        default=None,
+        help=(
+            "YYYYMM: run cProfile on this period's fetch (one unit at a time) and publish "
+            "(<state_dir>/profile-<pe>.pstats)"
+        ),
+    )
+    args = ap.parse_args(argv)
+    shard: Optional[Tuple[int, int]] = None
+    if args.shard:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 2
+    TELEMETRY.reset()
+    TELEMETRY.profile_period = args.profile_period
 
     base_url = os.environ.get("DHIS2_BASE_URL")
     username = os.environ.get("DHIS2_USERNAME")
@@ -560,7 +1691,29 @@ def main() -> int:
         return 2
 
     dx_expected = [x.strip() for x in DX_LIST.split(";") if x.strip()]
-    client = Dhis2Client(base_url=base_url, username=username, password=password)
+    formats = tuple(f.strip() for f in args.formats.split(",") if f.strip())
+    if not formats or set(formats) - {"ndjson", "sparse"}:
+        print(f"Unknown --formats {args.formats!r} (expected ndjson and/or sparse)", file=sys.stderr)
+        return 2
+    rate = args.rate
+    if args.sleep:
+        rate = 1.0 / args.sleep
+    limiter = TokenBucket(rate=rate)
+    cache = None
+    if args.cache_dir:
+        cache = ResponseCache(Path(args.cache_dir), max_mb=args.cache_max_mb)
+        if args.cache_ttl_h is not None:
+            cache.ttls["api/analytics"] = args.cache_ttl_h * 3600
+    client = Dhis2Client(
+        base_url=base_url,
+        username=username,
+        password=password,
+        limiter=limiter,
+        pool_size=args.concurrency + 1,  # +1: sondes / liste des provinces hors du pool de fetch
+        cache=cache,
+        timeout_s=args.timeout_s,
+        transport=args.transport,
+    )
 
     end = args.end or current_yyyymm()
     all_months = month_range(args.start, end)
@@ -571,46 +1724,180 @@ def main() -> int:
         periods = all_months[-max(1, args.months):]
 
     out_dir = Path(args.out)  # ✅ toujours défini
-    monthly_root = out_dir / "monthly"
-    index_path = out_dir / "index.json"
-
-    # Charger l'index existant (si présent)
-    index = {"generated_at": None, "months": {}}
-    if index_path.exists() and not args.backfill:
+    # Charger l'index existant (si présent), y compris en --backfill: les mois hors plage restent publiés
+    index = load_index(out_dir / "index.json")
+    published = index["months"]  # mois de docs/data (planification, --incremental)
+    publish_dir = out_dir
+    if shard is not None:
+        # shard: seulement ses mois, publiés dans son dossier (index à part, repris par --resume);
+        # ou_map et index de docs/data ne sont que lus
+        periods = shard_periods(periods, *shard)
+        publish_dir = Path(args.shard_dir or f".shards/shard-{shard[0]}")
+        index = load_index(publish_dir / "index.json")
+        print(f"[shard {shard[0]}/{shard[1]}] {len(periods)} months -> {publish_dir}", flush=True)
+    monthly_root = publish_dir / "monthly"
+    index_path = publish_dir / "index.json"
+
+    ou_map: Optional[Dict[str, dict]] = None
+    if args.partition_org2 or args.rollups:
         try:
-            index = json.loads(index_path.read_text(encoding="utf-8"))
-            if "months" not in index:
-                index["months"] = {}
-        except Exception:
-            index = {"generated_at": None, "months": {}}
-
-    for pe in periods:
-        records = fetch_period(
-            client=client,
-            pe=pe,
-            dx_expected=dx_expected,
-            rename_map=RENAME_MAP,
-            dx_chunk_chars=args.dx_chunk_chars,
-            sleep_s=args.sleep,
+            ou_map = read_ou_map(out_dir)
+        except (OSError, ValueError) as e:
+            if args.partition_org2:
+                print(f"--partition_org2 needs {out_dir / 'ou_map.json.gz'} (build_ou_map.py): {e}", file=sys.stderr)
+                return 2
+            print(f"[warn] no usable ou_map.json.gz ({e}): rollups skipped", flush=True)
+    org2_of: Optional[Dict[str, str]] = None
+    if args.partition_org2 and ou_map is not None:
+        org2_of, org2_names = load_org2_partitions(ou_map, client)
+        index["org2"] = {**index.get("org2", {}), **org2_names}
+    rollups = RollupSpec.from_ou_map(ou_map, dx_expected) if args.rollups and ou_map is not None else None
+    columns = [RENAME_MAP.get(dx, dx) for dx in dx_expected]
+    series: Optional[SeriesStore] = None
+    if args.series and shard is None:  # shards: séries mises à jour par `merge`
+        series = SeriesStore.from_index(
+            out_dir / "series",
+            columns,
+            None if args.series_rebuild else index.get("series"),
+            buckets=args.series_buckets,
         )
 
-        # Ecrire par mois en parts compressées
-        month_folder = monthly_root / pe
-        month_folder.mkdir(parents=True, exist_ok=True)
-
-        # vider l'ancien contenu du mois avant réécriture
-        for p in month_folder.glob("*"):
-            p.unlink()
-
-        parts = write_ndjson_gz_parts(month_folder, records, max_part_mb=args.max_part_mb)
-
-        index["months"][pe] = {"parts": parts, "rows": len(records)}
-
-    index["generated_at"] = datetime.utcnow().isoformat(timespec="seconds") + "Z"
-    index_path.parent.mkdir(parents=True, exist_ok=True)
-    index_path.write_text(json.dumps(index, ensure_ascii=False), encoding="utf-8")
+    changes: Optional[ChangeLog] = None
+    if args.changes and shard is None:  # shards: changesets écrits par `merge`, contre docs/data
+        changes = ChangeLog.from_index(out_dir / "changes", index.get("changes"), keep=args.changes_keep)
+
+    state_dir = Path(args.state_dir)
+    cost_model = CostModel.load(state_dir / "cost_model.json")
+    chunks = plan_chunks(dx_expected, args.dx_chunk_chars, cost_model, target_s=args.slow_request_s)
+    fetcher = AdaptiveFetcher(client, cost_model=cost_model, slow_s=args.slow_request_s)
+    journal = FetchJournal.open(state_dir, plan_key(dx_expected), resume=args.resume)
+    if journal.published:
+        periods = [pe for pe in periods if pe not in journal.published]
+
+    fingerprints: Dict[str, dict] = {}
+    to_fetch = periods
+    if args.incremental:
+        with TELEMETRY.stage("probe"):
+            to_fetch, fingerprints = plan_incremental(
+                client,
+                periods,
+                published,
+                dx_expected,
+                dx_chunk_chars=args.dx_chunk_chars,
+                concurrency=args.concurrency,
+            )
+
+    groups = plan_period_groups(
+        to_fetch,
+        chunks,
+        published,
+        ou_count=read_ou_count(out_dir),
+        rows_budget=args.rows_budget,
+        max_periods=args.max_periods_per_request,
+    )
+    print(
+        f"Plan: {len(to_fetch)} months in {len(groups)} period groups {['+'.join(g) for g in groups]}, "
+        f"{len(chunks)} dx chunks",
+        flush=True,
+    )
+
+    changed_months: List[str] = []
+    for month in fetch_periods(
+        client=client,
+        periods=to_fetch,
+        dx_expected=dx_expected,
+        rename_map=RENAME_MAP,
+        dx_chunk_chars=args.dx_chunk_chars,
+        concurrency=args.concurrency,
+        journal=journal,
+        groups=groups,
+        fetcher=fetcher,
+        chunks=chunks,
+    ):
+        pe = month.pe
+        # Ecrire par mois en parts compressées (seulement si le contenu a changé)
+        with TELEMETRY.stage("publish_month"):
+            entry, changed = TELEMETRY.profiled(
+                [pe],
+                publish_month,
+                monthly_root,
+                pe,
+                month.table,
+                previous=index["months"].get(pe),
+                formats=formats,
+                org2_of=org2_of,
+                rollups=rollups,
+                changes=changes,
+                layout=args.gzip_layout,
+                max_part_mb=args.max_part_mb,
+                level=args.gzip_level,
+                workers=args.gzip_workers,
+                mtime=0 if args.reproducible else None,
+            )
+        entry["cells"] = month.cells
+        entry["signature"] = month_signature(entry)
+        if pe in fingerprints:
+            entry["fingerprint"] = fingerprints[pe]
+        index["months"][pe] = entry
+        if changes is not None and changed:
+            index["changes"] = changes.meta()
+        if series is not None and series.needs(pe, month_signature(entry)):
+            with TELEMETRY.stage("series"):
+                series.update_month(pe, month_signature(entry), month.table.iter_rows())
+            index["series"] = series.meta()
+        if changed:
+            changed_months.append(pe)
+        print(f"[{pe}] {'written' if changed else 'unchanged'} rows={entry['rows']}", flush=True)
+
+        # index mis à jour (atomiquement) après CHAQUE mois: un crash ne désynchronise jamais
+        # les fichiers publiés et l'index
+        if changed or not index.get("generated_at"):
+            index["generated_at"] = datetime.utcnow().isoformat(timespec="seconds") + "Z"
+        write_json_if_changed(index_path, index)
+        journal.mark_published(pe)
+        cost_model.save()
+
+    if series is not None:
+        # mois publiés pas encore (ou plus) intégrés aux séries: relus depuis docs/data
+        with TELEMETRY.stage("series"):
+            for pe, entry in sorted(index["months"].items()):
+                sig = month_signature(entry)
+                if series.needs(pe, sig):
+                    series.update_month(pe, sig, iter_published_rows(monthly_root / pe, entry, columns))
+            rewritten = series.flush()
+        index["series"] = series.meta()
+        print(f"[series] {len(rewritten)} buckets rewritten", flush=True)
+
+    # generated_at ne bouge que si des données ont changé => pas de commit inutile
+    # (l'index peut encore changer ici: empreintes des mois sautés par --incremental)
+    if not index.get("generated_at"):
+        index["generated_at"] = datetime.utcnow().isoformat(timespec="seconds") + "Z"
+    index_changed = write_json_if_changed(index_path, index)
+    journal.finish()
+
+    if args.run_stats != "off":
+        extra = {
+            "periods": to_fetch,
+            "changed": changed_months,
+            "concurrency": args.concurrency,
+            "transport": args.transport,
+        }
+        summary = TELEMETRY.write(state_dir / RUN_STATS_FILE, extra=extra, history=args.stats_history)
+        if args.run_stats == "always" or changed_months or index_changed:
+            # même historique que la copie de state_dir (les runs sans changement y figurent aussi)
+            shutil.copyfile(state_dir / RUN_STATS_FILE, publish_dir / RUN_STATS_FILE)
+        req = summary["requests"]
+        print(
+            f"[stats] {summary['duration_s']}s, {req['sent']} requests ({req['cached']} cached, "
+            f"{req['retries']} retries, {req['bytes'] / 1e6:.1f} MB, {req['wire_bytes'] / 1e6:.1f} MB on the wire), "
+            f"ttfb p90={req['ttfb_s']['p90']}s, rss peak={summary['rss_peak_mb']} MB",
+            flush=True,
+        )
+    if args.profile_period:
+        prof = TELEMETRY.dump_profile(state_dir / f"profile-{args.profile_period}.pstats")
+        print(f"[profile] {prof or 'period not fetched: no profile'}", flush=True)
 
-    print(f"OK: refreshed {periods}; index months={len(index['months'])}")
+    print(f"OK: refreshed {to_fetch}; changed={changed_months}; index months={len(index['months'])}")
     return 0
 
 
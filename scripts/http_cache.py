@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from email.utils import formatdate
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+import requests
+
+# TTL par endpoint (préfixe du chemin, en secondes). 0 => jamais mis en cache.
+DEFAULT_TTLS: Dict[str, float] = {
+    "api/analytics": 6 * 3600,
+    "api/organisationUnits": 24 * 3600,
+    "api/system": 0,
+}
+
+
+@dataclass
+class ResponseCache:
+    """
+    Cache disque des réponses DHIS2, clé = (chemin, paramètres normalisés).
+    - corps stockés compressés (gzip) + 1 petit fichier meta JSON par entrée
+    - TTL par endpoint; une entrée expirée est revalidée via ETag / Last-Modified si possible
+    - éviction LRU (date du dernier accès) dès que la taille dépasse max_mb: la taille totale est
+      tenue à jour à chaque écriture, le dossier n'est parcouru qu'au premier usage et pour évincer
+    """
+
+    root: Path
+    max_mb: int = 1024
+    ttls: Dict[str, float] = field(default_factory=lambda: dict(DEFAULT_TTLS))
+    default_ttl_s: float = 3600
+
+    def __post_init__(self) -> None:
+        self.root = Path(self.root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.total_bytes: Optional[int] = None  # inconnu tant que le dossier n'a pas été parcouru
+
+    @staticmethod
+    def key(path: str, params: Dict[str, object]) -> str:
+        norm = []
+        for k in sorted(params):
+            v = params[k]
+            norm.append([k, [str(x) for x in v] if isinstance(v, (list, tuple)) else [str(v)]])
+        raw = json.dumps([path.strip("/"), norm], ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def ttl_for(self, path: str) -> float:
+        path = path.strip("/")
+        best = None
+        for prefix in self.ttls:
+            if path.startswith(prefix) and (best is None or len(prefix) > len(best)):
+                best = prefix
+        return self.ttls[best] if best is not None else self.default_ttl_s
+
+    def _paths(self, key: str):
+        d = self.root / key[:2]
+        return d / f"{key}.gz", d / f"{key}.json"
+
+    def _load_meta(self, key: str) -> Optional[dict]:
+        body, meta = self._paths(key)
+        try:
+            m = json.loads(meta.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        return m if body.exists() else None
+
+    def _touch(self, key: str) -> None:
+        # l'horodatage du fichier meta sert d'ordre LRU
+        try:
+            os.utime(self._paths(key)[1])
+        except OSError:
+            pass
+
+    def _read(self, key: str, chunk_size: int) -> Iterator[bytes]:
+        self._touch(key)
+        with gzip.open(self._paths(key)[0], "rb") as f:
+            while True:
+                c = f.read(chunk_size)
+                if not c:
+                    return
+                yield c
+
+    def _size(self, key: str) -> int:
+        try:
+            return sum(p.stat().st_size for p in self._paths(key))
+        except OSError:
+            return 0
+
+    def _store(self, key: str, path: str, headers, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Renvoie les morceaux tout en les écrivant; l'entrée n'est validée que si le corps est complet."""
+        body, meta = self._paths(key)
+        before = self._size(key)  # entrée remplacée (revalidation expirée)
+        body.parent.mkdir(parents=True, exist_ok=True)
+        tmp = body.with_name(f"{body.name}.{uuid.uuid4().hex}.tmp")
+        complete = False
+        try:
+            with gzip.GzipFile(tmp, "wb", compresslevel=3, mtime=0) as f:
+                for c in chunks:
+                    f.write(c)
+                    yield c
+            complete = True
+        finally:
+            if not complete:
+                tmp.unlink(missing_ok=True)
+        os.replace(tmp, body)
+        m = {
+            "path": path.strip("/"),
+            "stored_at": time.time(),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+        }
+        meta.write_text(json.dumps(m), encoding="utf-8")
+        added = self._size(key) - before
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes += added
+            over = self.total_bytes is None or self.total_bytes > self.max_mb * 1024 * 1024
+        if over:
+            self.evict()
+
+    def stream(
+        self,
+        path: str,
+        params: Dict[str, object],
+        send: Callable[[Dict[str, str]], requests.Response],
+        chunk_size: int = 1 << 16,
+    ) -> Iterator[bytes]:
+        """
+        Corps de la réponse (par morceaux), depuis le cache si frais, sinon via
+        send(en-têtes conditionnels) qui doit renvoyer une réponse requests en stream=True.
+        """
+        ttl = self.ttl_for(path)
+        if ttl <= 0:
+            r = send({})
+            try:
+                yield from r.iter_content(chunk_size=chunk_size)
+            finally:
+                r.close()
+            return
+
+        key = self.key(path, params)
+        m = self._load_meta(key)
+        if m is not None and time.time() - m.get("stored_at", 0) < ttl:
+            yield from self._read(key, chunk_size)
+            return
+
+        cond: Dict[str, str] = {}
+        if m is not None:
+            if m.get("etag"):
+                cond["If-None-Match"] = m["etag"]
+            if m.get("last_modified"):
+                cond["If-Modified-Since"] = m["last_modified"]
+            elif not m.get("etag"):
+                cond["If-Modified-Since"] = formatdate(m.get("stored_at", 0), usegmt=True)
+
+        r = send(cond)
+        try:
+            if r.status_code == 304 and m is not None:
+                m["stored_at"] = time.time()
+                self._paths(key)[1].write_text(json.dumps(m), encoding="utf-8")
+                yield from self._read(key, chunk_size)
+                return
+            yield from self._store(key, path, r.headers, r.iter_content(chunk_size=chunk_size))
+        finally:
+            r.close()
+
+    def evict(self) -> None:
+        """
+        Supprime les entrées les moins récemment utilisées jusqu'à repasser sous 90 % de max_mb
+        (une marge pour que les écritures suivantes ne relancent pas un parcours chacune).
+        """
+        max_bytes = self.max_mb * 1024 * 1024
+        with self.lock:
+            entries = []
+            total = 0
+            for meta in self.root.glob("*/*.json"):
+                body = meta.with_suffix(".gz")
+                try:
+                    size = body.stat().st_size + meta.stat().st_size
+                    used = meta.stat().st_mtime
+                except OSError:
+                    continue
+                entries.append((used, size, body, meta))
+                total += size
+            target = max_bytes if total <= max_bytes else int(max_bytes * 0.9)
+            for _, size, body, meta in sorted(entries, key=lambda e: e[0]):
+                if total <= target:
+                    break
+                body.unlink(missing_ok=True)
+                meta.unlink(missing_ok=True)
+                total -= size
+            self.total_bytes = total
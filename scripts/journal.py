@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import gzip
+import json
+import os
+import shutil
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator, List, Set, Tuple
+
+
+class SpillWriter:
+    """Lignes brutes analytics d'une unité (groupe de périodes, chunk), écrites au fil du téléchargement."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.tmp = path.with_name(path.name + ".tmp")
+        self.tmp.parent.mkdir(parents=True, exist_ok=True)
+        self.f = gzip.GzipFile(self.tmp, "wb", compresslevel=1, mtime=0)
+        self.rows = 0
+
+    def write(self, rows: List[list]) -> None:
+        self.f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows).encode("utf-8"))
+        self.rows += len(rows)
+
+    def commit(self) -> None:
+        self.f.close()
+        os.replace(self.tmp, self.path)
+
+    def abort(self) -> None:
+        self.f.close()
+        self.tmp.unlink(missing_ok=True)
+
+
+@dataclass
+class FetchJournal:
+    """
+    Journal de reprise d'un long backfill (dans --state_dir):
+    - journal.jsonl: 1 ligne par unité (groupe de périodes, ensemble dx) terminée, puis par mois publié (fsync)
+    - spill/<pe1+pe2...>/<unit>/seg-XXXX.ndjson.gz: lignes brutes des requêtes réussies de l'unité
+      (une unité découpée après un échec a plusieurs segments), rejouées à la reprise
+    Les unités sont identifiées par le hash de leur ensemble dx: un découpage différent
+    (coûts appris entre-temps) ne rejoue que les unités identiques.
+    Le journal n'est valable que pour la même liste dx (plan_key).
+    """
+
+    root: Path
+    plan_key: str
+    done: Set[Tuple[str, str]] = field(default_factory=set)
+    published: Set[str] = field(default_factory=set)
+
+    def __post_init__(self) -> None:
+        self.root = Path(self.root)
+        self.path = self.root / "journal.jsonl"
+        self.spill_root = self.root / "spill"
+        self.lock = threading.Lock()
+
+    @classmethod
+    def open(cls, root: Path, plan_key: str, resume: bool) -> "FetchJournal":
+        j = cls(root=root, plan_key=plan_key)
+        if resume and j.path.exists():
+            lines = j.path.read_text(encoding="utf-8").splitlines()
+            header = json.loads(lines[0]) if lines else {}
+            if header.get("plan") == plan_key:
+                for line in lines[1:]:
+                    try:
+                        e = json.loads(line)
+                    except ValueError:
+                        continue  # dernière ligne tronquée par le crash
+                    if "unit" in e:
+                        j.done.add((e["pe"], e["unit"]))
+                    elif e.get("published"):
+                        j.published.add(e["pe"])
+                print(f"[resume] {len(j.done)} units done, months published={sorted(j.published)}", flush=True)
+                return j
+            print("[resume] journal is for another dx plan: starting over", flush=True)
+        j.reset()
+        return j
+
+    def reset(self) -> None:
+        if self.spill_root.exists():
+            shutil.rmtree(self.spill_root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.done.clear()
+        self.published.clear()
+        self.path.write_text(json.dumps({"plan": self.plan_key}) + "\n", encoding="utf-8")
+
+    def _append(self, entry: dict) -> None:
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _unit_dir(self, pe: str, unit: str) -> Path:
+        return self.spill_root / pe / unit
+
+    def is_done(self, pe: str, unit: str) -> bool:
+        return (pe, unit) in self.done
+
+    def start_unit(self, pe: str, unit: str) -> None:
+        """(Re)commence une unité: les segments d'une tentative interrompue sont jetés."""
+        shutil.rmtree(self._unit_dir(pe, unit), ignore_errors=True)
+
+    def spill_writer(self, pe: str, unit: str) -> SpillWriter:
+        d = self._unit_dir(pe, unit)
+        with self.lock:
+            d.mkdir(parents=True, exist_ok=True)
+            # segments validés seulement: un .tmp laissé par un spill interrompu ne décale pas la numérotation
+            n = len(list(d.glob("seg-*.ndjson.gz"))) + 1
+            return SpillWriter(d / f"seg-{n:04d}.ndjson.gz")
+
+    def mark_done(self, pe: str, unit: str, rows: int) -> None:
+        self._append({"pe": pe, "unit": unit, "rows": rows})
+        with self.lock:
+            self.done.add((pe, unit))
+
+    def replay(self, pe: str, unit: str) -> Iterator[list]:
+        for seg in sorted(self._unit_dir(pe, unit).glob("seg-*.ndjson.gz")):
+            with gzip.open(seg, "rt", encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)
+
+    def mark_published(self, pe: str) -> None:
+        """Mois écrit + index à jour: les lignes brutes des groupes entièrement publiés ne servent plus."""
+        self._append({"pe": pe, "published": True})
+        self.published.add(pe)
+        if not self.spill_root.exists():
+            return
+        for d in self.spill_root.iterdir():
+            if all(p in self.published for p in d.name.split("+")):
+                shutil.rmtree(d, ignore_errors=True)
+
+    def finish(self) -> None:
+        """Run terminé sans erreur: plus rien à reprendre (le reste de --state_dir est conservé)."""
+        shutil.rmtree(self.spill_root, ignore_errors=True)
+        self.path.unlink(missing_ok=True)
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import gzip
+import json
+from pathlib import Path
+from typing import Dict, List
+
+# Carte des OU compacte "ou-tree-v1" (docs/data/ou_tree.json.gz): chaque OU n'apparaît qu'une fois,
+# à son niveau, et pointe vers son parent par indice dans le niveau du dessus.
+# {
+#   "format": "ou-tree-v1",
+#   "levels": {
+#     "2": {"ids": [...], "names": [...]},
+#     "3": {"ids": [...], "names": [...], "parent": [indice dans levels["2"], ...]},
+#     "4": {..., "parent": [...]},
+#     "5": {..., "parent": [...]}
+#   }
+# }
+# Parent absent (hiérarchie incomplète): -1.
+OU_TREE_FORMAT = "ou-tree-v1"
+LEVELS = (2, 3, 4, 5)
+
+
+def unit_parent(u: dict) -> str:
+    """uid du parent direct, d'après le champ path (/racine/.../parent/uid)."""
+    ids = [p for p in (u.get("path") or "").split("/") if p]
+    return ids[-2] if len(ids) >= 2 else ""
+
+
+def encode_tree(units: Dict[str, dict]) -> dict:
+    """units: uid -> {id, name, level, parent} (niveaux 2 à 5)."""
+    levels: Dict[str, dict] = {}
+    pos_above: Dict[str, int] = {}
+    for lvl in LEVELS:
+        ids = sorted(uid for uid, u in units.items() if u.get("level") == lvl)
+        entry: dict = {"ids": ids, "names": [units[uid].get("name") or "" for uid in ids]}
+        if lvl > LEVELS[0]:
+            entry["parent"] = [pos_above.get(units[uid].get("parent") or "", -1) for uid in ids]
+        levels[str(lvl)] = entry
+        pos_above = {uid: i for i, uid in enumerate(ids)}
+    return {"format": OU_TREE_FORMAT, "levels": levels}
+
+
+def decode_tree(tree: dict) -> Dict[str, dict]:
+    """Inverse de encode_tree: uid -> {id, name, level, parent}."""
+    units: Dict[str, dict] = {}
+    ids_above: List[str] = []
+    for lvl in LEVELS:
+        entry = tree["levels"].get(str(lvl)) or {"ids": [], "names": []}
+        parents = entry.get("parent") or [-1] * len(entry["ids"])
+        for uid, name, p in zip(entry["ids"], entry["names"], parents):
+            units[uid] = {"id": uid, "name": name, "level": lvl, "parent": ids_above[p] if p >= 0 else ""}
+        ids_above = entry["ids"]
+    return units
+
+
+def flat_map(units: Dict[str, dict]) -> Dict[str, Dict[str, str]]:
+    """Ancien format { ou5: {Org2, Org3, Org4, Org5, Org2Id, Org3Id, Org4Id} } en remontant les parents."""
+    out: Dict[str, Dict[str, str]] = {}
+    for uid in sorted(units):  # ordre indépendant de l'ordre d'arrivée des pages
+        u = units[uid]
+        if u.get("level") != 5:
+            continue
+        rec = {"Org2": "", "Org3": "", "Org4": "", "Org5": u.get("name") or "", "Org2Id": "", "Org3Id": "", "Org4Id": ""}
+        p = units.get(u.get("parent") or "")
+        while p is not None and p.get("level", 0) >= 2:
+            lvl = p["level"]
+            if lvl in (2, 3, 4):
+                rec[f"Org{lvl}"] = p.get("name") or ""
+                rec[f"Org{lvl}Id"] = p["id"]
+            p = units.get(p.get("parent") or "")
+        out[uid] = rec
+    return out
+
+
+def flat_from_tree(tree: dict) -> Dict[str, Dict[str, str]]:
+    return flat_map(decode_tree(tree))
+
+
+def read_ou_map(out_dir: Path) -> Dict[str, Dict[str, str]]:
+    """
+    Carte de build_ou_map.py au format plat {ou5: {Org2, Org3, Org4, Org5, Org2Id, ...}},
+    depuis ou_tree.json.gz si présent, sinon depuis l'ancien ou_map.json.gz.
+    """
+    tree_path = Path(out_dir) / "ou_tree.json.gz"
+    if tree_path.exists():
+        with gzip.open(tree_path, "rb") as f:
+            return flat_from_tree(json.loads(f.read()))
+    with gzip.open(Path(out_dir) / "ou_map.json.gz", "rb") as f:
+        return json.loads(f.read())
@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import heapq
+import json
+import math
+import threading
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+NAN = float("nan")
+
+
+def parse_value(val: object) -> Optional[float]:
+    if val is None:
+        return None
+    try:
+        return float(val)
+    except Exception:
+        return None
+
+
+def json_number(v: float) -> str:
+    """Comme json.dumps(v) pour un float: NaN (cellule absente) => null."""
+    if v != v:
+        return "null"
+    if math.isinf(v):
+        return "Infinity" if v > 0 else "-Infinity"
+    return float.__repr__(v)
+
+
+class MonthTable:
+    """
+    Un mois pivoté: matrice dense OU x colonnes dans un seul array('d') (8 octets par cellule,
+    NaN = absent), ligne de l'OU via ou_row. Les lignes NDJSON sont sérialisées directement
+    depuis la matrice, sans dict intermédiaire.
+    """
+
+    def __init__(self, pe: str, columns: List[str]) -> None:
+        self.pe = pe
+        self.period = f"{pe[:4]}-{pe[4:6]}-01"
+        self.columns = columns
+        self.width = len(columns)
+        self.ous: List[str] = []
+        self.ou_row: Dict[str, int] = {}
+        self.data = array("d")
+        self._blank = array("d", [NAN]) * self.width
+        # préfixes JSON pré-encodés: ', "col": '
+        self._keys = [", " + json.dumps(c, ensure_ascii=False) + ": " for c in columns]
+        self._nulls = [k + "null" for k in self._keys]
+
+    @classmethod
+    def from_records(cls, pe: str, columns: List[str], records: Iterable[dict]) -> "MonthTable":
+        """Relit un mois publié (lignes {OrgUnit, Period, colonnes...}, None = absent)."""
+        t = cls(pe, columns)
+        w = t.width
+        for rec in records:
+            base = t.row_of(rec["OrgUnit"]) * w
+            for c, col in enumerate(columns):
+                v = rec.get(col)
+                if v is not None:
+                    t.data[base + c] = v
+        return t
+
+    def __len__(self) -> int:
+        return len(self.ous)
+
+    def row_of(self, ou: str) -> int:
+        r = self.ou_row.get(ou)
+        if r is None:
+            r = len(self.ous)
+            self.ou_row[ou] = r
+            self.ous.append(ou)
+            self.data.extend(self._blank)
+        return r
+
+    def iter_rows(self, ous: Optional[Iterable[str]] = None) -> Iterator[Tuple[str, array]]:
+        """(ou, valeurs alignées sur columns), triées par OU (seulement `ous` si donné)."""
+        w = self.width
+        for ou in sorted(self.ous if ous is None else ous):
+            r = self.ou_row[ou]
+            yield ou, self.data[r * w : (r + 1) * w]
+
+    def encode_line(self, ou: str, values: array) -> bytes:
+        """Même octets que json.dumps(record, ensure_ascii=False) + "\\n"."""
+        head = '{"OrgUnit": ' + json.dumps(ou, ensure_ascii=False) + ', "Period": "' + self.period + '"'
+        parts = self._nulls[:]  # la plupart des cellules sont absentes
+        for c in [c for c, v in enumerate(values) if v == v]:
+            parts[c] = self._keys[c] + json_number(values[c])
+        return (head + "".join(parts) + "}\n").encode("utf-8")
+
+    def iter_lines(self) -> Iterator[bytes]:
+        for ou, values in self.iter_rows():
+            yield self.encode_line(ou, values)
+
+    def iter_records(self) -> Iterator[dict]:
+        for ou, values in self.iter_rows():
+            rec: dict = {"OrgUnit": ou, "Period": self.period}
+            for c, v in zip(self.columns, values):
+                rec[c] = None if v != v else v
+            yield rec
+
+
+class PivotAccumulator:
+    """
+    Pivot incrémental: les lignes longues (dx, pe, ou, value) sont repliées au fil de l'eau
+    dans 1 MonthTable par période (index dx -> colonne calculé une fois).
+    La mémoire est donc bornée par la taille du mois pivoté, pas par les réponses brutes;
+    le tampon d'une requête en cours (empty_like(dx_items)) n'a que les colonnes de son chunk dx.
+    Les dx hors de dx_expected sont comptés dans `cells` mais pas gardés.
+    """
+
+    def __init__(self, dx_expected: List[str], rename_map: Optional[Dict[str, str]] = None) -> None:
+        rename_map = rename_map or {}
+        self.dx_expected = dx_expected
+        self.rename_map = rename_map
+        self.columns = [rename_map.get(dx, dx) for dx in dx_expected]
+        self.dx_col: Dict[str, int] = {dx: i for i, dx in enumerate(dx_expected)}
+        self.tables: Dict[str, MonthTable] = {}
+        self.cells: Dict[str, int] = {}  # nb de lignes brutes reçues par période
+        self.lock = threading.Lock()
+
+    def empty_like(self, dx_items: Optional[List[str]] = None) -> "PivotAccumulator":
+        """Accumulateur vide avec les mêmes colonnes, ou seulement celles de dx_items (à replier par merge)."""
+        if dx_items is None:
+            return PivotAccumulator(self.dx_expected, self.rename_map)
+        return PivotAccumulator([dx for dx in dict.fromkeys(dx_items) if dx in self.dx_col], self.rename_map)
+
+    def table(self, pe: str) -> MonthTable:
+        t = self.tables.get(pe)
+        if t is None:
+            t = self.tables[pe] = MonthTable(pe, self.columns)
+        return t
+
+    def add(self, dx: str, pe: str, ou: str, val: Optional[float]) -> None:
+        c = self.dx_col.get(dx)
+        if c is None:
+            return
+        t = self.table(pe)
+        i = t.row_of(ou) * t.width + c
+        v = NAN if val is None else val
+        old = t.data[i]
+        if old != old:
+            t.data[i] = v
+        elif v == v:
+            t.data[i] = old + v  # doublon (ou, dx): somme
+
+    def add_rows(self, rows: Iterable[list]) -> int:
+        """Ajoute des lignes brutes analytics ([dx, pe, ou, value, ...]). Thread-safe."""
+        n = 0
+        dx_col = self.dx_col
+        with self.lock:
+            last_pe = None
+            t = data = ou_row = None
+            for r in rows:
+                try:
+                    dx, pe, ou, val = r[0], r[1], r[2], r[3]
+                except Exception:
+                    continue
+                n += 1
+                self.cells[pe] = self.cells.get(pe, 0) + 1
+                c = dx_col.get(dx)
+                if c is None:
+                    continue
+                if pe != last_pe:
+                    t = self.table(pe)
+                    data, ou_row, last_pe = t.data, t.ou_row, pe
+                row = ou_row.get(ou)
+                if row is None:
+                    row = t.row_of(ou)
+                i = row * t.width + c
+                try:
+                    v = float(val)
+                except (TypeError, ValueError):
+                    v = NAN  # null / valeur non numérique
+                old = data[i]
+                if old != old:
+                    data[i] = v
+                elif v == v:
+                    data[i] = old + v
+        return n
+
+    def merge(self, other: "PivotAccumulator") -> None:
+        """
+        Replie un autre accumulateur (ex: résultat complet d'une requête) dans celui-ci, colonnes
+        associées par dx (other peut n'avoir qu'une partie des colonnes). Thread-safe.
+        """
+        cols = [self.dx_col.get(dx) for dx in other.dx_expected]
+        with self.lock:
+            for pe, src in other.tables.items():
+                dst = self.table(pe)
+                w, sw = dst.width, src.width
+                for ou, r in src.ou_row.items():
+                    base = dst.row_of(ou) * w
+                    data = dst.data
+                    for c, v in zip(cols, src.data[r * sw : (r + 1) * sw]):
+                        if v != v or c is None:
+                            continue
+                        old = data[base + c]
+                        data[base + c] = v if old != old else old + v
+            for pe, n in other.cells.items():
+                self.cells[pe] = self.cells.get(pe, 0) + n
+
+    def __len__(self) -> int:
+        return sum(len(t) for t in self.tables.values())
+
+    def pop_table(self, pe: str) -> MonthTable:
+        """Retire et renvoie le mois `pe` (vide s'il n'a reçu aucune valeur)."""
+        with self.lock:
+            return self.tables.pop(pe, None) or MonthTable(pe, self.columns)
+
+    def iter_records(self, pe: Optional[str] = None) -> Iterator[dict]:
+        """
+        1 ligne par (ou,pe), triée, colonnes = dx_expected renommées.
+        Vide l'accumulateur (seulement la période `pe` si elle est donnée).
+        """
+        if pe is not None:
+            return self.pop_table(pe).iter_records()
+        tables = [self.pop_table(p) for p in sorted(self.tables)]
+        return heapq.merge(*(t.iter_records() for t in tables), key=lambda rec: rec["OrgUnit"])
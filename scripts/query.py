@@ -0,0 +1,388 @@
+from __future__ import annotations
+
+import argparse
+import bisect
+import csv
+import gzip
+import heapq
+import json
+import sys
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple
+
+from ou_tree import read_ou_map
+from sparse_format import iter_sparse_records, read_sparse
+
+# Lecture locale de docs/data (index.json + monthly/<pe>/...) sans tout décompresser:
+# - projection: seules les colonnes demandées sont construites (fichier creux: seules ces colonnes
+#   sont décodées);
+# - prédicats poussés vers le stockage: mois hors intervalle ignorés, parts dont [ou_min, ou_max]
+#   ne contient aucune OU voulue sautées, tranche org2=<uid>/ lue seule pour un filtre province,
+#   blocs gzip lus par seek via ou_index.json.gz (layout bgzf), OrgUnit lu avant json.loads.
+#   python scripts/query.py --org2 "Kinshasa" --start 202501 --columns "BCG fixe1,VPO 0" > kin.csv
+
+LINE_PREFIX = b'{"OrgUnit": "'  # début de chaque ligne NDJSON publiée (json.dumps, clés dans l'ordre)
+HIERARCHY_COLS = ("Org2", "Org3", "Org4", "Org5")
+
+
+def norm_month(s: Optional[str]) -> Optional[str]:
+    """"2025-01", "202501" ou "2025-01-01" -> "202501"."""
+    if not s:
+        return None
+    digits = s.replace("-", "")[:6]
+    if len(digits) != 6 or not digits.isdigit():
+        raise ValueError(f"invalid month: {s!r} (expected YYYYMM)")
+    return digits
+
+
+@dataclass
+class Query:
+    """Filtres et projection; None = pas de filtre. org2/org3: uid ou nom."""
+
+    start: Optional[str] = None  # YYYYMM inclus
+    end: Optional[str] = None  # YYYYMM inclus
+    ous: Optional[Set[str]] = None
+    org2: Optional[Set[str]] = None
+    org3: Optional[Set[str]] = None
+    columns: Optional[List[str]] = None
+
+    def __post_init__(self) -> None:
+        self.start = norm_month(self.start)
+        self.end = norm_month(self.end)
+
+    def has_month(self, pe: str) -> bool:
+        return (self.start is None or pe >= self.start) and (self.end is None or pe <= self.end)
+
+
+def line_ou(line: bytes) -> Optional[str]:
+    """OrgUnit d'une ligne NDJSON publiée sans la décoder (None si la ligne n'a pas la forme attendue)."""
+    if not line.startswith(LINE_PREFIX):
+        return None
+    end = line.find(b'"', len(LINE_PREFIX))
+    if end < 0 or b"\\" in line[len(LINE_PREFIX) : end]:
+        return None
+    return line[len(LINE_PREFIX) : end].decode("utf-8")
+
+
+def gunzip_members(raw: bytes) -> bytes:
+    """Décompresse une suite de membres gzip (blocs bgzf consécutifs)."""
+    out: List[bytes] = []
+    while raw:
+        d = zlib.decompressobj(31)
+        out.append(d.decompress(raw))
+        raw = d.unused_data
+    return b"".join(out)
+
+
+def casefold_all(values: Set[str]) -> Set[str]:
+    return {v.casefold() for v in values}
+
+
+def project(rec: dict, columns: Optional[List[str]]) -> dict:
+    if columns is None:
+        return rec
+    out = {"OrgUnit": rec.get("OrgUnit"), "Period": rec.get("Period")}
+    for c in columns:
+        out[c] = rec.get(c)
+    return out
+
+
+class Dataset:
+    """
+    docs/data publié par fetch_dhis2_vaccination.py. index.json est relu si son mtime change
+    (un processus long, ex. api_server.py, voit les nouvelles publications); ou_map chargé à la demande.
+    """
+
+    def __init__(self, root: Path, prefer_sparse: bool = True) -> None:
+        self.root = Path(root)
+        self.prefer_sparse = prefer_sparse
+        self._index: dict = {}
+        self._index_mtime: Optional[float] = None
+        self._ou_map: Optional[Dict[str, Dict[str, str]]] = None
+        self._ou_map_mtime: Optional[float] = None
+        self._columns: Dict[str, List[str]] = {}
+
+    @property
+    def index(self) -> dict:
+        path = self.root / "index.json"
+        mtime = path.stat().st_mtime
+        if mtime != self._index_mtime:
+            self._index = json.loads(path.read_text(encoding="utf-8"))
+            self._index_mtime = mtime
+            self._columns.clear()
+        return self._index
+
+    def ou_map_mtime(self) -> Optional[float]:
+        for name in ("ou_tree.json.gz", "ou_map.json.gz"):
+            path = self.root / name
+            if path.exists():
+                return path.stat().st_mtime
+        return None
+
+    def ou_map(self) -> Dict[str, Dict[str, str]]:
+        """Relu si ou_tree.json.gz / ou_map.json.gz a changé depuis le dernier chargement."""
+        mtime = self.ou_map_mtime()
+        if mtime is None:
+            raise ValueError(f"Org2/Org3 filters need ou_tree.json.gz or ou_map.json.gz in {self.root}")
+        if self._ou_map is None or mtime != self._ou_map_mtime:
+            self._ou_map = read_ou_map(self.root)
+            self._ou_map_mtime = mtime
+        return self._ou_map
+
+    def months(self, q: Optional[Query] = None) -> List[str]:
+        return sorted(pe for pe in self.index.get("months", {}) if q is None or q.has_month(pe))
+
+    def entry(self, pe: str) -> dict:
+        return self.index["months"][pe]
+
+    def month_folder(self, pe: str) -> Path:
+        return self.root / "monthly" / pe
+
+    def columns(self, pe: Optional[str] = None) -> List[str]:
+        """Colonnes d'un mois (par défaut le plus récent), lues dans le fichier creux ou la 1re ligne."""
+        months = self.months()
+        if not months:
+            return []
+        pe = pe or months[-1]
+        if pe not in self._columns:
+            entry = self.entry(pe)
+            folder = self.month_folder(pe)
+            cols: List[str] = []
+            if entry.get("sparse"):
+                cols = list(read_sparse(folder / entry["sparse"]["file"], header_only=True)["columns"])
+            elif entry.get("parts"):
+                with gzip.open(folder / entry["parts"][0]["file"], "rb") as f:
+                    first = f.readline()
+                if first:
+                    cols = [k for k in json.loads(first) if k not in ("OrgUnit", "Period")]
+            self._columns[pe] = cols
+        return self._columns[pe]
+
+    # ---- filtres OU ----
+
+    def _matches(self, e: Dict[str, str], lvl: int, wanted: Set[str], folded: Set[str]) -> bool:
+        """uid exact, ou nom sans tenir compte de la casse."""
+        return e.get(f"Org{lvl}Id") in wanted or (e.get(f"Org{lvl}") or "").casefold() in folded
+
+    def resolve_ous(self, q: Query, with_org2: bool = True) -> Optional[Set[str]]:
+        """Ensemble des OU (niveau 5) retenues par ous/org2/org3; None = toutes."""
+        org2 = q.org2 if with_org2 else None
+        if not (q.ous or org2 or q.org3):
+            return None
+        selected: Optional[Set[str]] = set(q.ous) if q.ous else None
+        if org2 or q.org3:
+            f2 = casefold_all(org2 or set())
+            f3 = casefold_all(q.org3 or set())
+            by_tree = {
+                ou
+                for ou, e in self.ou_map().items()
+                if (not org2 or self._matches(e, 2, org2, f2)) and (not q.org3 or self._matches(e, 3, q.org3, f3))
+            }
+            selected = by_tree if selected is None else selected & by_tree
+        return selected
+
+    def org2_slices(self, entry: dict, org2: Set[str]) -> List[str]:
+        names = self.index.get("org2") or {}
+        folded = casefold_all(org2)
+        return sorted(
+            uid for uid in entry.get("org2") or {} if uid in org2 or (names.get(uid) or "").casefold() in folded
+        )
+
+    # ---- lecture ----
+
+    def scan(self, q: Query) -> Iterator[dict]:
+        """Lignes {OrgUnit, Period, colonnes...} des mois retenus, par mois puis par OU."""
+        full: Optional[Set[str]] = None
+        full_done = False
+        for pe in self.months(q):
+            entry = self.entry(pe)
+            folder = self.month_folder(pe)
+            if q.org2 and entry.get("org2"):
+                ous = self.resolve_ous(q, with_org2=False)
+                slices = [
+                    self.scan_slice(folder / f"org2={uid}", entry["org2"][uid], ous, q.columns)
+                    for uid in self.org2_slices(entry, q.org2)
+                ]
+                yield from heapq.merge(*slices, key=lambda rec: rec["OrgUnit"])
+                continue
+            if not full_done:
+                full, full_done = self.resolve_ous(q), True
+            if full is not None and not full:
+                return
+            yield from self.scan_slice(folder, entry, full, q.columns)
+
+    def scan_slice(
+        self, folder: Path, entry: dict, ous: Optional[Set[str]], columns: Optional[List[str]]
+    ) -> Iterator[dict]:
+        """Un mois ou une tranche org2=<uid>/: choisit la lecture la moins coûteuse disponible."""
+        if ous is not None and entry.get("layout") == "bgzf" and entry.get("ou_index"):
+            lines: Iterable[bytes] = self._bgzf_lines(folder, entry, ous)
+        elif entry.get("sparse") and (self.prefer_sparse or not entry.get("parts")):
+            obj = read_sparse(folder / entry["sparse"]["file"])
+            for rec in iter_sparse_records(obj, columns, ous):
+                for k, v in rec.items():
+                    if isinstance(v, int):
+                        rec[k] = float(v)  # mêmes valeurs que les parts NDJSON
+                yield rec if columns is None else project(rec, columns)
+            return
+        else:
+            lines = self._part_lines(folder, entry, ous)
+        for line in lines:
+            yield project(json.loads(line), columns)
+
+    def _part_lines(self, folder: Path, entry: dict, ous: Optional[Set[str]]) -> Iterator[bytes]:
+        wanted = sorted(ous) if ous is not None else None
+        for p in entry.get("parts") or []:
+            if wanted is not None and "ou_min" in p:
+                i = bisect.bisect_left(wanted, p["ou_min"])
+                if i == len(wanted) or wanted[i] > p["ou_max"]:
+                    continue  # aucune OU voulue dans cette part
+            with gzip.open(folder / p["file"], "rb") as f:
+                for line in f:
+                    if wanted is not None:
+                        ou = line_ou(line)
+                        if ou is None:
+                            ou = json.loads(line).get("OrgUnit")
+                        if ou not in ous:
+                            if ou is not None and ou > wanted[-1]:
+                                return  # lignes triées par OU
+                            continue
+                    yield line
+
+    def _bgzf_lines(self, folder: Path, entry: dict, ous: Set[str]) -> Iterator[bytes]:
+        """Lit seulement les blocs des OU voulues (index ou_index.json.gz), plages contiguës fusionnées."""
+        with gzip.open(folder / entry["ou_index"]["file"], "rb") as f:
+            idx = json.loads(f.read())
+        pos = {ou: i for i, ou in enumerate(idx["ous"])}
+        ranges: List[Tuple[int, int]] = []
+        for i in sorted(pos[ou] for ou in ous if ou in pos):
+            b = idx["block"][i]
+            ranges.append((b, b + int(idx["spans"].get(str(i), 1))))
+        merged: List[List[int]] = []
+        for lo, hi in ranges:
+            if merged and lo <= merged[-1][1] and idx["blocks"][lo][0] == idx["blocks"][merged[-1][1] - 1][0]:
+                merged[-1][1] = max(merged[-1][1], hi)
+            else:
+                merged.append([lo, hi])
+        seen: Set[str] = set()
+        handles: Dict[int, object] = {}
+        try:
+            for lo, hi in merged:
+                part, off, _ = idx["blocks"][lo]
+                end = idx["blocks"][hi - 1][1] + idx["blocks"][hi - 1][2]
+                f = handles.get(part)
+                if f is None:
+                    f = handles[part] = open(folder / idx["parts"][part], "rb")
+                f.seek(off)
+                for line in gunzip_members(f.read(end - off)).split(b"\n"):
+                    ou = line_ou(line)  # un début de bloc peut être la fin d'une ligne longue: ignoré
+                    if ou in ous and ou not in seen:
+                        seen.add(ou)
+                        yield line + b"\n"
+        finally:
+            for f in handles.values():
+                f.close()
+
+
+def with_hierarchy(records: Iterable[dict], ou_map: Dict[str, Dict[str, str]]) -> Iterator[dict]:
+    """Ajoute Org2..Org5 (noms) après OrgUnit."""
+    blank = {c: "" for c in HIERARCHY_COLS}
+    for rec in records:
+        e = ou_map.get(rec["OrgUnit"]) or blank
+        out = {"OrgUnit": rec["OrgUnit"], **{c: e.get(c, "") for c in HIERARCHY_COLS}}
+        out.update(rec)
+        yield out
+
+
+def write_csv(records: Iterable[dict], fieldnames: List[str], out: TextIO) -> int:
+    w = csv.DictWriter(out, fieldnames=fieldnames, extrasaction="ignore", lineterminator="\n")
+    w.writeheader()
+    n = 0
+    for rec in records:
+        w.writerow(rec)
+        n += 1
+    return n
+
+
+def write_ndjson(records: Iterable[dict], out: TextIO) -> int:
+    n = 0
+    for rec in records:
+        out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        n += 1
+    return n
+
+
+def split_list(values: Optional[List[str]], sep: str = ",") -> Optional[Set[str]]:
+    if not values:
+        return None
+    return {x.strip() for v in values for x in v.split(sep) if x.strip()}
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Query the published docs/data vaccination dataset")
+    ap.add_argument("--data", default="docs/data", help="Published data folder (index.json, monthly/)")
+    ap.add_argument("--start", default=None, help="First month YYYYMM (inclusive)")
+    ap.add_argument("--end", default=None, help="Last month YYYYMM (inclusive)")
+    ap.add_argument("--ou", action="append", help="OrgUnit uid(s), comma separated; repeatable")
+    ap.add_argument("--ou_file", default=None, help="File with one OrgUnit uid per line")
+    ap.add_argument("--org2", action="append", help="Province uid or name; repeatable")
+    ap.add_argument("--org3", action="append", help="Health zone uid or name; repeatable")
+    ap.add_argument("--columns", default=None, help="Comma separated columns to keep (default: all)")
+    ap.add_argument("--names", action="store_true", help="Add Org2..Org5 names to each row")
+    ap.add_argument("--format", choices=["csv", "ndjson"], default="csv")
+    ap.add_argument("--out", default="-", help="Output file (default: stdout)")
+    ap.add_argument("--no_sparse", action="store_true", help="Read NDJSON parts even when sparse.bin.gz exists")
+    ap.add_argument("--list", action="store_true", help="Print months and columns, then exit")
+    args = ap.parse_args()
+
+    ds = Dataset(Path(args.data), prefer_sparse=not args.no_sparse)
+    if args.list:
+        for pe in ds.months():
+            e = ds.entry(pe)
+            print(f"{pe}\trows={e.get('rows')}\tformats={','.join(e.get('formats') or ['ndjson'])}")
+        print("columns: " + "; ".join(ds.columns()))
+        return 0
+
+    ous = split_list(args.ou) or set()
+    if args.ou_file:
+        ous |= {x.strip() for x in Path(args.ou_file).read_text(encoding="utf-8").splitlines() if x.strip()}
+    columns = [c.strip() for c in args.columns.split(",") if c.strip()] if args.columns else None
+    try:
+        q = Query(
+            start=args.start,
+            end=args.end,
+            ous=ous or None,
+            org2=split_list(args.org2, sep="\0"),
+            org3=split_list(args.org3, sep="\0"),
+            columns=columns,
+        )
+        known = ds.columns()
+        unknown = [c for c in columns or [] if known and c not in known]
+        if unknown:
+            raise ValueError(f"unknown column(s): {unknown}")
+        records: Iterable[dict] = ds.scan(q)
+        fieldnames = ["OrgUnit", "Period"] + (columns or known)
+        if args.names:
+            records = with_hierarchy(records, ds.ou_map())
+            fieldnames = ["OrgUnit", *HIERARCHY_COLS] + fieldnames[1:]
+
+        out = sys.stdout if args.out == "-" else open(args.out, "w", encoding="utf-8", newline="")
+        try:
+            if args.format == "csv":
+                n = write_csv(records, fieldnames, out)
+            else:
+                n = write_ndjson(records, out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return 2
+    print(f"OK: {n} rows", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+from array import array
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from pivot import NAN, MonthTable
+
+# Règles d'agrégation par dx (défaut: somme). Les taux de rapportage sont des pourcentages par
+# formation sanitaire (1 rapport attendu par mois): le taux d'une zone est la moyenne des formations
+# qui en ont un, c.-à-d. rapports reçus / rapports attendus. Le nombre de formations moyennées
+# est publié à côté ("<colonne> [n]") pour pouvoir recombiner des zones avec les bons poids.
+AGG_RULES: Dict[str, str] = {
+    "E4BX1ea2iDJ.REPORTING_RATE": "mean",  # Complétude
+    "E4BX1ea2iDJ.REPORTING_RATE_ON_TIME": "mean",  # Promptitude
+}
+
+ROLLUP_LEVELS = (4, 3, 2)  # Org4 (aire de santé) -> Org3 (zone de santé) -> Org2 (province)
+UNKNOWN = "unknown"  # OU absentes de ou_map.json.gz
+
+
+@dataclass
+class Rollup:
+    """Agrégat d'un mois à un niveau: sommes et nb de cellules non nulles par (groupe, colonne)."""
+
+    level: int
+    keys: List[str]
+    width: int
+    sums: array  # NaN = aucune valeur dans le groupe
+    counts: array
+    n_ou: array  # formations sanitaires (niveau 5) ayant au moins une valeur
+
+
+def group_by(
+    keys: List[str],
+    width: int,
+    values: array,
+    counts: Optional[array],
+    n_ou: Optional[array],
+    group_of: Dict[str, str],
+    level: int,
+) -> Rollup:
+    """
+    Regroupe les lignes `keys` (matrice values, len(keys) x width) selon group_of.
+    counts=None: chaque valeur non nulle compte pour 1 (lignes = formations sanitaires).
+    Les niveaux supérieurs sont calculés depuis le niveau inférieur (sommes et comptes s'additionnent).
+    """
+    gidx: Dict[str, int] = {}
+    rows: List[int] = []
+    for k in keys:
+        g = group_of.get(k, UNKNOWN)
+        i = gidx.get(g)
+        if i is None:
+            i = gidx[g] = len(gidx)
+        rows.append(i)
+    n = len(gidx)
+    sums = array("d", [NAN]) * (n * width)
+    cnts = array("d", [0.0]) * (n * width)
+    nou = array("l", [0]) * n
+    for r, g in enumerate(rows):
+        src = r * width
+        dst = g * width
+        row = values[src : src + width]
+        nonnull = [c for c, v in enumerate(row) if v == v]
+        if not nonnull:
+            continue
+        nou[g] += 1 if n_ou is None else n_ou[r]
+        for c in nonnull:
+            old = sums[dst + c]
+            sums[dst + c] = row[c] if old != old else old + row[c]
+            cnts[dst + c] += 1.0 if counts is None else counts[src + c]
+    return Rollup(level=level, keys=list(gidx), width=width, sums=sums, counts=cnts, n_ou=nou)
+
+
+def rollup_levels(table: MonthTable, parents: Dict[int, Dict[str, str]]) -> List[Rollup]:
+    """
+    Org4, Org3 puis Org2 d'un mois. parents[level][ou5] = clé du parent de ce niveau;
+    chaque niveau est agrégé depuis le précédent (un groupe Org4 a un seul parent Org3, etc.).
+    """
+    w = table.width
+    keys = list(table.ous)  # ordre des lignes de la matrice
+    values: array = table.data
+    counts: Optional[array] = None
+    n_ou: Optional[array] = None
+    group_of: Dict[str, str] = parents[ROLLUP_LEVELS[0]]
+    out: List[Rollup] = []
+    for i, level in enumerate(ROLLUP_LEVELS):
+        r = group_by(keys, w, values, counts, n_ou, group_of, level)
+        out.append(r)
+        if i + 1 < len(ROLLUP_LEVELS):
+            up = parents[ROLLUP_LEVELS[i + 1]]
+            # parent du groupe = parent de n'importe laquelle de ses formations
+            group_of = {}
+            for ou5, g in parents[level].items():
+                group_of.setdefault(g, up.get(ou5, UNKNOWN))
+            keys, values, counts, n_ou = r.keys, r.sums, r.counts, r.n_ou
+    return out
+
+
+def iter_rollup_records(
+    r: Rollup,
+    period: str,
+    columns: List[str],
+    mean_cols: Set[int],
+    info: Dict[str, dict],
+) -> Iterator[dict]:
+    """Lignes triées par clé: {OrgUnit, Level, Name, parents..., Period, n_ou, colonnes..., "<col> [n]"}."""
+    w = r.width
+    for g in sorted(range(len(r.keys)), key=lambda i: r.keys[i]):
+        key = r.keys[g]
+        rec: dict = {"OrgUnit": key, "Level": r.level}
+        rec.update(info.get(key) or {"Name": ""})
+        rec["Period"] = period
+        rec["n_ou"] = r.n_ou[g]
+        base = g * w
+        for c, col in enumerate(columns):
+            s = r.sums[base + c]
+            n = r.counts[base + c]
+            if s != s:
+                rec[col] = None
+            elif c in mean_cols:
+                rec[col] = s / n
+            else:
+                rec[col] = s
+        for c in sorted(mean_cols):
+            rec[f"{columns[c]} [n]"] = int(r.counts[base + c])
+        yield rec
+
+
+def ou_hierarchy(ou_map: Dict[str, dict]) -> Tuple[Dict[int, Dict[str, str]], Dict[str, dict]]:
+    """
+    Depuis ou_map.json.gz: (parents[level][ou5] = clé du parent, infos par clé: nom et parents).
+    Clé = uid (Org2Id...) ; un ancien ou_map sans uid utilise le chemin des noms "Org2/Org3/...".
+    """
+    parents: Dict[int, Dict[str, str]] = {lvl: {} for lvl in ROLLUP_LEVELS}
+    info: Dict[str, dict] = {}
+    for ou5, e in ou_map.items():
+        path: List[str] = []
+        above: dict = {}
+        for lvl in (2, 3, 4):
+            name = e.get(f"Org{lvl}") or ""
+            path.append(name)
+            key = e.get(f"Org{lvl}Id") or "/".join(path)
+            parents[lvl][ou5] = key
+            if key not in info:
+                info[key] = {"Name": name, **above}
+            above = {**above, f"Org{lvl}": name, f"Org{lvl}Id": key}
+    return parents, info
+
+
+@dataclass
+class RollupSpec:
+    """Hiérarchie (depuis ou_map.json.gz) et colonnes moyennées, communes à tous les mois d'une run."""
+
+    parents: Dict[int, Dict[str, str]]
+    info: Dict[str, dict]
+    mean_cols: Set[int] = field(default_factory=set)
+
+    @classmethod
+    def from_ou_map(cls, ou_map: Dict[str, dict], dx_expected: List[str]) -> "RollupSpec":
+        parents, info = ou_hierarchy(ou_map)
+        mean_cols = {i for i, dx in enumerate(dx_expected) if AGG_RULES.get(dx) == "mean"}
+        return cls(parents=parents, info=info, mean_cols=mean_cols)
+
+    def records(self, table: MonthTable) -> Dict[int, List[dict]]:
+        """Lignes agrégées du mois, par niveau (2, 3, 4)."""
+        return {
+            r.level: list(iter_rollup_records(r, table.period, table.columns, self.mean_cols, self.info))
+            for r in rollup_levels(table, self.parents)
+        }
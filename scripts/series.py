@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sparse_format import compact_number
+
+# Produit "series": toutes les périodes d'une OU dans un seul fichier (courbes par formation).
+# Les OU sont réparties en N seaux: series/b-XXX.json.gz, XXX = fnv1a32(uid UTF-8) % N
+# (FNV-1a 32 bits: h = 0x811c9dc5; pour chaque octet: h = ((h ^ octet) * 0x01000193) mod 2^32).
+# {
+#   "format": "series-v1",
+#   "columns": ["BCG fixe1", ...],
+#   "series": {"<ou>": {"202501": [[col, ...], [val, ...]], ...}, ...}   # cellules non nulles
+# }
+SERIES_FORMAT = "series-v1"
+
+
+def fnv1a32(s: str) -> int:
+    h = 0x811C9DC5
+    for b in s.encode("utf-8"):
+        h = ((h ^ b) * 0x01000193) & 0xFFFFFFFF
+    return h
+
+
+@dataclass
+class SeriesStore:
+    """
+    Mise à jour incrémentale des seaux: les mois rafraîchis sont mis en tampon (cellules non nulles
+    par seau), puis chaque seau concerné est relu, modifié pour ces mois seulement et réécrit
+    s'il a changé. Le tampon est vidé dès qu'il dépasse max_buffer_cells (mémoire bornée en backfill).
+    """
+
+    root: Path
+    columns: List[str]
+    buckets: int = 256
+    max_buffer_cells: int = 3_000_000
+    files: Dict[str, dict] = field(default_factory=dict)  # meta par seau publié (index.json)
+    months: Dict[str, str] = field(default_factory=dict)  # mois intégré -> signature du mois publié
+    month_buckets: Dict[str, List[int]] = field(default_factory=dict)  # mois intégré -> seaux où il figure
+
+    def __post_init__(self) -> None:
+        self.root = Path(self.root)
+        self.pending: Dict[str, Dict[int, Dict[str, list]]] = {}  # pe -> seau -> ou -> [cols, vals]
+        self.pending_sig: Dict[str, str] = {}
+        self.pending_cells = 0
+
+    @classmethod
+    def from_index(cls, root: Path, columns: List[str], meta: Optional[dict], buckets: int) -> "SeriesStore":
+        """Reprend l'état publié (index.json["series"]); un autre nombre de seaux repart de zéro."""
+        s = cls(root=root, columns=columns, buckets=buckets)
+        if meta and meta.get("buckets") == buckets and meta.get("format") == SERIES_FORMAT:
+            s.files = dict(meta.get("files") or {})
+            s.months = dict(meta.get("months") or {})
+            s.month_buckets = {pe: list(b) for pe, b in (meta.get("month_buckets") or {}).items()}
+        return s
+
+    def bucket_of(self, ou: str) -> int:
+        return fnv1a32(ou) % self.buckets
+
+    def name(self, b: int) -> str:
+        return f"b-{b:03d}.json.gz"
+
+    def needs(self, pe: str, signature: str) -> bool:
+        return self.months.get(pe) != signature and self.pending_sig.get(pe) != signature
+
+    def update_month(self, pe: str, signature: str, rows: Iterable[Tuple[str, Sequence[float]]]) -> None:
+        """rows = (ou, valeurs alignées sur columns, None/NaN = absent): remplace le mois pe de chaque OU."""
+        by_bucket: Dict[int, Dict[str, list]] = {}
+        for ou, values in rows:
+            cols: List[int] = []
+            vals: List[object] = []
+            for c, v in enumerate(values):
+                if v is None or v != v:
+                    continue
+                cols.append(c)
+                vals.append(compact_number(float(v)))
+            if cols:
+                by_bucket.setdefault(self.bucket_of(ou), {})[ou] = [cols, vals]
+                self.pending_cells += len(cols)
+        self.pending[pe] = by_bucket
+        self.pending_sig[pe] = signature
+        if self.pending_cells > self.max_buffer_cells:
+            self.flush()
+
+    def _load(self, b: int) -> dict:
+        path = self.root / self.name(b)
+        try:
+            with gzip.open(path, "rb") as f:
+                obj = json.loads(f.read())
+        except (OSError, ValueError):
+            return {"format": SERIES_FORMAT, "columns": self.columns, "series": {}}
+        if obj.get("columns") != self.columns:
+            # liste de colonnes changée: réindexer par nom, les colonnes disparues sont perdues
+            pos = {c: i for i, c in enumerate(self.columns)}
+            old_cols = obj.get("columns") or []
+            for months in obj.get("series", {}).values():
+                for pe, (cols, vals) in list(months.items()):
+                    kept = [(pos[old_cols[c]], v) for c, v in zip(cols, vals) if old_cols[c] in pos]
+                    months[pe] = [[c for c, _ in kept], [v for _, v in kept]]
+            obj["columns"] = self.columns
+        return obj
+
+    def _save(self, b: int, obj: dict) -> None:
+        raw = json.dumps(obj, ensure_ascii=False, separators=(",", ":"), sort_keys=True).encode("utf-8")
+        sha = hashlib.sha256(raw).hexdigest()
+        name = self.name(b)
+        if (self.files.get(name) or {}).get("sha256") == sha and (self.root / name).exists():
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.root / f".{name}.tmp"
+        with gzip.GzipFile(tmp, "wb", compresslevel=9, mtime=0) as f:
+            f.write(raw)
+        os.replace(tmp, self.root / name)
+        self.files[name] = {"rows": len(obj["series"]), "bytes": (self.root / name).stat().st_size, "sha256": sha}
+
+    def flush(self) -> List[str]:
+        """Applique les mois en tampon; renvoie les seaux réécrits."""
+        if not self.pending:
+            return []
+        before = {k: v.get("sha256") for k, v in self.files.items()}
+        touched = {b for by_bucket in self.pending.values() for b in by_bucket}
+        # les OU disparues d'un mois rafraîchi sont dans les seaux où ce mois figurait
+        published = {b for b in range(self.buckets) if self.name(b) in self.files}
+        for pe in self.pending:
+            if pe in self.month_buckets:
+                touched |= set(self.month_buckets[pe]) & published
+            elif pe in self.months:
+                touched |= published  # index d'avant month_buckets: seaux du mois inconnus
+        for b in sorted(touched):
+            obj = self._load(b)
+            series = obj["series"]
+            for pe, by_bucket in self.pending.items():
+                for months in series.values():
+                    months.pop(pe, None)
+                for ou, cells in by_bucket.get(b, {}).items():
+                    series.setdefault(ou, {})[pe] = cells
+            obj["series"] = {ou: m for ou, m in series.items() if m}
+            self._save(b, obj)
+        self.months.update(self.pending_sig)
+        for pe, by_bucket in self.pending.items():
+            self.month_buckets[pe] = sorted(by_bucket)
+        self.pending.clear()
+        self.pending_sig.clear()
+        self.pending_cells = 0
+        return sorted(k for k, v in self.files.items() if before.get(k) != v.get("sha256"))
+
+    def meta(self) -> dict:
+        return {
+            "format": SERIES_FORMAT,
+            "buckets": self.buckets,
+            "hash": "fnv1a32",
+            "path": "series/b-{bucket:03d}.json.gz",
+            "files": self.files,
+            "months": self.months,
+            "month_buckets": self.month_buckets,
+        }
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import struct
+import sys
+from array import array
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Sequence, Set
+
+# Format "sparse-v2" d'un mois (monthly/<pe>/sparse.bin.gz), à côté ou à la place des parts NDJSON.
+# Contenu décompressé:
+#   b"SPRS" | longueur de l'en-tête (u32 little-endian) | en-tête JSON UTF-8 | blocs des colonnes
+# En-tête:
+# {
+#   "format": "sparse-v2",
+#   "period": "2026-01-01",
+#   "columns": ["BCG fixe1", ...],          # dictionnaire des colonnes, écrit une seule fois
+#   "ous": ["A0Fnzg0FvLl", ...],            # dictionnaire des OrgUnit (triés): ligne i = ous[i]
+#   "blocks": [{"dtype": "u16", "count": 3021, "offset": 0, "bytes": 8733}, ...]   # un par colonne
+# }
+# Bloc de la colonne c (offset compté depuis la fin de l'en-tête):
+# - bitmap des valeurs présentes: ceil(len(ous) / 8) octets, ligne i = bit (i & 7) de l'octet i >> 3;
+# - les `count` valeurs présentes, dans l'ordre des lignes, tableau typé little-endian du plus petit
+#   type qui les contient toutes: u8, u16, u32 (entiers >= 0), i32, f64. Au-delà d'un octet, le
+#   tableau est rangé par plans d'octets (tous les octets de poids faible, puis les suivants):
+#   les poids forts, presque constants, se compressent bien. Un client reconstitue le tableau typé
+#   en une passe (v = p0[k] | p1[k] << 8 ...), sans parser de texte.
+SPARSE_FORMAT = "sparse-v2"
+SPARSE_FILE = "sparse.bin.gz"
+SPARSE_MAGIC = b"SPRS"
+
+# dtype -> (code array, largeur en octets)
+DTYPES = {"u8": ("B", 1), "u16": ("H", 2), "u32": ("I", 4), "i32": ("i", 4), "f64": ("d", 8)}
+BITS = [tuple(b for b in range(8) if byte >> b & 1) for byte in range(256)]
+
+
+def compact_number(v: float) -> object:
+    return int(v) if v.is_integer() and abs(v) < 2**53 else v
+
+
+def pick_dtype(values: Sequence[float]) -> str:
+    """Plus petit type de DTYPES qui représente exactement toutes les valeurs."""
+    if not values or not all(v.is_integer() for v in values):
+        return "f64" if values else "u8"
+    lo, hi = min(values), max(values)
+    if lo >= 0:
+        for dtype, limit in (("u8", 1 << 8), ("u16", 1 << 16), ("u32", 1 << 32)):
+            if hi < limit:
+                return dtype
+    if -(1 << 31) <= lo and hi < 1 << 31:
+        return "i32"
+    return "f64"
+
+
+def encode_values(values: Sequence[float], dtype: str) -> bytes:
+    code, width = DTYPES[dtype]
+    arr = array(code, [int(v) for v in values] if dtype != "f64" else values)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    raw = arr.tobytes()
+    return raw if width == 1 else b"".join(raw[k::width] for k in range(width))
+
+
+def decode_values(blob: bytes, dtype: str, count: int) -> array:
+    code, width = DTYPES[dtype]
+    if width == 1:
+        raw = blob
+    else:
+        buf = bytearray(count * width)
+        for k in range(width):
+            buf[k::width] = blob[k * count : (k + 1) * count]
+        raw = bytes(buf)
+    arr = array(code)
+    arr.frombytes(raw)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+
+class SparseMonthBuilder:
+    """Construit le format creux d'un mois ligne par ligne, depuis la matrice pivotée (add_values)."""
+
+    def __init__(self, columns: List[str], period: Optional[str] = None) -> None:
+        self.columns = list(columns)
+        self.ous: List[str] = []
+        self.period = period
+        self.rows: List[List[int]] = [[] for _ in self.columns]
+        self.values: List[List[float]] = [[] for _ in self.columns]
+        self.cells = 0
+
+    def add_values(self, ou: str, values: Sequence[Optional[float]]) -> None:
+        """Une ligne: valeurs alignées sur columns (None ou NaN = absent)."""
+        i = len(self.ous)
+        self.ous.append(ou)
+        for c, v in enumerate(values):
+            if v is None or v != v:
+                continue
+            self.rows[c].append(i)
+            self.values[c].append(float(v))
+            self.cells += 1
+
+    def to_bytes(self) -> bytes:
+        nbytes = (len(self.ous) + 7) // 8
+        blocks: List[dict] = []
+        body = bytearray()
+        for rows, values in zip(self.rows, self.values):
+            bitmap = bytearray(nbytes)
+            for i in rows:
+                bitmap[i >> 3] |= 1 << (i & 7)
+            dtype = pick_dtype(values)
+            data = bytes(bitmap) + encode_values(values, dtype)
+            blocks.append({"dtype": dtype, "count": len(values), "offset": len(body), "bytes": len(data)})
+            body += data
+        header = {
+            "format": SPARSE_FORMAT,
+            "period": self.period,
+            "columns": self.columns,
+            "ous": self.ous,
+            "blocks": blocks,
+        }
+        head = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return SPARSE_MAGIC + struct.pack("<I", len(head)) + head + bytes(body)
+
+    def write(self, path: Path, level: int = 9, mtime: Optional[int] = 0) -> dict:
+        raw = self.to_bytes()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with gzip.GzipFile(path, "wb", compresslevel=level, mtime=mtime) as f:
+            f.write(raw)
+        return {
+            "file": path.name,
+            "rows": len(self.ous),
+            "cells": self.cells,
+            "bytes": path.stat().st_size,
+            "sha256": hashlib.sha256(raw).hexdigest(),
+        }
+
+
+def read_header(f: BinaryIO) -> dict:
+    if f.read(4) != SPARSE_MAGIC:
+        raise ValueError("not a sparse-v2 month file")
+    (size,) = struct.unpack("<I", f.read(4))
+    header = json.loads(f.read(size))
+    if header.get("format") != SPARSE_FORMAT:
+        raise ValueError(f"unsupported sparse format {header.get('format')!r}")
+    return header
+
+
+def read_sparse(path: Path, header_only: bool = False) -> dict:
+    """
+    En-tête + colonnes décodées: obj["data"][c] = (indices des lignes présentes, valeurs).
+    header_only: seulement l'en-tête (colonnes, OrgUnit), sans décompresser les blocs.
+    """
+    with gzip.open(path, "rb") as f:
+        obj = read_header(f)
+        if header_only:
+            return obj
+        body = f.read()
+    nbytes = (len(obj["ous"]) + 7) // 8
+    data = []
+    for b in obj["blocks"]:
+        blob = body[b["offset"] : b["offset"] + b["bytes"]]
+        rows = [(k << 3) | bit for k, byte in enumerate(blob[:nbytes]) if byte for bit in BITS[byte]]
+        values = decode_values(blob[nbytes:], b["dtype"], b["count"])
+        if len(rows) != b["count"] or len(values) != b["count"]:
+            raise ValueError(f"{path}: corrupted column block")
+        data.append((rows, values))
+    obj["data"] = data
+    return obj
+def iter_sparse_records(
+    obj: dict, columns: Optional[List[str]] = None, ous: Optional[Set[str]] = None
+) -> Iterator[dict]:
+    """Reconstruit les lignes larges (OrgUnit, Period, colonnes...) d'un mois creux (seulement `ous` si donné)."""
+    all_cols: List[str] = obj["columns"]
+    wanted = all_cols if columns is None else [c for c in columns if c in all_cols]
+    rows = None if ous is None else {i for i, ou in enumerate(obj["ous"]) if ou in ous}
+    by_ou: Dict[int, Dict[str, object]] = {}
+    for c in wanted:
+        idx, vals = obj["data"][all_cols.index(c)]
+        if vals.typecode == "d":
+            vals = [compact_number(v) for v in vals]  # entiers quand c'est possible, comme en NDJSON
+        for i, val in zip(idx, vals):
+            if rows is None or i in rows:
+                by_ou.setdefault(i, {})[c] = val
+    for i, ou in enumerate(obj["ous"]):
+        if rows is not None and i not in rows:
+            continue
+        cells = by_ou.get(i, {})
+        rec: dict = {"OrgUnit": ou, "Period": obj.get("period")}
+        for c in wanted:
+            rec[c] = cells.get(c)
+        yield rec
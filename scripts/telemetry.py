@@ -0,0 +1,345 @@
+from __future__ import annotations
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, TypeVar
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore[assignment]
+
+# Mesures d'une exécution, publiées dans docs/data/run_stats.json (à côté de index.json):
+# - 1 enregistrement par requête HTTP (Dhis2Client): latence jusqu'aux en-têtes, durée totale,
+#   octets reçus (décompressés et sur le réseau), tentatives refaites par urllib3, réponse servie par le cache;
+# - 1 par chunk analytics: lignes, temps, CPU de parsing (flux JSON ou CSV), du pivot et du journal;
+# - par étape (rows_to_records, pivot_records, write_ndjson_gz_parts, publication d'un mois...):
+#   nombre d'appels, temps, CPU du thread appelant, CPU de tout le processus pendant l'étape
+#   (inclut la compression parallèle et les workers de fetch), pic RSS du processus pendant l'étape
+#   (Linux, voir RssPeaks; None ailleurs).
+# Un historique glissant des résumés permet de voir la tendance d'un run à l'autre.
+
+RUN_STATS_FILE = "run_stats.json"
+T = TypeVar("T")
+
+
+def rss_peak_mb() -> Optional[float]:
+    """Pic de mémoire résidente du processus depuis son démarrage (None si indisponible)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)  # macOS: octets, Linux: Ko
+
+
+def read_hwm_kb() -> Optional[int]:
+    """VmHWM (pic RSS depuis la dernière remise à zéro) de /proc/self/status, en Ko."""
+    try:
+        with open("/proc/self/status", "rb") as f:
+            for line in f:
+                if line.startswith(b"VmHWM:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def reset_hwm() -> bool:
+    """Ramène VmHWM au RSS courant (Linux >= 4.0); False si le noyau ou les droits ne le permettent pas."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class RssPeaks:
+    """
+    Pic RSS par étape. ru_maxrss ne redescend jamais: une étape lancée après le fetch en hériterait.
+    À l'ouverture d'une étape, le pic VmHWM en cours est reporté sur toutes les étapes ouvertes
+    (imbriquées ou dans d'autres threads) puis remis au RSS courant; à la fermeture, l'étape garde le
+    maximum vu pendant sa durée. La remise à zéro touche aussi ru_maxrss: le pic du processus est
+    donc suivi ici (process_peak_mb).
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.enabled = read_hwm_kb() is not None and reset_hwm()
+        self.open: Dict[int, int] = {}
+        self.next_token = 0
+        self.process_kb = 0
+
+    def _fold(self) -> None:
+        kb = read_hwm_kb() or 0
+        self.process_kb = max(self.process_kb, kb)
+        for token, peak in self.open.items():
+            self.open[token] = max(peak, kb)
+
+    def begin(self) -> Optional[int]:
+        if not self.enabled:
+            return None
+        with self.lock:
+            self._fold()
+            reset_hwm()
+            self.next_token += 1
+            self.open[self.next_token] = 0
+            return self.next_token
+
+    def end(self, token: Optional[int]) -> Optional[float]:
+        """Pic RSS (Mo) du processus entre begin() et end(); None si non mesurable."""
+        if token is None:
+            return None
+        with self.lock:
+            self._fold()
+            return round(self.open.pop(token) / 1024, 1)
+
+    def process_peak_mb(self) -> Optional[float]:
+        peak = rss_peak_mb()
+        if not self.enabled:
+            return peak
+        with self.lock:
+            self._fold()
+            mb = round(self.process_kb / 1024, 1)
+        return mb if peak is None else max(mb, peak)
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    s = sorted(values)
+    return round(s[min(len(s) - 1, int(q * len(s)))], 3)
+
+
+def spread(values: List[float]) -> dict:
+    return {"p50": percentile(values, 0.5), "p90": percentile(values, 0.9), "max": percentile(values, 1.0)}
+
+
+class Telemetry:
+    """Collecteur partagé par tous les threads d'une exécution (TELEMETRY ci-dessous)."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.profile_lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.started = datetime.utcnow().isoformat(timespec="seconds") + "Z"
+            self.t0 = time.perf_counter()
+            self.cpu0 = time.process_time()
+            self.requests: List[dict] = []
+            self.chunks: List[dict] = []
+            self.stages: Dict[str, dict] = {}
+            self.profile_period: Optional[str] = None
+            self.profiles: List[cProfile.Profile] = []
+            self.rss = RssPeaks()
+
+    # ---- requêtes HTTP ----
+
+    def request_started(self) -> None:
+        # requête envoyée tant que le cache n'a pas répondu; status None = échec avant les en-têtes
+        self.local.request = {"status": None}
+
+    def request_sent(self, status: int, ttfb_s: float, retries: int, relogin: bool) -> None:
+        """Appelé par Dhis2Client._request une fois les en-têtes reçus (après les tentatives urllib3)."""
+        self.local.request = {"status": status, "ttfb_s": round(ttfb_s, 3), "retries": retries, "relogin": relogin}
+
+    def request_done(
+        self,
+        path: str,
+        params: Dict[str, object],
+        nbytes: int,
+        total_s: float,
+        error: str = "",
+        wire_bytes: Optional[int] = None,
+        cached: bool = False,
+    ) -> None:
+        """
+        nbytes = corps décodé; wire_bytes = octets reçus avant décompression (défaut: nbytes);
+        cached = corps servi par ResponseCache sans requête.
+        """
+        rec = getattr(self.local, "request", None) or {"status": None}
+        self.local.request = None
+        if cached:
+            rec = {"status": 200, "cached": True}
+        wire = nbytes if wire_bytes is None else wire_bytes
+        rec = {"path": path, **request_labels(params), **rec, "bytes": nbytes, "wire_bytes": wire}
+        rec["total_s"] = round(total_s, 3)
+        if error:
+            rec["error"] = error
+        with self.lock:
+            self.requests.append(rec)
+
+    # ---- chunks analytics ----
+
+    def chunk(
+        self, label: str, n_dx: int, rows: int, wall_s: float, cpu_s: float, pivot_cpu_s: float, spill_cpu_s: float
+    ) -> None:
+        """cpu_s = CPU du thread sur tout le chunk; le parsing est ce qui reste hors pivot et journal."""
+        with self.lock:
+            self.chunks.append(
+                {
+                    "label": label,
+                    "dx": n_dx,
+                    "rows": rows,
+                    "wall_s": round(wall_s, 3),
+                    "parse_cpu_s": round(max(cpu_s - pivot_cpu_s - spill_cpu_s, 0.0), 3),
+                    "pivot_cpu_s": round(pivot_cpu_s, 3),
+                    "spill_cpu_s": round(spill_cpu_s, 3),
+                }
+            )
+
+    # ---- étapes ----
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        w0, c0, p0 = time.perf_counter(), time.thread_time(), time.process_time()
+        token = self.rss.begin()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - w0
+            cpu = time.thread_time() - c0
+            pcpu = time.process_time() - p0
+            peak = self.rss.end(token)
+            with self.lock:
+                s = self.stages.setdefault(
+                    name, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "process_cpu_s": 0.0, "rss_peak_mb": None}
+                )
+                s["calls"] += 1
+                s["wall_s"] += wall
+                s["cpu_s"] += cpu
+                s["process_cpu_s"] += pcpu
+                if peak is not None:
+                    s["rss_peak_mb"] = max(s["rss_peak_mb"] or 0.0, peak)
+
+    # ---- profilage (opt-in, une période) ----
+
+    def profiled(self, periods: List[str], fn: Callable[..., T], *args: object, **kw: object) -> T:
+        """
+        Exécute fn sous cProfile si la période profilée en fait partie (sinon appel direct).
+        Depuis Python 3.12 (sys.monitoring), un seul profileur peut être actif dans le processus:
+        les appels profilés sont sérialisés, les unités de la période profilée passent une par une
+        pendant que les autres périodes continuent en parallèle.
+        """
+        if self.profile_period is None or self.profile_period not in periods:
+            return fn(*args, **kw)
+        with self.profile_lock:
+            prof = cProfile.Profile()
+            try:
+                return prof.runcall(fn, *args, **kw)
+            finally:
+                with self.lock:
+                    self.profiles.append(prof)
+
+    def dump_profile(self, path: Path, top: int = 40) -> Optional[Path]:
+        """Fusionne les profils (un par thread/appel) en un fichier .pstats + un résumé texte."""
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0])
+        for p in profiles[1:]:
+            stats.add(p)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        stats.dump_stats(str(path))
+        buf = io.StringIO()
+        pstats.Stats(str(path), stream=buf).sort_stats("cumulative").print_stats(top)
+        path.with_suffix(".txt").write_text(buf.getvalue(), encoding="utf-8")
+        return path
+
+    # ---- résumé ----
+
+    def summary(self) -> dict:
+        with self.lock:
+            reqs = list(self.requests)
+            chunks = list(self.chunks)
+            stages = {k: dict(v) for k, v in self.stages.items()}
+        sent = [r for r in reqs if not r.get("cached")]
+        lat = [r["ttfb_s"] for r in sent if "ttfb_s" in r]
+        total = [r["total_s"] for r in reqs]
+        by_path: Dict[str, dict] = {}
+        for r in reqs:
+            p = by_path.setdefault(r["path"], {"count": 0, "bytes": 0, "wire_bytes": 0, "total_s": 0.0, "retries": 0})
+            p["count"] += 1
+            p["bytes"] += r["bytes"]
+            p["wire_bytes"] += r.get("wire_bytes", r["bytes"])
+            p["total_s"] = round(p["total_s"] + r["total_s"], 3)
+            p["retries"] += r.get("retries", 0)
+        rows = [c["rows"] for c in chunks]
+        for s in stages.values():
+            for k in ("wall_s", "cpu_s", "process_cpu_s"):
+                s[k] = round(s[k], 3)
+        return {
+            "started": self.started,
+            "duration_s": round(time.perf_counter() - self.t0, 1),
+            "process_cpu_s": round(time.process_time() - self.cpu0, 1),
+            "rss_peak_mb": self.rss.process_peak_mb(),
+            "requests": {
+                "count": len(reqs),
+                "sent": len(sent),
+                "cached": len(reqs) - len(sent),
+                "errors": sum(1 for r in reqs if r.get("error") or (r.get("status") or 0) >= 400),
+                "retries": sum(r.get("retries", 0) for r in reqs),
+                "relogins": sum(1 for r in reqs if r.get("relogin")),
+                "bytes": sum(r["bytes"] for r in reqs),
+                "wire_bytes": sum(r.get("wire_bytes", r["bytes"]) for r in reqs),
+                "ttfb_s": spread(lat),
+                "total_s": spread(total),
+                "by_path": by_path,
+            },
+            "chunks": {
+                "count": len(chunks),
+                "rows": sum(rows),
+                "rows_per_chunk": {"min": min(rows, default=0), **spread(rows)},
+                "parse_cpu_s": round(sum(c["parse_cpu_s"] for c in chunks), 3),
+                "pivot_cpu_s": round(sum(c["pivot_cpu_s"] for c in chunks), 3),
+                "spill_cpu_s": round(sum(c["spill_cpu_s"] for c in chunks), 3),
+            },
+            "stages": stages,
+        }
+
+    def write(self, path: Path, extra: Optional[dict] = None, history: int = 30) -> dict:
+        """run_stats.json: {"last": résumé + détail des requêtes et chunks, "history": [résumés]}."""
+        path = Path(path)
+        previous: List[dict] = []
+        try:
+            previous = json.loads(path.read_text(encoding="utf-8")).get("history") or []
+        except (OSError, ValueError):
+            pass
+        summary = {**self.summary(), **(extra or {})}
+        with self.lock:
+            detail = {"requests_detail": list(self.requests), "chunks_detail": list(self.chunks)}
+        doc = {"last": {**summary, **detail}, "history": (previous + [summary])[-history:]}
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(json.dumps(doc, ensure_ascii=False, indent=1), encoding="utf-8")
+        os.replace(tmp, path)
+        return summary
+
+
+def request_labels(params: Dict[str, object]) -> dict:
+    """pe / ou / nb de dx d'une requête analytics (les listes de dx complètes seraient trop longues)."""
+    out: dict = {}
+    for dim in params.get("dimension") or []:
+        name, _, value = str(dim).partition(":")
+        if name == "dx":
+            out["dx"] = len(value.split(";"))
+        elif name in ("pe", "ou"):
+            out[name] = value
+    if "page" in params:
+        out["page"] = params["page"]
+    return out
+
+
+TELEMETRY = Telemetry()